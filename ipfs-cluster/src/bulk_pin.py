@@ -0,0 +1,129 @@
+# Copyright 2021 Erik Lönroth
+# See LICENSE file for licensing details.
+
+"""
+Pin a (large) CID manifest through the ipfs-cluster REST API.
+
+The manifest has one CID per line, optionally followed by a pin name. Blank lines
+and lines starting with # are skipped. It is read a batch at a time, so memory
+use does not grow with the manifest, and the byte offset after each completed
+batch is handed to a checkpoint callback to resume from.
+"""
+
+import logging
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
+
+import requests
+
+logger = logging.getLogger(__name__)
+
+# How many failed CIDs to report back, the counters cover the rest.
+FAILED_SAMPLE = 10
+
+
+def manifest_id(path):
+    """
+    Identifies a manifest file, a checkpoint only applies to the same one.
+    A re-attached resource or edited file gets a new id and starts over.
+    """
+    st = os.stat(path)
+    return f"{os.path.realpath(path)}:{st.st_size}:{st.st_mtime_ns}"
+
+
+def read_manifest(path, offset=0):
+    """
+    Yield (offset after the line, cid, name) from byte offset on.
+    """
+    with open(path, 'rb') as f:
+        f.seek(offset)
+        for line in f:
+            offset += len(line)
+            fields = line.decode('utf-8', 'replace').split(None, 1)
+            if not fields or fields[0].startswith('#'):
+                continue
+            name = fields[1].strip() if len(fields) > 1 else None
+            yield offset, fields[0], name or None
+
+
+def _pin(cluster, replication_min, replication_max, retries):
+    """
+    Pin one CID. Returns None once pinned, or why the cluster rejected it (4xx).
+
+    Connection problems and server errors are retried with a growing pause and
+    raised once the retries are used up, the pin may well succeed later.
+    """
+    def pin(entry):
+        _, cid, name = entry
+        for attempt in range(retries + 1):
+            try:
+                cluster.pin(cid, replication_min, replication_max, name=name)
+                return None
+            except requests.RequestException as e:
+                response = getattr(e, 'response', None)
+                if response is not None and response.status_code < 500:
+                    return f"{cid}: {e}"
+                if attempt == retries:
+                    raise
+            time.sleep(0.5 * 2 ** attempt)
+    return pin
+
+
+def run(cluster, path, offset=0, batch_size=1000, concurrency=16, replication_min=0,
+        replication_max=0, retries=2, checkpoint=None, progress=None):
+    """
+    Pin everything in the manifest at path from byte offset on.
+
+    Pins go out concurrency at a time, batch_size per batch. After each batch
+    checkpoint(offset, counts) and progress(counts) are called. Pinning is
+    idempotent in ipfs-cluster, so resuming from the last checkpoint after an
+    interruption only repeats part of one batch.
+
+    Only pins the cluster rejected count as failed. When it can't be reached,
+    or keeps answering with server errors, the run stops with that
+    RequestException, checkpointed up to the first CID that was not pinned.
+    """
+    if batch_size <= 0 or concurrency <= 0:
+        raise ValueError("batch-size and concurrency must be positive")
+
+    counts = {'pinned': 0, 'failed': 0, 'pins-per-s': 0}
+    failed = []
+    started = time.monotonic()
+    entries = read_manifest(path, offset)
+    pin = _pin(cluster, replication_min, replication_max, retries)
+
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        while True:
+            batch = list(islice(entries, batch_size))
+            if not batch:
+                break
+            try:
+                for (end, _, _), error in zip(batch, pool.map(pin, batch)):
+                    if error is None:
+                        counts['pinned'] += 1
+                    else:
+                        counts['failed'] += 1
+                        if len(failed) < FAILED_SAMPLE:
+                            failed.append(error)
+                    offset = end
+            except requests.RequestException as e:
+                logger.warning(f"Cluster API unavailable, stopping at byte {offset}: {e}")
+                if checkpoint:
+                    checkpoint(offset, counts)
+                raise
+
+            seconds = time.monotonic() - started
+            if seconds:
+                counts['pins-per-s'] = round((counts['pinned'] + counts['failed']) / seconds, 1)
+            if checkpoint:
+                checkpoint(offset, counts)
+            if progress:
+                progress(counts)
+
+    result = dict(counts, offset=offset, seconds=round(time.monotonic() - started, 1))
+    if failed:
+        logger.warning(f"{counts['failed']} pins failed, first ones: {failed}")
+        result['failed-sample'] = '\n'.join(failed)
+    return result
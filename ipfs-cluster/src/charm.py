@@ -3,19 +3,28 @@
 # See LICENSE file for licensing details.
 
 import logging
-import os
 import shutil
 from pathlib import Path
 import requests
-from ops.charm import CharmBase
+from ops.charm import CharmBase, RelationDepartedEvent, UpdateStatusEvent
 from ops.framework import StoredState
 from ops.main import main
-from ops.model import ActiveStatus, BlockedStatus, WaitingStatus, MaintenanceStatus
-import subprocess
+from ops.model import BlockedStatus, WaitingStatus, MaintenanceStatus, ModelError
 import sys
-import jinja2
 import json
 import utils
+import files
+import hookstats
+import service_config
+import systemd_unit
+import storage
+import pin_benchmark
+import bulk_pin
+import releases
+import rebalance
+import health
+import upstreams
+from cluster_api import ClusterApi, DEFAULT_CLUSTER_API_URL, DEFAULT_IPFS_API_URL
 
 logger = logging.getLogger(__name__)
 
@@ -29,6 +38,14 @@ IPFS_HOME = Path('/opt/ipfs/')
 IPFS_CTL = Path('/opt/ipfs/ipfs-cluster-ctl/')
 IPFS_SERVICE = Path('/opt/ipfs/ipfs-cluster-service/')
 IPFS = Path('/opt/ipfs/go-ipfs/')
+SYSTEMD_UNIT = Path('/etc/systemd/system/ipfs-cluster.service')
+
+# The cluster shares the host with its ipfs daemon, which gets the lion's share.
+CLUSTER_MEMORY_SHARE = 0.25
+
+# Published role -> the relation its upstreams go out on.
+UPSTREAM_RELATIONS = {'api': 'web', 'proxy': 'proxy'}
+
 
 class IPFSClusterCharm(CharmBase):
     """IPFS cluster with all core hooks."""
@@ -37,223 +54,748 @@ class IPFSClusterCharm(CharmBase):
 
     def __init__(self, *args):
         super().__init__(*args)
+        # Shown next to the service state, e.g. where a rolling upgrade is at.
+        self._upgrade_note = None
         self.framework.observe(self.on.install, self._on_install)
-        self.framework.observe(self.on.config_changed, self._on_config_changed)
-        self.framework.observe(self.on.start, self._on_start)
-        self.framework.observe(self.on.leader_elected, self._on_leader_elected)
         self.framework.observe(self.on.stop, self._on_stop)
-        self.framework.observe(self.on.update_status, self._on_update_status)
-
-
-        # Peer relation
-        self.framework.observe(self.on.replicas_relation_joined, self._on_replicas_relation_joined)
-        self.framework.observe(self.on.replicas_relation_departed, self._on_replicas_relation_departed)
-        self.framework.observe(self.on.replicas_relation_changed, self._on_replicas_relation_changed)
-
+        self.framework.observe(self.on.hook_stats_action, self._on_hook_stats_action)
+        self.framework.observe(self.on.ipfs_cluster_state_storage_attached,
+                               self._on_ipfs_cluster_state_storage_attached)
+        self.framework.observe(self.on.ipfs_cluster_state_storage_detaching,
+                               self._on_ipfs_cluster_state_storage_detaching)
+        self.framework.observe(self.on.pin_benchmark_action, self._on_pin_benchmark_action)
+        self.framework.observe(self.on.bulk_pin_action, self._on_bulk_pin_action)
+
+        # Everything else converges through one idempotent reconcile pass,
+        # including the peer relation events and the update-status tick.
+        for event in (self.on.config_changed,
+                      self.on.start,
+                      self.on.leader_elected,
+                      self.on.upgrade_charm,
+                      self.on.update_status,
+                      self.on.replicas_relation_joined,
+                      self.on.replicas_relation_changed,
+                      self.on.replicas_relation_departed,
+                      self.on.ipfs_relation_joined,
+                      self.on.ipfs_relation_changed,
+                      self.on.web_relation_joined,
+                      self.on.proxy_relation_joined):
+            self.framework.observe(event, self._reconcile)
 
         self._stored.set_default(service_sources_uri=self.config["service-sources-uri"],
                                  ctl_sources_uri=self.config["ctl-sources-uri"],
+                                 release=None,
+                                 previous_release=None,
                                  restart_on_reconfig=self.config["restart-on-reconfig"],
                                  leader_ip=None,
                                  cluster_secret=None,
                                  identity_id=None,
-                                 has_peers=False)
-
-
+                                 has_peers=False,
+                                 hook_stats=[],
+                                 bulk_pin={},
+                                 latency=[],
+                                 version_cache={},
+                                 state_detached=False,
+                                 queued=None,
+                                 restart_pending=False)
+
+    @hookstats.timed
     def _on_install(self, event):
         """
         Install ipfs-cluster
         """
         logger.debug(EMOJI_CORE_HOOK_EVENT + sys._getframe().f_code.co_name)
 
-        logger.info(f"Installing ctl from source uri {EMOJI_PACKAGE}")
-        os.system(f"mkdir -p {IPFS_HOME}")
-        utils.fetch_and_extract_sources(self._stored.ctl_sources_uri, IPFS_HOME)
+        logger.info(f"Installing ctl and service from source uris {EMOJI_PACKAGE}")
+        hookstats.system(f"mkdir -p {IPFS_HOME}")
+        if self._ensure_installed():
+            self._install_cluster_unit()
 
-        logger.info(f"Installing service from source uri {EMOJI_PACKAGE}")     
-        utils.fetch_and_extract_sources(self._stored.service_sources_uri, IPFS_HOME)
-        
-        shutil.copyfile('templates/etc/systemd/system/ipfs-cluster.service', '/etc/systemd/system/ipfs-cluster.service')
+    def _ensure_installed(self):
+        """
+        Stage and activate the configured release and init ipfs-cluster, where
+        that did not happen yet. Returns whether the unit is installed.
 
-        # Do the init - produces the service.json and other configs
-        # ./ipfs-cluster-service init
-        # configuration written to /home/ubuntu/.ipfs-cluster/service.json
-        # new identity written to /home/ubuntu/.ipfs-cluster/identity.json
-        # new empty peerstore written to /home/ubuntu/.ipfs-cluster/peerstore
-        os.system('sudo -u ubuntu /opt/ipfs/ipfs-cluster-service/ipfs-cluster-service init --force')
+        Install starts this, every reconcile repeats it until it succeeded, so a
+        failed download or a sha256 fixed in config later leaves nothing stuck.
+        """
+        if not (IPFS_SERVICE / 'ipfs-cluster-service').exists():
+            name = self._desired_release()
+            try:
+                self._stage_release(name)
+            except (requests.RequestException, utils.ArtifactVerificationError, OSError) as e:
+                logger.error(f"Failed to install ipfs-cluster binaries: {e}")
+                self.unit.status = BlockedStatus("Failed to fetch ipfs-cluster binaries, "
+                                                 "retrying on the next hook.")
+                return False
+            # Nothing runs yet, no need to wait for a turn.
+            releases.activate(name)
+            self._stored.release = name
+
+        if not utils.SERVICE_JSON.exists():
+            # Do the init - produces the service.json and other configs
+            # ./ipfs-cluster-service init
+            # configuration written to /home/ubuntu/.ipfs-cluster/service.json
+            # new identity written to /home/ubuntu/.ipfs-cluster/identity.json
+            # new empty peerstore written to /home/ubuntu/.ipfs-cluster/peerstore
+            hookstats.system('sudo -u ubuntu '
+                             '/opt/ipfs/ipfs-cluster-service/ipfs-cluster-service init --force')
+        return True
+
+    @hookstats.timed
+    def _on_stop(self, event):
+        """
+        Bring down your service, possibly defer until all systems are good to go similar to
+        start hook.
+        """
+        logger.debug(EMOJI_CORE_HOOK_EVENT + sys._getframe().f_code.co_name)
 
+        logger.info(f"{EMOJI_RED_DOT} Stopping the ipfs-cluster service...")
+        hookstats.system('systemctl stop ipfs-cluster.service')
 
-    def _on_config_changed(self, event):
+    @hookstats.timed
+    def _on_ipfs_cluster_state_storage_attached(self, event):
         """
-        Update configs.
+        Put the cluster state on the volume, moving existing state over while it runs.
+
+        Runs before install on new units, then init writes straight onto the volume.
         """
         logger.debug(EMOJI_CORE_HOOK_EVENT + sys._getframe().f_code.co_name)
-        if not self._stored.cluster_secret:
-            self.unit.status = BlockedStatus("Missing secret for config.")
-            logger.error("Hold up start, missing cluster secret.")
-        else:
-            utils.write_service_json({'cluster_secret': self._stored.cluster_secret})
-        
-        self._on_update_status(event)
+        location = event.storage.location
+        target = location / 'ipfs-cluster'
+        storage.ensure_noatime(location)
 
-    def _on_start(self, event):
+        self._stored.state_detached = False
+        if storage.is_bind_mounted(target, utils.CLUSTER_HOME):
+            return
+        if not storage.has_data(utils.CLUSTER_HOME):
+            storage.bind_mount(target, utils.CLUSTER_HOME)
+            shutil.chown(utils.CLUSTER_HOME, 'ubuntu', 'ubuntu')
+            return
+
+        logger.info(f"{EMOJI_PACKAGE} Moving {utils.CLUSTER_HOME} onto {target}")
+        running = hookstats.system('systemctl is-active ipfs-cluster.service') == 0
+
+        def progress(phase, percent):
+            self.unit.status = MaintenanceStatus(f"Moving state to storage: {phase} {percent}%")
+
+        def stop():
+            if running:
+                hookstats.system('systemctl stop ipfs-cluster.service')
+
+        def start():
+            if running:
+                hookstats.system('systemctl start ipfs-cluster.service')
+
+        storage.migrate(utils.CLUSTER_HOME, target, stop, start, progress)
+        self._update_status()
+
+    @hookstats.timed
+    def _on_ipfs_cluster_state_storage_detaching(self, event):
         """
-            Start your service here, possibly defer (wait) until conditions are OK.
+        The state goes with the volume, stop the cluster before it disappears.
         """
         logger.debug(EMOJI_CORE_HOOK_EVENT + sys._getframe().f_code.co_name)
-        logger.info(f"{EMOJI_GREEN_DOT} Starting ipfs-cluster.service")
+        logger.info(f"{EMOJI_RED_DOT} Stopping ipfs-cluster, state storage detaching")
+        hookstats.system('systemctl stop ipfs-cluster.service')
+        storage.unmount(utils.CLUSTER_HOME)
+        self._stored.state_detached = True
+        self.unit.status = BlockedStatus("ipfs-cluster-state storage detached.")
 
-        # If no peers, just start as we are.
-        if self.model.unit.is_leader():
-            os.system('systemctl start ipfs-cluster.service')
-        else:
-            # Wait until there is a peerstore file
-            if not self._stored.has_peers:
-                self.unit.status = BlockedStatus("Has no peers.")
-                logger.info("Hold up start, waiting for peerstore file.")
-                event.defer()
-                return
-            elif not self._stored.cluster_secret:
-                self.unit.status = BlockedStatus("Missing secret for config.")
-                logger.info("Hold up start, missing cluster secret.")
-                event.defer()
-                return
-            else:
-                utils.write_service_json({'cluster_secret': self._stored.cluster_secret})
-                os.system('systemctl start ipfs-cluster.service')
-            
-        # Calling update_status gives quick feedback when deploying starts up.
-        self._on_update_status(event)
-        self.unit.set_workload_version(utils.getIpfsClusterVersion())
+    def _on_hook_stats_action(self, event):
+        """
+        Wall time and external command percentiles per hook, from the last hook-stats-size runs.
+        """
+        records = list(self._stored.hook_stats)
+        summary = hookstats.summarize(records, event.params.get("hook") or None)
+        event.set_results({"recorded": len(records), "hooks": summary})
 
+    def _on_pin_benchmark_action(self, event):
+        """
+        Pin ingest rate and time to pinned through the cluster REST API, see pin_benchmark.run.
+        """
+        params = event.params
+        concurrency = params.get("concurrency", 8)
+        try:
+            with ClusterApi(DEFAULT_CLUSTER_API_URL, pool_size=concurrency) as cluster:
+                results = pin_benchmark.run(cluster, DEFAULT_IPFS_API_URL,
+                                            count=params.get("count", 100),
+                                            concurrency=concurrency,
+                                            replication_min=params.get("replication-min", 0),
+                                            replication_max=params.get("replication-max", 0),
+                                            block_size=params.get("block-size", 1024),
+                                            timeout=params.get("timeout", 300))
+        except (requests.RequestException, ValueError) as e:
+            event.fail(f"Pin benchmark failed: {e}")
+            return
+        event.set_results(results)
 
-    def _on_leader_elected(self, event):
+    def _on_bulk_pin_action(self, event):
         """
-            This is only run on the unit which is selected by juju as leader.
+        Pin a CID manifest, resuming from the checkpoint of an earlier run on it.
         """
-        logger.debug(EMOJI_CORE_HOOK_EVENT + sys._getframe().f_code.co_name)
+        params = event.params
+        try:
+            path = params.get("manifest") or self.model.resources.fetch("cid-manifest")
+            manifest = bulk_pin.manifest_id(path)
+        except (ModelError, OSError) as e:
+            event.fail(f"No CID manifest: {e}")
+            return
+
+        state = dict(self._stored.bulk_pin)
+        if state.get("manifest") != manifest or params.get("restart"):
+            state = {"manifest": manifest, "offset": 0, "pinned": 0, "failed": 0}
+        elif state["offset"]:
+            event.log(f"Resuming at byte {state['offset']}, {state['pinned']} pinned before")
+        before = dict(state)
+
+        def checkpoint(offset, counts):
+            state.update(offset=offset,
+                         pinned=before["pinned"] + counts["pinned"],
+                         failed=before["failed"] + counts["failed"])
+            self._stored.bulk_pin = state
+            # Persist now, not at the end of the action, so a kill loses one batch at most.
+            self.framework.commit()
+
+        def progress(counts):
+            event.log(f"{state['pinned']} pinned, {state['failed']} failed, "
+                      f"{counts['pins-per-s']} pins/s")
+
+        concurrency = params.get("concurrency", 16)
+        try:
+            with ClusterApi(DEFAULT_CLUSTER_API_URL, pool_size=concurrency) as cluster:
+                result = bulk_pin.run(cluster, path, offset=state["offset"],
+                                      batch_size=params.get("batch-size", 1000),
+                                      concurrency=concurrency,
+                                      replication_min=params.get("replication-min", 0),
+                                      replication_max=params.get("replication-max", 0),
+                                      checkpoint=checkpoint, progress=progress)
+        except requests.RequestException as e:
+            event.fail(f"Bulk pin stopped at byte {state['offset']}, cluster API unavailable: "
+                       f"{e}. Run it again to resume.")
+            return
+        except (OSError, ValueError) as e:
+            event.fail(f"Bulk pin failed: {e}")
+            return
+        result.update({"total-pinned": state["pinned"], "total-failed": state["failed"]})
+        event.set_results(result)
+
+    @hookstats.timed
+    def _reconcile(self, event):
+        """
+        Converge the unit on what relation data, config and binaries say it should be.
+
+        Each step compares desired with observed state (service.json, peerstore,
+        systemd) and only acts on a difference, so this is cheap to run from every
+        hook. Nothing is deferred: data that is missing now arrives with a later
+        relation-changed, and update-status re-runs the pass anyway.
+        """
+        logger.debug(EMOJI_CORE_HOOK_EVENT + event.handle.kind)
+
+        if self._stored.state_detached:
+            # Don't init a new identity where the state volume used to be mounted.
+            return
+        if not self._ensure_installed():
+            return
+
         peer_relation = self.model.get_relation("replicas")
-        ip = str(self.model.get_binding(peer_relation).network.bind_address)
+        departed = event.departing_unit or event.unit \
+            if isinstance(event, RelationDepartedEvent) else None
+
+        if self.unit.is_leader():
+            self._reconcile_leader_data(peer_relation)
+        else:
+            self._reconcile_follower_data(peer_relation)
+
+        if peer_relation:
+            self._publish_peer_id(peer_relation)
+            self._publish_tags(peer_relation)
+            self.writePeerStore(departed)
+
+        self._reconcile_release(peer_relation)
 
+        if not self._stored.cluster_secret:
+            logger.info("Hold up, missing cluster secret.")
+            self.unit.status = WaitingStatus("Waiting for cluster secret from leader.")
+            return
+
+        settings = self._service_settings(peer_relation)
+        if settings is None:
+            return
+        changed = self._write_service_json(settings)
+
+        unit_changed = self._install_cluster_unit()
+        self._reconcile_service(peer_relation, changed or unit_changed)
+        if self.unit.is_leader() and peer_relation:
+            self._reconcile_rebalance(peer_relation, settings)
+        probed = self._update_status(tick=isinstance(event, UpdateStatusEvent))
+        self._publish_upstreams(peer_relation, settings, probed, departed)
+
+    def _reconcile_leader_data(self, peer_relation):
+        """
+        The leader owns the cluster secret and hands it, its address and identity,
+        to the others through the application data bag.
+        """
         # Pick up values from generated files if we don't have it stored.
         if not self._stored.cluster_secret:
             self._stored.cluster_secret = utils.get_cluster_secret()
         if not self._stored.identity_id:
             self._stored.identity_id = utils.get_identity_id()
-            
-        peer_relation.data[self.app].update({"leader-ip": ip})
-        peer_relation.data[self.app].update({"secret": self._stored.cluster_secret})
-        peer_relation.data[self.app].update({"id": self._stored.identity_id})
 
-    def _on_update_status(self, event):
+        if not peer_relation:
+            return
+        desired = {"leader-ip": str(self.model.get_binding(peer_relation).network.bind_address),
+                   "secret": self._stored.cluster_secret,
+                   "id": self._stored.identity_id}
+        app_data = peer_relation.data[self.app]
+        stale = {key: value for key, value in desired.items() if app_data.get(key) != value}
+        if stale:
+            logger.debug("Leader %s publishing %s", self.unit.name, list(stale))
+            app_data.update(stale)
+
+    def _reconcile_follower_data(self, peer_relation):
         """
-        Tell the world.
+        Store the latest copy of the leader's data in our state store.
         """
-        logger.debug(EMOJI_CORE_HOOK_EVENT + sys._getframe().f_code.co_name)
+        if not peer_relation:
+            return
+        app_data = peer_relation.data[self.app]
+        for stored, key in (("leader_ip", "leader-ip"),
+                            ("cluster_secret", "secret"),
+                            ("identity_id", "id")):
+            value = app_data.get(key)
+            if value and value != getattr(self._stored, stored):
+                setattr(self._stored, stored, value)
+
+    def _desired_release(self):
+        return releases.release_name(self.config["service-sources-uri"],
+                                     self.config["ctl-sources-uri"])
+
+    def _stage_release(self, name):
+        sources = [(self.config["ctl-sources-uri"], self.config["ctl-sources-sha256"]),
+                   (self.config["service-sources-uri"], self.config["service-sources-sha256"])]
+        return releases.stage(name, sources, self.config["artifact-cache-size"] * 1024 * 1024)
+
+    def _reconcile_release(self, peer_relation):
+        """
+        Roll the configured sources out one peer at a time.
+
+        Every unit stages the new release next to the running one and says so in
+        its unit data. The leader hands out upgrade-turn in the app data to one
+        staged unit at a time, which switches, restarts and publishes its release
+        once its pin tracker caught up. The next turn waits until the leader sees
+        that peer back in the cluster.
+        """
+        desired = self._desired_release()
+        unit_data = peer_relation.data[self.unit] if peer_relation else {}
+
+        if releases.current() != desired:
+            try:
+                self._stage_release(desired)
+            except (requests.RequestException, utils.ArtifactVerificationError, OSError) as e:
+                logger.error(f"Failed to stage release {desired}: {e}")
+                self._upgrade_note = f"Upgrade to {desired} failed to fetch."
+                return
+            if peer_relation and unit_data.get("release-staged") != desired:
+                unit_data["release-staged"] = desired
+
+        if self.unit.is_leader() and peer_relation:
+            self._reconcile_upgrade_turn(peer_relation, desired)
+
+        if releases.current() != desired and self._has_turn(peer_relation, "upgrade-turn"):
+            self._switch_release(desired)
 
-        if not os.system('systemctl is-active ipfs-cluster.service') == 0:
+        active = releases.current()
+        if peer_relation and active and unit_data.get("release") != active:
+            if self._caught_up():
+                unit_data["release"] = active
+                if self.unit.is_leader():
+                    self._reconcile_upgrade_turn(peer_relation, desired)
+            else:
+                self._upgrade_note = f"Catching up on {active}."
+
+    def _reconcile_upgrade_turn(self, peer_relation, desired):
+        """
+        Leader only: pass upgrade-turn on once the previous holder is back.
+
+        The leader goes last, it has to stay up to judge the others.
+        """
+        app_data = peer_relation.data[self.app]
+        units = sorted(peer_relation.units, key=lambda u: int(u.name.split('/')[-1]))
+        units.append(self.unit)
+
+        turn = app_data.get("upgrade-turn")
+        holder = next((unit for unit in units if unit.name == turn), None)
+        if holder and not self._rejoined(peer_relation, holder, desired):
+            self._upgrade_note = f"Upgrade to {desired}: waiting for {turn} to rejoin."
+            return
+
+        pending = [unit for unit in units if peer_relation.data[unit].get("release") != desired]
+        next_turn = ""
+        if pending and peer_relation.data[pending[0]].get("release-staged") == desired:
+            next_turn = pending[0].name
+            self._upgrade_note = f"Upgrade to {desired}: {next_turn} is upgrading."
+        elif pending:
+            self._upgrade_note = f"Upgrade to {desired}: waiting for {pending[0].name} to stage."
+        if app_data.get("upgrade-turn", "") != next_turn:
+            logger.info(f"Upgrade turn {turn} -> {next_turn or 'nobody'}")
+            app_data["upgrade-turn"] = next_turn
+
+    def _rejoined(self, peer_relation, unit, desired):
+        """
+        unit runs desired, caught up, and is back in our view of the cluster peers.
+        """
+        if peer_relation.data[unit].get("release") != desired:
+            return False
+        return self._in_cluster(peer_relation, unit)
+
+    def _in_cluster(self, peer_relation, unit):
+        """
+        unit is us, or in our view of the cluster peers without an error.
+        """
+        if unit == self.unit:
+            return True
+        try:
+            with ClusterApi(DEFAULT_CLUSTER_API_URL) as cluster:
+                peers = cluster.peers()
+        except requests.RequestException as e:
+            logger.warning(f"Can't list cluster peers: {e}")
+            return False
+        peer_id = peer_relation.data[unit].get("peer-id")
+        return any(peer.get("id") == peer_id and not peer.get("error") for peer in peers)
+
+    def _switch_release(self, name):
+        """
+        Point the binaries at release name and restart onto it, keeping the
+        release we came from around to roll back to.
+        """
+        running = hookstats.system('systemctl is-active ipfs-cluster.service') == 0
+        releases.activate(name)
+        # Binaries from before releases end up as 'legacy'.
+        previous = self._stored.release or 'legacy'
+        self._stored.previous_release, self._stored.release = previous, name
+        # Queue lengths from before the restart say nothing about the new release.
+        self._stored.queued = None
+        self._stored.service_sources_uri = self.config["service-sources-uri"]
+        self._stored.ctl_sources_uri = self.config["ctl-sources-uri"]
+        if running:
+            logger.info(f"{EMOJI_GREEN_DOT} Restarting ipfs-cluster.service on release {name}")
+            hookstats.system('systemctl restart ipfs-cluster.service')
+        releases.prune({name, previous})
+
+    def _caught_up(self):
+        """
+        Our cluster peer answers and its pin tracker keeps up: at most
+        upgrade-max-queued pins queued, or no more than on the previous check.
+
+        Looks once, a peer that is behind is checked again by the next hook
+        (update-status at the latest) rather than waited for here.
+        """
+        try:
+            with ClusterApi(DEFAULT_CLUSTER_API_URL) as cluster:
+                cluster.id()
+                queued = len(cluster.pins(filter='queued', local=True))
+        except requests.RequestException as e:
+            logger.info(f"ipfs-cluster API not answering yet: {e}")
+            return False
+        previous, self._stored.queued = self._stored.queued, queued
+        if queued <= self.config["upgrade-max-queued"]:
+            return True
+        if previous is not None and queued <= previous:
+            logger.info(f"Pin tracker has {queued} pins queued, no more than before ({previous}).")
+            return True
+        logger.info(f"Pin tracker has {queued} pins queued, not caught up yet.")
+        return False
+
+    def _install_cluster_unit(self):
+        """
+        Render ipfs-cluster.service with resource settings sized for this host.
+
+        The expected connection count is the cluster connection manager high_water.
+        Only reloads systemd when the rendered unit changed. Returns whether it did.
+        """
+        resources = systemd_unit.host_resources()
+        settings = systemd_unit.compute(resources, utils.get_connection_high_water(),
+                                        CLUSTER_MEMORY_SHARE, self.config)
+        unit = systemd_unit.render('templates/etc/systemd/system/ipfs-cluster.service.j2',
+                                   **settings)
+        if SYSTEMD_UNIT.exists() and SYSTEMD_UNIT.read_text() == unit:
+            return False
+        files.write_atomic(SYSTEMD_UNIT, unit)
+        logger.info(f"Installed new {SYSTEMD_UNIT}")
+        hookstats.system('systemctl daemon-reload')
+        return True
+
+    def _reconcile_service(self, peer_relation, config_changed):
+        """
+        Start the service once it can join the cluster, restart it on config changes.
+
+        A change that reaches every unit at once, like the replication factors on a
+        peer join, would restart them all together. Restarts take turns instead:
+        units with one pending say so in restart-pending, and the leader hands out
+        restart-turn in the app data to one at a time.
+        """
+        if hookstats.system('systemctl is-active ipfs-cluster.service') != 0:
+            # The leader bootstraps the cluster, the others need somebody to dial.
+            if not self.unit.is_leader() and not self._stored.has_peers:
+                logger.info("Hold up start, waiting for peerstore entries.")
+                return
+            logger.info(f"{EMOJI_GREEN_DOT} Starting ipfs-cluster.service")
+            hookstats.system('systemctl start ipfs-cluster.service')
+            self._stored.restart_pending = False
+        elif config_changed and self.config["restart-on-reconfig"]:
+            self._stored.restart_pending = True
+
+        if self._stored.restart_pending and self._has_turn(peer_relation, "restart-turn"):
+            logger.info(f"{EMOJI_GREEN_DOT} Restarting ipfs-cluster.service for new config")
+            hookstats.system('systemctl restart ipfs-cluster.service')
+            self._stored.restart_pending = False
+
+        if not peer_relation:
+            return
+        pending = "true" if self._stored.restart_pending else ""
+        if peer_relation.data[self.unit].get("restart-pending", "") != pending:
+            peer_relation.data[self.unit]["restart-pending"] = pending
+        if self.unit.is_leader():
+            self._reconcile_restart_turn(peer_relation)
+
+    def _has_turn(self, peer_relation, key):
+        if not peer_relation or not peer_relation.units:
+            return True
+        return peer_relation.data[self.app].get(key) == self.unit.name
+
+    def _reconcile_restart_turn(self, peer_relation):
+        """
+        Leader only: pass restart-turn on once the previous holder restarted and
+        is back in the cluster. The leader goes last.
+        """
+        app_data = peer_relation.data[self.app]
+        units = sorted(peer_relation.units, key=lambda u: int(u.name.split('/')[-1]))
+        units.append(self.unit)
+
+        turn = app_data.get("restart-turn", "")
+        holder = next((unit for unit in units if unit.name == turn), None)
+        if holder:
+            pending = peer_relation.data[holder].get("restart-pending")
+            if pending or not self._in_cluster(peer_relation, holder):
+                return
+
+        pending = [unit for unit in units if peer_relation.data[unit].get("restart-pending")]
+        next_turn = pending[0].name if pending else ""
+        if turn != next_turn:
+            logger.info(f"Restart turn {turn or 'nobody'} -> {next_turn or 'nobody'}")
+            app_data["restart-turn"] = next_turn
+
+    def _update_status(self, tick=False):
+        """
+        Tell the world. Returns what the health probe found, see _probe_health.
+
+        A running service whose API does not answer is Blocked from the update-status
+        tick on, other hooks may be looking right after a (re)start.
+        """
+        probed = self._probe_health()
+        if probed is not None:
+            self.unit.status = health.to_status(*probed, note=self._upgrade_note)
+        elif not hookstats.system('systemctl is-active ipfs-cluster.service') == 0:
             logger.info("ipfs-cluster service is not running.")
-            self.unit.status = MaintenanceStatus("Inactive.")
+            if not self.unit.is_leader() and not self._stored.has_peers:
+                self.unit.status = WaitingStatus("Waiting for peers.")
+            else:
+                self.unit.status = MaintenanceStatus("Inactive.")
+        elif tick:
+            self.unit.status = BlockedStatus("Running, but the REST API is not answering.")
         else:
-            logger.info(f"ipfs-daemon service is running.")
-            self.unit.status = ActiveStatus("Running.")
+            self.unit.status = MaintenanceStatus("Waiting for the REST API.")
 
         if self.model.unit.is_leader():
-                self.unit.set_workload_version(utils.getIpfsClusterVersion())
-        
-    def _on_stop(self, event):
+            version = health.cached_version(self._stored.version_cache,
+                                            IPFS_SERVICE / 'ipfs-cluster-service',
+                                            utils.getIpfsClusterVersion)
+            if version:
+                self.unit.set_workload_version(version)
+        return probed
+
+    def _probe_health(self):
         """
-        Bring down your service, possibly defer until all systems are good to go similar to start hook.
+        Time REST API round trips, (state, p95) over the recent ones.
+
+        Blocked if a call took longer than health-blocked-ms, None if the API
+        did not answer at all.
         """
-        logger.debug(EMOJI_CORE_HOOK_EVENT + sys._getframe().f_code.co_name)
+        blocked_ms = self.config["health-blocked-ms"]
+        try:
+            with ClusterApi(DEFAULT_CLUSTER_API_URL, timeout=blocked_ms / 1000) as cluster:
+                times = health.probe([cluster.id, lambda: list(cluster.peers())],
+                                     self.config["health-samples"])
+        except requests.Timeout as e:
+            logger.warning(f"ipfs-cluster REST API timed out: {e}")
+            return health.timed_out(self._stored.latency, blocked_ms)
+        except (requests.RequestException, ValueError) as e:
+            logger.warning(f"ipfs-cluster REST API not answering: {e}")
+            return None
+        health.record(self._stored.latency, times)
+        state, p95 = health.assess(self._stored.latency, self.config["health-degraded-ms"],
+                                   blocked_ms)
+        logger.info(f"ipfs-cluster REST API p95 {p95} ms over {len(self._stored.latency)} "
+                    f"probes: {state}")
+        return state, p95
+
+    def _service_settings(self, peer_relation):
+        """
+        Throughput, replication and allocation settings, the daemon API address and
+        our tags, as dotted service.json keys. None (and Blocked) if the config is invalid.
 
-        logger.info(f"{EMOJI_RED_DOT} Stopping the ipfs-cluster service...")
-        os.system('systemctl stop ipfs-cluster.service')
+        Replication and allocation default to what suits the units in the deployment.
+        """
+        tags = [self._tags()]
+        units = 1
+        if peer_relation:
+            units += len(peer_relation.units)
+            tags += [json.loads(peer_relation.data[unit].get("tags") or "{}")
+                     for unit in peer_relation.units]
+        defaults = service_config.default_replication(units)
+        defaults.update(service_config.default_allocation(tags))
+        try:
+            settings = service_config.settings_from_config(self.config, defaults)
+            public = upstreams.parse_roles(self.config["public-endpoints"],
+                                           list(service_config.LISTENERS))
+        except ValueError as e:
+            logger.error(f"Invalid service.json config: {e}")
+            self.unit.status = BlockedStatus(str(e))
+            return None
+        settings.update(service_config.ipfs_node_settings(self._ipfs_api_multiaddr()))
+        settings.update(service_config.tag_settings(tags[0]))
+        current = utils.get_service_settings([key for key, _ in service_config.LISTENERS.values()])
+        settings.update(service_config.listen_settings(current, public))
+        return settings
+
+    def _write_service_json(self, settings):
+        """
+        Merge secret and settings into service.json. Returns whether the file changed.
+        """
+        return utils.write_service_json({'cluster_secret': self._stored.cluster_secret}, settings)
 
+    def _tags(self):
+        return utils.host_tags(self.config["disk-tier"] or None)
 
-    def _on_replicas_relation_joined(self, event):
-        logger.debug(EMOJI_CORE_HOOK_EVENT + sys._getframe().f_code.co_name)
+    def _publish_tags(self, relation):
+        """
+        Let the other peers know our zone and disk tier, allocation defaults follow them.
+        """
+        tags = json.dumps(self._tags(), sort_keys=True)
+        if relation.data[self.unit].get("tags") != tags:
+            relation.data[self.unit].update({"tags": tags})
 
-        """Handle relation-joined event for the replicas relation"""
-        logger.debug("Hello from %s to %s", self.unit.name, event.unit.name)
+    def _reconcile_rebalance(self, peer_relation, settings):
+        """
+        Leader only: once the replication factors grow, re-pin the pins made with the
+        old ones, rebalance-batch-size per hook until none are left.
 
-        # Check if we're the leader, meaning we are responsible
-        # for sending config. No peerstore expected to exists for
-        # leader, so only set local store values.
-        if self.unit.is_leader():
-            ip = str(self.model.get_binding(event.relation).network.bind_address)
-            logging.debug("Leader %s setting some data!", self.unit.name)
-            event.relation.data[self.app].update({"leader-ip": ip})
-            event.relation.data[self.app].update({"secret": self._stored.cluster_secret})
-            event.relation.data[self.app].update({"id": str(self._stored.identity_id)})
-        else:
-                self.writePeerStore()
-                self._stored.has_peers = True
+        The applied factors and those still to move away from live in the app data,
+        so a new leader carries on.
+        """
+        factors = [settings['cluster.replication_factor_min'],
+                   settings['cluster.replication_factor_max']]
+        app_data = peer_relation.data[self.app]
+        applied = json.loads(app_data.get("replication") or "null")
+        pending = json.loads(app_data.get("rebalance-from") or "[]")
+        if applied != factors:
+            if applied and -1 not in applied and (factors[1] == -1 or factors[1] > applied[1]):
+                pending.append(applied)
+            pending = [old for old in pending if old != factors]
+            app_data.update({"replication": json.dumps(factors),
+                             "rebalance-from": json.dumps(pending)})
+        if not pending or hookstats.system('systemctl is-active ipfs-cluster.service') != 0:
+            return
 
-    def _on_replicas_relation_departed(self, event):
-        logger.debug(EMOJI_CORE_HOOK_EVENT + sys._getframe().f_code.co_name)
-        logger.debug("Goodbye from %s to %s", self.unit.name, event.unit.name)
+        try:
+            with ClusterApi(DEFAULT_CLUSTER_API_URL) as cluster:
+                moved = rebalance.run(cluster, pending, factors,
+                                      self.config["rebalance-batch-size"])
+        except requests.RequestException as e:
+            logger.warning(f"Rebalance batch failed, retrying next hook: {e}")
+            return
+        if not moved:
+            logger.info(f"Rebalanced all pins onto replication {factors}")
+            app_data.update({"rebalance-from": ""})
 
-    def _on_replicas_relation_changed(self, event):
-        logger.debug(EMOJI_CORE_HOOK_EVENT + sys._getframe().f_code.co_name)
+    def _publish_upstreams(self, peer_relation, settings, probed, departed=None):
+        """
+        Our public REST API and proxy listeners, weighted by the REST API latency
+        (probed, None if it did not answer).
 
-        logging.debug("Unit %s can see the following data: %s", self.unit.name, event.relation.data.keys())
-        # {'egress-subnets': '10.166.0.21/32',
-        #  'ingress-address': '10.166.0.21',
-        #  'private-address': '10.166.0.21',
-        #  'unit-data': 'ipfs-cluster/0'},
-        #  <ops.model.Application ipfs-cluster>:
-        #    {'id': 'someid',
-        #     'leader-ip': '10.166.0.21',
-        #     'secret': 'somesecret'},
-        #  <ops.model.Unit ipfs-cluster/1>:
-        #    {'egress-subnets': '10.166.0.20/32',
-        #     'ingress-address': '10.166.0.20',
-        #     'private-address': '10.166.0.20',
-        #     'unit-data': 'ipfs-cluster/1'}}
-
-        # Fetch an item from the application data bucket
-        leader_ip_value = event.relation.data[self.app].get("leader-ip")
-        cluster_secret = event.relation.data[self.app]['secret']
-        identity_id = event.relation.data[self.app]['id']
-
-        valid_relation = True
-        
-        # Store the latest copy of data locally in our state store
-        if leader_ip_value and leader_ip_value != self._stored.leader_ip:
-            self._stored.leader_ip = leader_ip_value
-        else:
-            valid_relation = False
-        
-        if cluster_secret and cluster_secret != self._stored.cluster_secret:
-            self._stored.cluster_secret = cluster_secret
-        else:
-            valid_relation = False
-            
-        if identity_id and identity_id != self._stored.identity_id:
-            self._stored.identity_id = identity_id
-        else:
-            valid_relation = False
+        They go in our replicas unit data, and as hostname and port on the web and
+        proxy relations. The leader lists every unit's in the app data of those.
+        """
+        state, p95 = probed or ('blocked', 0)
+        weight = health.weight(state, p95, self.config["health-degraded-ms"])
+        listeners = {role: settings.get(key)
+                     for role, (key, _) in service_config.LISTENERS.items()}
+        address = str(self.model.get_binding("web").network.ingress_address)
+        own = upstreams.entries(self.unit.name, address, listeners, state, weight)
+        if peer_relation:
+            upstreams.update(peer_relation.data[self.unit], {"upstreams": json.dumps(own)})
+
+        every = upstreams.gather(peer_relation, own, departed) if self.unit.is_leader() else None
+        for role, endpoint in UPSTREAM_RELATIONS.items():
+            mine = [entry for entry in own if entry["role"] == role]
+            for relation in self.model.relations[endpoint]:
+                if mine:
+                    upstreams.update(relation.data[self.unit], {"hostname": address,
+                                                                "port": str(mine[0]["port"])})
+                if every is not None:
+                    upstreams.update(relation.data[self.app], {"upstreams": json.dumps(
+                        [entry for entry in every if entry["role"] == role])})
+
+    def _ipfs_api_multiaddr(self):
+        """
+        API multiaddr published by the ipfs-daemon we are a subordinate of.
 
-        # In case we dont have all data needed to write config
-        # and start with that, lets defer() and wait.
-        if not valid_relation:
-            event.defer()
+        With api-socket set there that is a unix socket, which saves the TCP
+        loopback round trip on every pin and status call.
+        """
+        relation = self.model.get_relation("ipfs")
+        if not relation:
+            return None
+        for unit in relation.units:
+            multiaddr = relation.data[unit].get("api-multiaddr")
+            if multiaddr:
+                return multiaddr
+        return None
+
+    def _publish_peer_id(self, relation):
+        """
+        Let the other peers know our cluster peer ID, they build their peerstore from it.
+        """
+        if not utils.IDENTITY_JSON.exists():
             return
+        peer_id = utils.get_identity_id()
+        if relation.data[self.unit].get("peer-id") != peer_id:
+            relation.data[self.unit].update({"peer-id": peer_id})
 
-    def writePeerStore(self):
+    def writePeerStore(self, departed=None):
         """
         Write peerstore to file
+
+        One entry per live peer which published its own peer ID. Only the
+        difference to what is on disk is applied, so most hooks don't write at all.
         """
         peer_relation = self.model.get_relation("replicas")
-        identity_id = self._stored.identity_id
-            
-        with open("/home/ubuntu/.ipfs-cluster/peerstore", "w+") as peerstoreFile:
-            for peer in peer_relation.units:
-                peer_ip = peer_relation.data[peer].get("ingress-address")
-                peerstoreFile.write(f"/ip4/{peer_ip}/tcp/9096/p2p/{identity_id}\n")
-        
-
-            
+        if not peer_relation:
+            return
+
+        entries = set()
+        for peer in peer_relation.units:
+            if peer == departed:
+                continue
+            peer_ip = peer_relation.data[peer].get("ingress-address")
+            peer_id = peer_relation.data[peer].get("peer-id")
+            if peer_ip and peer_id:
+                entries.add(utils.peer_multiaddr(peer_ip, peer_id))
+
+        utils.update_peerstore(entries)
+        self._stored.has_peers = bool(entries)
+
+
 if __name__ == "__main__":
     main(IPFSClusterCharm)
@@ -0,0 +1,113 @@
+# Copyright 2021 Erik Lönroth
+# See LICENSE file for licensing details.
+
+import json
+import logging
+
+import requests
+from requests.adapters import HTTPAdapter
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_CLUSTER_API_URL = "http://127.0.0.1:9094"
+DEFAULT_IPFS_API_URL = "http://127.0.0.1:5001"
+DEFAULT_TIMEOUT = 10
+
+PIN_ERRORS = ('pin_error', 'unpin_error', 'cluster_error')
+
+
+def json_items(response):
+    """
+    Decode a JSON list, or the newline delimited objects newer versions stream.
+    """
+    try:
+        body = response.json()
+        return body if isinstance(body, list) else [body]
+    except ValueError:
+        return [json.loads(line) for line in response.text.splitlines() if line.strip()]
+
+
+def pin_state(info):
+    """
+    Summarize a GlobalPinInfo: 'pinned' once every allocated peer has it,
+    'error' if any of them failed, 'pending' otherwise.
+    """
+    statuses = [peer.get('status') for peer in (info.get('peer_map') or {}).values()]
+    statuses = [status for status in statuses if status != 'remote']
+    if any(status in PIN_ERRORS for status in statuses):
+        return 'error'
+    if statuses and all(status == 'pinned' for status in statuses):
+        return 'pinned'
+    return 'pending'
+
+
+class ClusterApi:
+    """
+    Client for the ipfs-cluster REST API, on one keep-alive session.
+    """
+
+    def __init__(self, url=DEFAULT_CLUSTER_API_URL, timeout=DEFAULT_TIMEOUT, pool_size=4):
+        self.url = url.rstrip('/')
+        self.timeout = timeout
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def close(self):
+        self.session.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def request(self, method, path, timeout=None, **kwargs):
+        response = self.session.request(method, f"{self.url}{path}",
+                                        timeout=timeout or self.timeout, **kwargs)
+        response.raise_for_status()
+        return response
+
+    def id(self):
+        return self.request('GET', '/id').json()
+
+    def peers(self):
+        return json_items(self.request('GET', '/peers'))
+
+    def pin(self, cid, replication_min=0, replication_max=0, name=None):
+        params = {'replication-min': replication_min or None,
+                  'replication-max': replication_max or None,
+                  'name': name}
+        return self.request('POST', f"/pins/{cid}",
+                            params={k: v for k, v in params.items() if v is not None}).json()
+
+    def unpin(self, cid):
+        return self.request('DELETE', f"/pins/{cid}").json()
+
+    def status(self, cid):
+        return self.request('GET', f"/pins/{cid}").json()
+
+    def allocations(self):
+        """
+        Every pin in the shared state with its allocations and replication factors.
+
+        Streamed, newer versions send one object per line and those are never
+        all held in memory.
+        """
+        response = self.request('GET', '/allocations', params={'filter': 'pin'}, stream=True)
+        with response:
+            lines = response.iter_lines()
+            for line in lines:
+                if not line.strip():
+                    continue
+                if line.lstrip().startswith(b'['):
+                    # Older versions send a single JSON list.
+                    yield from json.loads(b'\n'.join([line, *lines]))
+                    return
+                yield json.loads(line)
+
+    def pins(self, filter=None, local=False):
+        params = {'filter': filter, 'local': 'true' if local else None}
+        return json_items(self.request('GET', '/pins',
+                                       params={k: v for k, v in params.items() if v}))
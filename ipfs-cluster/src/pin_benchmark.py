@@ -0,0 +1,105 @@
+# Copyright 2021 Erik Lönroth
+# See LICENSE file for licensing details.
+
+"""
+Pin ingest benchmark through the ipfs-cluster REST API.
+"""
+
+import logging
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+from cluster_api import pin_state
+from hookstats import percentile
+
+logger = logging.getLogger(__name__)
+
+
+def _add_block(session, ipfs_url, size, timeout):
+    """
+    Put one random, unpinned block in the local ipfs so the pin has something to find.
+    """
+    response = session.post(f"{ipfs_url}/api/v0/add",
+                            params={'pin': 'false', 'raw-leaves': 'true', 'cid-version': '1',
+                                    'quieter': 'true'},
+                            files={'file': ('pin-benchmark', os.urandom(size))},
+                            timeout=timeout)
+    response.raise_for_status()
+    return response.json()['Hash']
+
+
+def run(cluster, ipfs_url, count, concurrency, replication_min=0, replication_max=0,
+        block_size=1024, timeout=300, poll_interval=0.5):
+    """
+    Pin count fresh blocks with concurrency parallel requests, then poll until every
+    pin is pinned on all its allocated peers (or timeout seconds passed). Queue
+    build-up is sampled from the cluster-wide queued/pinning pins on each round.
+    Everything pinned is unpinned again at the end.
+    """
+    if count <= 0 or concurrency <= 0:
+        raise ValueError("count and concurrency must be positive")
+
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        cids = list(pool.map(lambda _: _add_block(cluster.session, ipfs_url, block_size, 30),
+                             range(count)))
+
+        submitted = {}
+
+        def pin(cid):
+            cluster.pin(cid, replication_min, replication_max, name='pin-benchmark')
+            submitted[cid] = time.monotonic()
+
+        started = time.monotonic()
+        try:
+            list(pool.map(pin, cids))
+            submit_seconds = time.monotonic() - started
+
+            latencies, failed, queue = {}, set(), []
+            pending = set(cids)
+            deadline = started + timeout
+            while pending and time.monotonic() < deadline:
+                for cid, state in zip(list(pending),
+                                      pool.map(lambda c: pin_state(cluster.status(c)),
+                                               list(pending))):
+                    if state == 'pinned':
+                        latencies[cid] = time.monotonic() - submitted[cid]
+                    elif state == 'error':
+                        failed.add(cid)
+                pending -= set(latencies) | failed
+                queue.append(len(cluster.pins(filter='queued,pinning')))
+                if pending:
+                    time.sleep(poll_interval)
+            total_seconds = time.monotonic() - started
+        finally:
+            cleanup = [cid for cid in cids if cid in submitted]
+            for cid, ok in zip(cleanup, pool.map(_unpin_quietly(cluster), cleanup)):
+                if not ok:
+                    logger.warning(f"Could not unpin {cid} after the benchmark")
+
+    times = [latency * 1000 for latency in latencies.values()]
+    return {
+        'pins': count,
+        'pinned': len(latencies),
+        'failed': len(failed),
+        'timed-out': len(pending),
+        'submit-pins-per-s': round(count / submit_seconds, 2) if submit_seconds else 0,
+        'pinned-per-s': round(len(latencies) / total_seconds, 2) if total_seconds else 0,
+        'latency-p50-ms': round(percentile(times, 50) or 0, 1),
+        'latency-p95-ms': round(percentile(times, 95) or 0, 1),
+        'latency-p99-ms': round(percentile(times, 99) or 0, 1),
+        'queue-max': max(queue or [0]),
+        'queue-mean': round(sum(queue) / len(queue), 1) if queue else 0,
+    }
+
+
+def _unpin_quietly(cluster):
+    def unpin(cid):
+        try:
+            cluster.unpin(cid)
+            return True
+        except requests.RequestException:
+            return False
+    return unpin
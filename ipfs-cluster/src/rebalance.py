@@ -0,0 +1,42 @@
+# Copyright 2021 Erik Lönroth
+# See LICENSE file for licensing details.
+
+"""
+Move pins that follow the replication defaults onto new defaults, a batch at a time.
+
+ipfs-cluster stores the replication factors in every pin and never revisits
+existing allocations when peers join. Pins made with the old defaults are
+re-pinned with the new factors, which allocates the extra copies to the peers
+with the most room. Pins with factors of their own are left alone.
+"""
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+def pin_cid(pin):
+    cid = pin.get('cid')
+    return cid.get('/') if isinstance(cid, dict) else cid
+
+
+def run(cluster, old_factors, new_factors, batch_size):
+    """
+    Re-pin up to batch_size pins whose (min, max) factors are in old_factors.
+
+    Returns how many were re-pinned, 0 means nothing is left to move.
+    """
+    old_factors = {tuple(factors) for factors in old_factors}
+    rmin, rmax = new_factors
+    moved = 0
+    for pin in cluster.allocations():
+        factors = (pin.get('replication_factor_min'), pin.get('replication_factor_max'))
+        if factors not in old_factors:
+            continue
+        cluster.pin(pin_cid(pin), rmin, rmax, name=pin.get('name') or None)
+        moved += 1
+        if moved >= batch_size:
+            break
+    if moved:
+        logger.info(f"Re-pinned {moved} pins from {sorted(old_factors)} to {new_factors}")
+    return moved
@@ -0,0 +1,123 @@
+# Copyright 2021 Erik Lönroth
+# See LICENSE file for licensing details.
+
+"""
+Side by side ipfs-cluster releases with an atomic switch.
+
+Every pair of service and ctl archives is unpacked into its own directory under
+/opt/ipfs/releases. /opt/ipfs/current points at the active one, and the paths the
+systemd unit and the charm use (/opt/ipfs/ipfs-cluster-service, ...) point into
+current. Staging a new release never touches the running binaries, and switching
+is a single rename of the current symlink.
+"""
+
+import hashlib
+import logging
+import os
+import re
+import shutil
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import utils
+
+logger = logging.getLogger(__name__)
+
+IPFS_HOME = Path('/opt/ipfs')
+RELEASES = IPFS_HOME / 'releases'
+CURRENT = IPFS_HOME / 'current'
+BINARIES = ('ipfs-cluster-service', 'ipfs-cluster-ctl')
+# Written last, a release without it was interrupted while staging.
+COMPLETE = '.complete'
+VERSION = re.compile(r'_(v[0-9][^_/]*)_')
+
+
+def release_name(service_uri, ctl_uri):
+    """
+    Version from the service archive name plus a digest of both uris,
+    e.g. v0.14.1-3f9a2c1b.
+    """
+    match = VERSION.search(os.path.basename(service_uri))
+    digest = hashlib.sha1(f"{service_uri}\n{ctl_uri}".encode()).hexdigest()[:8]
+    return f"{match.group(1) if match else 'release'}-{digest}"
+
+
+def staged(name):
+    return (RELEASES / name / COMPLETE).exists()
+
+
+def stage(name, sources, cache_max_bytes):
+    """
+    Fetch and unpack (uri, sha256) sources side by side into RELEASES/name.
+
+    Raises what utils.fetch_and_extract_sources raises.
+    """
+    path = RELEASES / name
+    if staged(name):
+        return path
+    path.mkdir(parents=True, exist_ok=True)
+    # The archives are independent, fetch them side by side.
+    with ThreadPoolExecutor(max_workers=len(sources)) as pool:
+        futures = [pool.submit(utils.fetch_and_extract_sources, uri, path, sha256,
+                               cache_max_bytes=cache_max_bytes)
+                   for uri, sha256 in sources]
+        for future in futures:
+            future.result()
+    (path / COMPLETE).touch()
+    logger.info(f"Staged release {name} in {path}")
+    return path
+
+
+def current():
+    """
+    Name of the active release, None on an install from before releases.
+    """
+    if not CURRENT.is_symlink():
+        return None
+    return os.path.basename(os.readlink(CURRENT))
+
+
+def activate(name):
+    """
+    Point current at the staged release name, in one atomic rename.
+
+    Binaries unpacked straight into IPFS_HOME by older charms are moved into a
+    'legacy' release first, so rolling back to them stays possible.
+    """
+    if not staged(name):
+        raise FileNotFoundError(f"Release {name} is not staged")
+
+    tmp = IPFS_HOME / '.current.tmp'
+    if tmp.is_symlink():
+        tmp.unlink()
+    os.symlink(RELEASES / name, tmp)
+    os.replace(tmp, CURRENT)
+
+    for binary in BINARIES:
+        link = IPFS_HOME / binary
+        if link.is_symlink():
+            continue
+        if link.is_dir():
+            legacy = RELEASES / 'legacy'
+            legacy.mkdir(parents=True, exist_ok=True)
+            shutil.rmtree(legacy / binary, ignore_errors=True)
+            os.replace(link, legacy / binary)
+            (legacy / COMPLETE).touch()
+        os.symlink(Path(CURRENT.name) / binary, link)
+    logger.info(f"Activated release {name}")
+
+
+def prune(keep):
+    """
+    Remove every release not named in keep.
+    """
+    if not RELEASES.is_dir():
+        return []
+    removed = []
+    for path in RELEASES.iterdir():
+        if path.name not in keep:
+            shutil.rmtree(path, ignore_errors=True)
+            removed.append(path.name)
+    if removed:
+        logger.info(f"Pruned releases {removed}")
+    return removed
@@ -0,0 +1,202 @@
+# Copyright 2021 Erik Lönroth
+# See LICENSE file for licensing details.
+
+"""
+Charm config driven management of the ipfs-cluster service.json.
+
+Every managed key is listed in SCHEMA with the charm option that sets it and a
+validator. Options left at their empty default fall back to the selected preset
+and, failing that, to whatever `ipfs-cluster-service init` wrote.
+"""
+
+import copy
+import re
+
+import upstreams
+
+GO_DURATION = re.compile(r'^([0-9]+(\.[0-9]+)?(ns|us|µs|ms|s|m|h))+$')
+
+
+def positive_int(value):
+    return isinstance(value, int) and not isinstance(value, bool) and value > 0
+
+
+def go_duration(value):
+    return isinstance(value, str) and bool(GO_DURATION.match(value))
+
+
+def replication_factor(value):
+    # -1 pins everywhere.
+    return positive_int(value) or value == -1
+
+
+def boolean(value):
+    return isinstance(value, bool)
+
+
+def allocate_by(value):
+    return isinstance(value, list) and bool(value) and all(
+        isinstance(item, str) and item for item in value)
+
+
+def comma_list(value):
+    return [item.strip() for item in value.split(',') if item.strip()] or None
+
+
+def tri_state(value):
+    """
+    'true' or 'false' -> bool, empty -> None (keep what init wrote), anything else as is.
+    """
+    value = value.strip()
+    return {'true': True, 'false': False}.get(value.lower(), value or None)
+
+
+# service.json key -> (charm option, validator)
+SCHEMA = {
+    'pin_tracker.stateless.concurrent_pins': ('pintracker-concurrent-pins', positive_int),
+    'pin_tracker.stateless.max_pin_queue_size': ('pintracker-max-pin-queue-size', positive_int),
+    'consensus.crdt.batching.max_batch_size': ('crdt-max-batch-size', positive_int),
+    'consensus.crdt.batching.max_batch_age': ('crdt-max-batch-age', go_duration),
+    'consensus.crdt.rebroadcast_interval': ('crdt-rebroadcast-interval', go_duration),
+    'monitor.pubsubmon.check_interval': ('monitor-check-interval', go_duration),
+    'ipfs_connector.ipfshttp.pin_timeout': ('ipfs-pin-timeout', go_duration),
+    'cluster.replication_factor_min': ('replication-factor-min', replication_factor),
+    'cluster.replication_factor_max': ('replication-factor-max', replication_factor),
+    'cluster.disable_repinning': ('disable-repinning', boolean),
+    'allocator.balanced.allocate_by': ('allocate-by', allocate_by),
+}
+
+# Charm options given as text that service.json wants in another shape.
+PARSERS = {
+    'allocate-by': comma_list,
+    'disable-repinning': tri_state,
+}
+
+PRESETS = {
+    # Bulk pinning: more pins in flight, a deeper queue and batched CRDT commits
+    # instead of one delta broadcast per pin.
+    'high-ingest': {
+        'pin_tracker.stateless.concurrent_pins': 50,
+        'pin_tracker.stateless.max_pin_queue_size': 5000000,
+        'consensus.crdt.batching.max_batch_size': 500,
+        'consensus.crdt.batching.max_batch_age': '1s',
+        'consensus.crdt.rebroadcast_interval': '1m',
+        'monitor.pubsubmon.check_interval': '30s',
+        'ipfs_connector.ipfshttp.pin_timeout': '5m',
+    },
+}
+
+
+# Where the cluster reaches its ipfs daemon, for the connector and the proxy.
+IPFS_NODE_KEYS = ('ipfs_connector.ipfshttp.node_multiaddress',
+                  'api.ipfsproxy.node_multiaddress')
+
+
+def ipfs_node_settings(multiaddr):
+    """
+    Point the connector and the proxy at the daemon's API multiaddr,
+    a /unix/... socket or a TCP address. Nothing if there is none yet.
+    """
+    if not multiaddr or not multiaddr.startswith('/'):
+        return {}
+    return {key: multiaddr for key in IPFS_NODE_KEYS}
+
+
+# Published role -> service.json key of its listeners, and what init writes there.
+LISTENERS = {
+    'api': ('api.restapi.http_listen_multiaddress', '/ip4/127.0.0.1/tcp/9094'),
+    'proxy': ('api.ipfsproxy.listen_multiaddress', '/ip4/127.0.0.1/tcp/9095'),
+}
+
+
+def listen_settings(current, public):
+    """
+    The REST API and proxy listeners, on all interfaces for the roles in public and
+    on loopback for the others. current is {key: value} as service.json has it now.
+    """
+    return {key: upstreams.bind_addresses(current.get(key) or default, role in public)
+            for role, (key, default) in LISTENERS.items()}
+
+
+def default_replication(units):
+    """
+    Replication defaults for a deployment of units peers: up to three copies,
+    and one peer may be down without pins failing for lack of peers.
+    """
+    return {'cluster.replication_factor_min': 2 if units >= 3 else 1,
+            'cluster.replication_factor_max': min(units, 3)}
+
+
+def default_allocation(tags):
+    """
+    Spread pins over zones, then by free space, once units sit in more than one zone.
+
+    tags is a list of every unit's tags.
+    """
+    zones = {unit_tags.get('zone') for unit_tags in tags} - {None}
+    if len(zones) < 2:
+        return {}
+    return {'allocator.balanced.allocate_by': ['tag:zone', 'freespace']}
+
+
+def tag_settings(tags):
+    """
+    Our tags for the tags informer, the allocator can only balance on tags it reports.
+    """
+    return {f"informer.tags.tags.{key}": value for key, value in tags.items() if value}
+
+
+def settings_from_config(config, defaults=None):
+    """
+    Resolve charm config into {dotted service.json key: value}.
+
+    defaults (derived from the deployment, like default_replication) go over the
+    preset and under the charm options. Raises ValueError naming the offending
+    option if anything does not validate.
+    """
+    preset = config.get('cluster-profile') or ''
+    if preset and preset not in PRESETS:
+        raise ValueError(f"Unknown cluster-profile '{preset}'")
+
+    settings = dict(PRESETS.get(preset, {}))
+    settings.update(defaults or {})
+    for key, (option, _) in SCHEMA.items():
+        value = config.get(option)
+        if option in PARSERS and isinstance(value, str):
+            value = PARSERS[option](value)
+        # False is a setting, unlike a 0 or empty option.
+        if value is False or value not in (None, '', 0):
+            settings[key] = value
+
+    for key, value in settings.items():
+        option, valid = SCHEMA[key]
+        if not valid(value):
+            raise ValueError(f"Invalid {option} '{value}'")
+    return settings
+
+
+def nest(settings):
+    """
+    {'a.b': 1} -> {'a': {'b': 1}}
+    """
+    nested = {}
+    for dotted, value in settings.items():
+        node = nested
+        parts = dotted.split('.')
+        for part in parts[:-1]:
+            node = node.setdefault(part, {})
+        node[parts[-1]] = value
+    return nested
+
+
+def deep_merge(base, overrides):
+    """
+    Return a copy of base with overrides merged in, recursing into dicts.
+    """
+    merged = copy.deepcopy(base)
+    for key, value in overrides.items():
+        if isinstance(value, dict) and isinstance(merged.get(key), dict):
+            merged[key] = deep_merge(merged[key], value)
+        else:
+            merged[key] = copy.deepcopy(value)
+    return merged
@@ -1,57 +1,381 @@
-import subprocess
+import files
+import hookstats
 import requests
 import tarfile
 from pathlib import Path
-import io
+import hashlib
 import json
 import logging
+import os
+import shutil
+import tempfile
+import threading
+
+import service_config
 
 logger = logging.getLogger(__name__)
 
-def fetch_and_extract_sources(tarfile_url, dstpath):
+CLUSTER_HOME = Path('/home/ubuntu/.ipfs-cluster')
+SERVICE_JSON = CLUSTER_HOME / 'service.json'
+IDENTITY_JSON = CLUSTER_HOME / 'identity.json'
+PEERSTORE = CLUSTER_HOME / 'peerstore'
+CLUSTER_PORT = 9096
+DEFAULT_CONNECTION_HIGH_WATER = 400
+ARTIFACT_CACHE = Path('/var/cache/ipfs-charms/artifacts')
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+DOWNLOAD_TIMEOUT = (10, 60)
+# uri -> sha256 of the archive last installed from it, finds cached archives without
+# a configured digest. Releases are fetched concurrently, one writer at a time.
+ARTIFACT_INDEX = 'index.json'
+_index_lock = threading.Lock()
+
+
+class ArtifactVerificationError(Exception):
+    """
+    Raised when a downloaded archive does not match its expected sha256.
+    """
+
+
+class _HashingReader:
+    """
+    File-like wrapper which hashes, and optionally tees to disk, everything read through it.
+
+    Lets tarfile consume a download as a stream while the digest is computed on the way.
+    """
+
+    def __init__(self, chunks, sink=None):
+        self._chunks = chunks
+        self._sink = sink
+        self._buffer = b''
+        self._offset = 0
+        self.digest = hashlib.sha256()
+        self.size = 0
+
+    def read(self, size=-1):
+        # Keep one chunk around and hand out slices of it, tarfile reads in small blocks.
+        parts = []
+        wanted = size
+        while wanted:
+            if self._offset >= len(self._buffer):
+                self._buffer, self._offset = next(self._chunks, b''), 0
+                if not self._buffer:
+                    break
+            end = len(self._buffer) if wanted < 0 else self._offset + wanted
+            part = self._buffer[self._offset:end]
+            self._offset += len(part)
+            if wanted > 0:
+                wanted -= len(part)
+            parts.append(part)
+        data = b''.join(parts)
+        self.digest.update(data)
+        self.size += len(data)
+        if self._sink:
+            self._sink.write(data)
+        return data
+
+    def drain(self):
+        """
+        Read whatever tarfile left behind (end-of-archive padding) so the digest covers it all.
+        """
+        while self.read(DOWNLOAD_CHUNK_SIZE):
+            pass
+
+
+def _cached_archive(sha256, cache_dir):
+    if not sha256:
+        return None
+    path = Path(cache_dir) / f"{sha256}.tar.gz"
+    return path if path.is_file() else None
+
+
+def _read_index(cache_dir):
+    try:
+        with open(Path(cache_dir) / ARTIFACT_INDEX) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def _remember_archive(cache_dir, uri, sha256):
+    """
+    Record sha256 as what uri serves, dropping entries whose archive was evicted.
+    """
+    with _index_lock:
+        index = _read_index(cache_dir)
+        known = {key: value for key, value in index.items()
+                 if _cached_archive(value, cache_dir)}
+        known[uri] = sha256
+        if known != index:
+            files.write_atomic(Path(cache_dir) / ARTIFACT_INDEX, json.dumps(known, indent=4))
+
+
+def _within(root, path):
+    return os.path.realpath(path).startswith(root + os.sep)
+
+
+def _safe_members(tfile, dst):
+    """
+    Extract archive members one by one, refusing anything that would land outside dst.
+    """
+    root = os.path.realpath(dst)
+    for member in tfile:
+        target = os.path.join(root, member.name)
+        # Hardlink names are relative to the archive root, symlinks to their own dir.
+        link_base = root if member.islnk() else os.path.dirname(target)
+        is_link = member.issym() or member.islnk()
+        if not _within(root, target) or (
+                is_link and not _within(root, os.path.join(link_base, member.linkname))):
+            raise ArtifactVerificationError(f"Refusing unsafe archive member {member.name}")
+        tfile.extract(member, path=dst)
+        yield member
+
+
+def _move_into_place(staging, dst):
+    """
+    Move the top level entries of a staging dir into dst, replacing older copies.
+    """
+    for entry in os.listdir(staging):
+        target = dst / entry
+        if target.is_dir() and not target.is_symlink():
+            shutil.rmtree(target)
+        elif target.exists() or target.is_symlink():
+            target.unlink()
+        os.replace(staging / entry, target)
+
+
+def evict_artifact_cache(cache_dir=ARTIFACT_CACHE, max_bytes=0, keep=None):
+    """
+    Drop least recently used archives until the cache fits in max_bytes.
+
+    The archive named by keep is never evicted, even if it alone is larger than max_bytes.
+    """
+    cache = Path(cache_dir)
+    if not cache.is_dir():
+        return []
+    archives = sorted(cache.glob('*.tar.gz'), key=lambda p: p.stat().st_mtime)
+    total = sum(p.stat().st_size for p in archives)
+    evicted = []
+    for archive in archives:
+        if total <= max_bytes:
+            break
+        if keep and archive.name == f"{keep}.tar.gz":
+            continue
+        total -= archive.stat().st_size
+        archive.unlink()
+        evicted.append(archive.name)
+    if evicted:
+        logger.info(f"Evicted {len(evicted)} archive(s) from {cache}: {evicted}")
+    return evicted
+
+
+def fetch_and_extract_sources(tarfile_url, dstpath, sha256=None,
+                              cache_dir=ARTIFACT_CACHE, cache_max_bytes=512 * 1024 * 1024):
     """
     Fetch and Install sources from internet
+
+    The archive is streamed straight into tarfile and never held in memory as a whole.
+    Members are extracted into a staging dir next to dstpath and only moved into place
+    once the sha256 of the downloaded bytes matches the expected one, if given.
+
+    Verified archives are kept in a content addressed cache (named by their sha256), so
+    a reinstall with a known digest never touches the network. Without one, the digest
+    the same uri produced before is used to find it in the cache.
+
+    Returns the sha256 of the installed archive.
     """
+    dst = Path(dstpath)
+    dst.mkdir(parents=True, exist_ok=True)
+    cache = Path(cache_dir)
+    cache.mkdir(parents=True, exist_ok=True)
+    expected = sha256.strip().lower() if sha256 else None
+
+    staging = Path(tempfile.mkdtemp(prefix='.staging-', dir=dst))
+    sink = tempfile.NamedTemporaryFile(prefix='.download-', dir=cache, delete=False)
     try:
-        response = requests.get(tarfile_url, allow_redirects=True, stream=True)
-        dst = Path(dstpath)
-        with tarfile.open(fileobj=io.BytesIO(response.content), mode='r:gz') as tfile:
-            tfile.extractall(path=dst)
-    except subprocess.CalledProcessError as e:
-        print(e)
-        sys.exit(-1)
+        cached = _cached_archive(expected or _read_index(cache).get(tarfile_url), cache)
+        if cached:
+            logger.info(f"Using cached archive {cached} for {tarfile_url}")
+            sink.close()
+            os.unlink(sink.name)
+            sink = None
+            source = open(cached, 'rb')
+            reader = _HashingReader(iter(lambda: source.read(DOWNLOAD_CHUNK_SIZE), b''))
+        else:
+            response = requests.get(tarfile_url, allow_redirects=True, stream=True,
+                                    timeout=DOWNLOAD_TIMEOUT)
+            response.raise_for_status()
+            source = response
+            reader = _HashingReader(response.iter_content(DOWNLOAD_CHUNK_SIZE), sink)
+
+        with source:
+            with tarfile.open(fileobj=reader, mode='r|gz') as tfile:
+                for _ in _safe_members(tfile, staging):
+                    pass
+            reader.drain()
+
+        digest = reader.digest.hexdigest()
+        if cached and cached.name != f"{digest}.tar.gz":
+            # Damaged on disk, the next attempt downloads it again.
+            os.unlink(cached)
+            raise ArtifactVerificationError(f"Cached archive {cached} is corrupt, got {digest}")
+        if expected and digest != expected:
+            raise ArtifactVerificationError(
+                f"sha256 mismatch for {tarfile_url}: expected {expected}, got {digest}")
+        if not expected and not cached:
+            logger.warning(f"No sha256 configured for {tarfile_url}, got {digest} unverified.")
+
+        _move_into_place(staging, dst)
+
+        if sink:
+            sink.close()
+            os.replace(sink.name, cache / f"{digest}.tar.gz")
+            sink = None
+        else:
+            os.utime(cached)
+        evict_artifact_cache(cache, cache_max_bytes, keep=digest)
+        _remember_archive(cache, tarfile_url, digest)
+        logger.info(f"Installed {tarfile_url} ({reader.size} bytes, sha256 {digest}) to {dst}")
+        return digest
+    finally:
+        shutil.rmtree(staging, ignore_errors=True)
+        if sink:
+            sink.close()
+            os.unlink(sink.name)
+
+
+def disk_tier(path):
+    """
+    nvme, ssd or hdd for the disk holding path, None if sysfs doesn't say.
+    """
+    dev = os.stat(path).st_dev
+    block = Path(f"/sys/dev/block/{os.major(dev)}:{os.minor(dev)}")
+    if not block.exists():
+        return None
+    block = block.resolve()
+    # A partition keeps its queue settings on the parent disk.
+    for disk in (block, block.parent):
+        rotational = disk / 'queue' / 'rotational'
+        if rotational.exists():
+            if rotational.read_text().strip() == '1':
+                return 'hdd'
+            return 'nvme' if disk.name.startswith('nvme') else 'ssd'
+    return None
+
+
+def host_tags(tier=None):
+    """
+    Allocation tags for this unit: the Juju availability zone and the disk tier
+    of the cluster state, unless tier is given.
+    """
+    home = CLUSTER_HOME if CLUSTER_HOME.exists() else Path('/')
+    return {'zone': os.environ.get('JUJU_AVAILABILITY_ZONE') or None,
+            'tier': tier or disk_tier(home)}
+
 
 def getIpfsClusterVersion():
-    resp = subprocess.check_output(['/opt/ipfs/ipfs-cluster-service/ipfs-cluster-service','--version']).decode()
-    return resp.rstrip().rpartition(' ')[-1] # Get the version
+    resp = hookstats.check_output(
+        ['/opt/ipfs/ipfs-cluster-service/ipfs-cluster-service', '--version']).decode()
+    return resp.rstrip().rpartition(' ')[-1]  # Get the version
 
-def write_service_json(ctx):
+
+def write_service_json(ctx, settings=None):
     """
     Writes the service.json file.
+
+    The cluster secret and the dotted settings (see service_config) are deep merged
+    into what is on disk. Nothing is written unless the result differs.
+    Returns True if the file changed.
     """
-    with open("/home/ubuntu/.ipfs-cluster/service.json", "r") as jsonFile:
+    with open(SERVICE_JSON, "r") as jsonFile:
         data = json.load(jsonFile)
 
-    data['cluster']['secret'] = ctx['cluster_secret']
-    
-    with open("/home/ubuntu/.ipfs-cluster/service.json", "w") as jsonFile:
-        json.dump(data, jsonFile, indent=4)
+    overrides = dict(settings or {})
+    overrides['cluster.secret'] = ctx['cluster_secret']
+    merged = service_config.deep_merge(data, service_config.nest(overrides))
+    if merged == data:
+        return False
+
+    files.write_atomic(SERVICE_JSON, json.dumps(merged, indent=4))
+    logger.info(f"Updated {SERVICE_JSON}")
+    return True
 
 
 def get_cluster_secret():
     """
     Get the secret from the service.json file.
     """
-    with open("/home/ubuntu/.ipfs-cluster/service.json", "r") as jsonFile:
+    with open(SERVICE_JSON, "r") as jsonFile:
         data = json.load(jsonFile)
 
     return data['cluster']['secret']
 
+
+def get_connection_high_water():
+    """
+    cluster.connection_manager.high_water from service.json, the init default if unset.
+    """
+    if not SERVICE_JSON.exists():
+        return DEFAULT_CONNECTION_HIGH_WATER
+    with open(SERVICE_JSON, "r") as jsonFile:
+        data = json.load(jsonFile)
+
+    manager = data.get('cluster', {}).get('connection_manager', {})
+    return manager.get('high_water') or DEFAULT_CONNECTION_HIGH_WATER
+
+
+def get_service_settings(keys):
+    """
+    {dotted key: value} from service.json, None for what it does not hold.
+    """
+    if not SERVICE_JSON.exists():
+        return dict.fromkeys(keys)
+    with open(SERVICE_JSON, "r") as jsonFile:
+        data = json.load(jsonFile)
+
+    found = {}
+    for key in keys:
+        node = data
+        for part in key.split('.'):
+            node = node.get(part) if isinstance(node, dict) else None
+        found[key] = node
+    return found
+
+
 def get_identity_id():
     """
     Get the id from the identity.json file.
     """
-    with open("/home/ubuntu/.ipfs-cluster/identity.json", "r") as jsonFile:
+    with open(IDENTITY_JSON, "r") as jsonFile:
         data = json.load(jsonFile)
 
     return data['id']
+
+
+def peer_multiaddr(ip, peer_id):
+    """
+    The cluster swarm multiaddr of a peer, as written to the peerstore.
+    """
+    proto = 'ip6' if ':' in ip else 'ip4'
+    return f"/{proto}/{ip}/tcp/{CLUSTER_PORT}/p2p/{peer_id}"
+
+
+def read_peerstore():
+    if not PEERSTORE.exists():
+        return set()
+    with open(PEERSTORE) as peerstoreFile:
+        return {line.strip() for line in peerstoreFile if line.strip()}
+
+
+def update_peerstore(entries):
+    """
+    Make the peerstore hold exactly entries (a set of multiaddrs).
+
+    The file is only (atomically) rewritten if the set differs from what is on disk.
+    Returns the (added, removed) sets.
+    """
+    current = read_peerstore()
+    added, removed = entries - current, current - entries
+    if added or removed:
+        files.write_atomic(PEERSTORE, ''.join(f"{entry}\n" for entry in sorted(entries)))
+        logger.info(f"Updated {PEERSTORE}: +{sorted(added)} -{sorted(removed)}")
+    return added, removed
@@ -0,0 +1,182 @@
+# Copyright 2021 Erik Lönroth
+# See LICENSE file for licensing details.
+
+"""
+Stand-ins for what the charm reaches outside of Juju on a real unit.
+
+FakeHost puts every path the charm uses (/opt/ipfs, /home/ubuntu/.ipfs-cluster,
+the systemd unit, fstab) under a temporary root, answers the commands run through
+hookstats like systemctl and ipfs-cluster-service would, and serves the cluster
+REST API from FakeApi. Hooks then run unchanged in a Harness.
+"""
+
+import json
+import os
+import shlex
+import subprocess
+import tempfile
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from unittest.mock import Mock, patch
+from urllib.parse import parse_qs, urlparse
+
+import releases
+
+
+def peer_id(n):
+    return f"12D3KooWFakePeer{n:036d}"
+
+
+class _ApiHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # Headers and body go out in separate writes, don't let them wait for an ACK.
+    disable_nagle_algorithm = True
+
+    def _answer(self):
+        url = urlparse(self.path)
+        length = int(self.headers.get('Content-Length') or 0)
+        if length:
+            self.rfile.read(length)
+        with self.server.lock:
+            self.server.requests += 1
+        route = self.server.routes.get(url.path.rstrip('/'), {})
+        body = route(parse_qs(url.query)) if callable(route) else route
+        data = json.dumps(body).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    do_GET = do_POST = do_DELETE = _answer
+
+    def log_message(self, format, *args):
+        pass
+
+
+class FakeApi(ThreadingHTTPServer):
+    """
+    Answers every request with the JSON routes holds for its path, {} for any other
+    path, and counts them. A route can be a function of the query parameters.
+    """
+
+    def __init__(self, routes=None):
+        super().__init__(('127.0.0.1', 0), _ApiHandler)
+        self.routes = routes or {}
+        self.requests = 0
+        self.lock = threading.Lock()
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server_address[1]}"
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+class FakeHost:
+    """
+    A unit's host under a temporary root, for the lifetime of testcase.
+    """
+
+    def __init__(self, testcase, version='1.0.0'):
+        tmp = tempfile.TemporaryDirectory()
+        testcase.addCleanup(tmp.cleanup)
+        self.root = Path(tmp.name)
+        self.version = version
+        self.running = set()
+        # Every command line run through os.system, in order.
+        self.commands = []
+        self.peers = [{'id': peer_id(0)}]
+        self.api = FakeApi({'/id': lambda query: self.peers[0],
+                            '/peers': lambda query: self.peers,
+                            '/pins': [],
+                            '/allocations': []})
+        testcase.addCleanup(self.api.stop)
+
+        self.cluster_home = self.root / 'home/ubuntu/.ipfs-cluster'
+        self.ipfs_home = self.root / 'opt/ipfs'
+        etc = self.root / 'etc'
+        (etc / 'systemd/system').mkdir(parents=True)
+        (etc / 'fstab').touch()
+        (self.root / 'proc').mkdir()
+        (self.root / 'proc/mounts').touch()
+
+        binding = Mock()
+        binding.network.bind_address = '10.0.0.1'
+        binding.network.ingress_address = '10.0.0.1'
+        patches = [
+            patch('os.system', self.system),
+            patch('subprocess.check_output', self.check_output),
+            patch('subprocess.run', self.run),
+            # There is no ubuntu user to hand files to.
+            patch('shutil.chown'),
+            patch('ops.model.Model.get_binding', return_value=binding),
+            patch('utils.CLUSTER_HOME', self.cluster_home),
+            patch('utils.SERVICE_JSON', self.cluster_home / 'service.json'),
+            patch('utils.IDENTITY_JSON', self.cluster_home / 'identity.json'),
+            patch('utils.PEERSTORE', self.cluster_home / 'peerstore'),
+            patch('utils.ARTIFACT_CACHE', self.root / 'var/cache/ipfs-charms/artifacts'),
+            patch('releases.IPFS_HOME', self.ipfs_home),
+            patch('releases.RELEASES', self.ipfs_home / 'releases'),
+            patch('releases.CURRENT', self.ipfs_home / 'current'),
+            patch('storage.FSTAB', str(etc / 'fstab')),
+            patch('storage.PROC_MOUNTS', str(self.root / 'proc/mounts')),
+            patch('charm.IPFS_HOME', self.ipfs_home),
+            patch('charm.IPFS_SERVICE', self.ipfs_home / 'ipfs-cluster-service'),
+            patch('charm.SYSTEMD_UNIT', etc / 'systemd/system/ipfs-cluster.service'),
+            patch('charm.DEFAULT_CLUSTER_API_URL', self.api.url),
+        ]
+        for p in patches:
+            p.start()
+            testcase.addCleanup(p.stop)
+
+    def stage(self, name):
+        """
+        Put release name in place as if fetched, so no hook downloads anything.
+        """
+        path = self.ipfs_home / 'releases' / name
+        for binary in releases.BINARIES:
+            (path / binary).mkdir(parents=True)
+            (path / binary / binary).touch()
+        (path / releases.COMPLETE).touch()
+
+    def _init(self):
+        self.cluster_home.mkdir(parents=True, exist_ok=True)
+        service = {'cluster': {'peername': 'fake',
+                               'secret': '0f' * 32,
+                               'connection_manager': {'high_water': 400, 'low_water': 100}},
+                   'ipfs_connector': {'ipfshttp': {
+                       'node_multiaddress': '/ip4/127.0.0.1/tcp/5001'}}}
+        (self.cluster_home / 'service.json').write_text(json.dumps(service, indent=4))
+        (self.cluster_home / 'identity.json').write_text(json.dumps({'id': peer_id(0)}))
+
+    def system(self, cmd):
+        self.commands.append(cmd)
+        argv = shlex.split(cmd)
+        if argv[:2] == ['sudo', '-u']:
+            argv = argv[3:]
+        program = os.path.basename(argv[0])
+        if program == 'systemctl':
+            verb, unit = argv[1], argv[-1]
+            if verb == 'is-active':
+                # os.system returns the wait status, is-active exits 3 when inactive.
+                return 0 if unit in self.running else 3 << 8
+            if verb in ('start', 'restart'):
+                self.running.add(unit)
+            elif verb == 'stop':
+                self.running.discard(unit)
+        elif program == 'ipfs-cluster-service' and 'init' in argv:
+            self._init()
+        return 0
+
+    def check_output(self, args, **kwargs):
+        if args[-1] == '--version':
+            return f"{os.path.basename(args[0])} version {self.version}\n".encode()
+        return b''
+
+    def run(self, args, **kwargs):
+        return subprocess.CompletedProcess(args, 0, b'', b'')
@@ -0,0 +1,76 @@
+# Copyright 2021 Erik Lönroth
+# See LICENSE file for licensing details.
+
+import os
+import tempfile
+import threading
+import unittest
+
+import requests
+
+import bulk_pin
+
+
+class FakeCluster:
+    def __init__(self, reject=(), down_after=None):
+        self.pinned = []
+        self.reject = set(reject)
+        self.down_after = down_after
+        self.lock = threading.Lock()
+
+    def pin(self, cid, replication_min=0, replication_max=0, name=None):
+        if self.down_after is not None and len(self.pinned) >= self.down_after:
+            raise requests.ConnectionError("Connection refused")
+        if cid in self.reject:
+            response = requests.Response()
+            response.status_code = 400
+            raise requests.HTTPError("400 Bad Request", response=response)
+        with self.lock:
+            self.pinned.append((cid, name))
+
+
+class TestBulkPin(unittest.TestCase):
+    def setUp(self):
+        fd, self.path = tempfile.mkstemp()
+        with os.fdopen(fd, 'w') as f:
+            f.write("# preload\n\n")
+            f.write(''.join(f"bafy{i} pin-{i}\n" for i in range(10)))
+            f.write("bad\n")
+        self.addCleanup(os.unlink, self.path)
+
+    def test_batches_checkpoint_and_failures(self):
+        cluster = FakeCluster(reject={'bad'})
+        checkpoints = []
+        result = bulk_pin.run(cluster, self.path, batch_size=4, concurrency=2,
+                              checkpoint=lambda offset, counts: checkpoints.append(offset))
+        self.assertEqual(result['pinned'], 10)
+        self.assertEqual(result['failed'], 1)
+        self.assertEqual(result['failed-sample'].split(':')[0], 'bad')
+        self.assertEqual(len(checkpoints), 3)
+        self.assertEqual(checkpoints[-1], os.path.getsize(self.path))
+        self.assertIn(('bafy3', 'pin-3'), cluster.pinned)
+
+    def test_resume_from_checkpoint(self):
+        checkpoints = []
+        bulk_pin.run(FakeCluster(), self.path, batch_size=4,
+                     checkpoint=lambda offset, counts: checkpoints.append(offset))
+
+        cluster = FakeCluster()
+        result = bulk_pin.run(cluster, self.path, offset=checkpoints[0], batch_size=4)
+        self.assertEqual(sorted(cid for cid, _ in cluster.pinned),
+                         sorted(['bafy4', 'bafy5', 'bafy6', 'bafy7', 'bafy8', 'bafy9', 'bad']))
+        self.assertEqual(result['offset'], os.path.getsize(self.path))
+
+    def test_outage_stops_before_the_unpinned(self):
+        checkpoints = []
+        with self.assertRaises(requests.ConnectionError):
+            bulk_pin.run(FakeCluster(down_after=6), self.path, batch_size=4, concurrency=1,
+                         retries=0, checkpoint=lambda offset, counts: checkpoints.append(
+                             (offset, dict(counts))))
+        offset, counts = checkpoints[-1]
+        self.assertEqual((counts['pinned'], counts['failed']), (6, 0))
+
+        cluster = FakeCluster()
+        bulk_pin.run(cluster, self.path, offset=offset, batch_size=4)
+        self.assertEqual(sorted(cid for cid, _ in cluster.pinned),
+                         ['bad', 'bafy6', 'bafy7', 'bafy8', 'bafy9'])
@@ -3,16 +3,243 @@
 #
 # Learn more about testing at: https://juju.is/docs/sdk/testing
 
+import json
+import time
 import unittest
-from unittest.mock import Mock
+from unittest.mock import patch
 
-from charm import GitlabRunnerCharm
-from ops.model import ActiveStatus
+import requests
+import charm as charm_module
+from charm import IPFSClusterCharm
+from ops.model import ActiveStatus, BlockedStatus, MaintenanceStatus, WaitingStatus
 from ops.testing import Harness
 
+import utils
+from tests import fakes
+
 
 class TestCharm(unittest.TestCase):
     def setUp(self):
-        self.harness = Harness(GitlabRunnerCharm)
+        self.harness = Harness(IPFSClusterCharm)
+        self.addCleanup(self.harness.cleanup)
+        self.harness.begin()
+        # The steps are called directly, no host to run the hooks on.
+        self.harness.disable_hooks()
+
+    def test_upgrade_turn_moves_on_once_the_peer_rejoined(self):
+        rel = self.harness.add_relation('replicas', 'ipfs-cluster')
+        for unit in ('ipfs-cluster/1', 'ipfs-cluster/2'):
+            self.harness.add_relation_unit(rel, unit)
+        self.harness.set_leader(True)
+        charm = self.harness.charm
+        relation = self.harness.model.get_relation('replicas')
+        desired = charm._desired_release()
+        self.harness.update_relation_data(rel, 'ipfs-cluster/1', {'release': 'old',
+                                                                  'release-staged': desired,
+                                                                  'peer-id': 'peer1'})
+
+        charm._reconcile_upgrade_turn(relation, desired)
+        self.assertEqual(relation.data[charm.app]['upgrade-turn'], 'ipfs-cluster/1')
+
+        self.harness.update_relation_data(rel, 'ipfs-cluster/1', {'release': desired})
+        with patch('charm.ClusterApi') as api:
+            api.return_value.__enter__.return_value.peers.return_value = []
+            charm._reconcile_upgrade_turn(relation, desired)
+            self.assertEqual(relation.data[charm.app]['upgrade-turn'], 'ipfs-cluster/1')
+
+            api.return_value.__enter__.return_value.peers.return_value = [{'id': 'peer1'}]
+            charm._reconcile_upgrade_turn(relation, desired)
+        self.assertNotIn('upgrade-turn', relation.data[charm.app])
+        self.assertIn('ipfs-cluster/2 to stage', charm._upgrade_note)
+
+    def test_caught_up_once_the_queue_stops_growing(self):
+        charm = self.harness.charm
+        self.harness.update_config({'upgrade-max-queued': 100})
+        with patch('charm.ClusterApi') as api:
+            cluster = api.return_value.__enter__.return_value
+            seen = []
+            for queued in (150, 170, 170, 400, 90):
+                cluster.pins.return_value = [{}] * queued
+                seen.append(charm._caught_up())
+            cluster.id.side_effect = requests.ConnectionError("refused")
+            seen.append(charm._caught_up())
+        self.assertEqual(seen, [False, False, True, False, True, False])
+
+    def test_config_restarts_take_turns(self):
+        rel = self.harness.add_relation('replicas', 'ipfs-cluster')
+        for n in (1, 2):
+            self.harness.add_relation_unit(rel, f'ipfs-cluster/{n}')
+            self.harness.update_relation_data(rel, f'ipfs-cluster/{n}',
+                                              {'restart-pending': 'true', 'peer-id': f'peer{n}'})
+        self.harness.set_leader(True)
+        charm = self.harness.charm
+        relation = self.harness.model.get_relation('replicas')
+        app_data = relation.data[charm.app]
+
+        with patch('charm.ClusterApi') as api:
+            api.return_value.__enter__.return_value.peers.return_value = [{'id': 'peer1'}]
+            charm._reconcile_restart_turn(relation)
+            self.assertEqual(app_data['restart-turn'], 'ipfs-cluster/1')
+            self.harness.update_relation_data(rel, 'ipfs-cluster/2', {'restart-pending': ''})
+            charm._reconcile_restart_turn(relation)
+            self.assertEqual(app_data['restart-turn'], 'ipfs-cluster/1')
+
+            # Restarted, but not back in the cluster yet.
+            self.harness.update_relation_data(rel, 'ipfs-cluster/2', {'restart-pending': 'true'})
+            self.harness.update_relation_data(rel, 'ipfs-cluster/1', {'restart-pending': ''})
+            api.return_value.__enter__.return_value.peers.return_value = []
+            charm._reconcile_restart_turn(relation)
+            self.assertEqual(app_data['restart-turn'], 'ipfs-cluster/1')
+
+            api.return_value.__enter__.return_value.peers.return_value = [{'id': 'peer1'}]
+            charm._reconcile_restart_turn(relation)
+            self.assertEqual(app_data['restart-turn'], 'ipfs-cluster/2')
+
+    @patch('hookstats.system')
+    def test_follower_restarts_on_its_turn_only(self, system):
+        rel = self.harness.add_relation('replicas', 'ipfs-cluster')
+        self.harness.add_relation_unit(rel, 'ipfs-cluster/1')
+        charm = self.harness.charm
+        relation = self.harness.model.get_relation('replicas')
+        self.harness.update_config({'restart-on-reconfig': True})
+        system.return_value = 0
+
+        charm._reconcile_service(relation, True)
+        self.assertNotIn('systemctl restart ipfs-cluster.service',
+                         [c.args[0] for c in system.call_args_list])
+        self.assertEqual(relation.data[charm.unit]['restart-pending'], 'true')
+
+        self.harness.update_relation_data(rel, 'ipfs-cluster', {'restart-turn': 'ipfs-cluster/0'})
+        charm._reconcile_service(relation, False)
+        self.assertIn('systemctl restart ipfs-cluster.service',
+                      [c.args[0] for c in system.call_args_list])
+        self.assertEqual(relation.data[charm.unit].get('restart-pending', ''), '')
+
+
+class TestInstall(unittest.TestCase):
+    def setUp(self):
+        self.host = fakes.FakeHost(self)
+        self.harness = Harness(IPFSClusterCharm)
+        self.addCleanup(self.harness.cleanup)
+        self.harness.set_leader(True)
+        self.harness.begin()
+
+    def test_failed_fetch_is_retried_by_later_hooks(self):
+        charm = self.harness.charm
+        with patch('utils.fetch_and_extract_sources',
+                   side_effect=requests.ConnectionError("unreachable")):
+            charm.on.install.emit()
+            self.assertIsInstance(charm.unit.status, BlockedStatus)
+            charm.on.update_status.emit()
+        self.assertFalse(utils.SERVICE_JSON.exists())
+
+        self.host.stage(charm._desired_release())
+        charm.on.update_status.emit()
+        self.assertTrue((charm_module.IPFS_SERVICE / 'ipfs-cluster-service').exists())
+        self.assertTrue(utils.SERVICE_JSON.exists())
+        self.assertEqual(charm_module.SYSTEMD_UNIT.stat().st_mode & 0o777, 0o644)
+        self.assertIn('ipfs-cluster.service', self.host.running)
+
+
+class TestReconcile(unittest.TestCase):
+    def setUp(self):
+        self.host = fakes.FakeHost(self)
+        self.harness = Harness(IPFSClusterCharm)
+        self.addCleanup(self.harness.cleanup)
+        self.rel = self.harness.add_relation('replicas', 'ipfs-cluster')
+        self.harness.add_relation_unit(self.rel, 'ipfs-cluster/1')
+        self.harness.set_leader(False)
+        self.harness.begin()
+        self.charm = self.harness.charm
+        self.host.stage(self.charm._desired_release())
+        self.charm.on.install.emit()
+
+    def _leader_publishes(self):
+        self.harness.update_relation_data(self.rel, 'ipfs-cluster', {
+            'leader-ip': '10.0.0.2', 'secret': 'ab' * 32, 'id': fakes.peer_id(1)})
+
+    def _peer_joins(self):
+        self.harness.update_relation_data(self.rel, 'ipfs-cluster/1', {
+            'ingress-address': '10.0.0.2', 'peer-id': fakes.peer_id(1)})
+
+    def _unit_data(self):
+        return self.harness.get_relation_data(self.rel, self.charm.unit.name)
+
+    def test_follower_waits_for_the_secret_without_deferring(self):
+        with patch('ops.framework.EventBase.defer') as defer:
+            self._peer_joins()
+            self.charm.on.update_status.emit()
+        defer.assert_not_called()
+        self.assertIsInstance(self.charm.unit.status, WaitingStatus)
+        self.assertIn("cluster secret", self.charm.unit.status.message)
+        self.assertNotIn('ipfs-cluster.service', self.host.running)
+
+    def test_follower_starts_once_it_has_the_secret_and_a_peer(self):
+        self._leader_publishes()
+        self.assertEqual(self.charm._stored.cluster_secret, 'ab' * 32)
+        self.assertNotIn('ipfs-cluster.service', self.host.running)
+
+        self._peer_joins()
+        self.assertIn('ipfs-cluster.service', self.host.running)
+        self.assertIn(fakes.peer_id(1), utils.PEERSTORE.read_text())
+        service = json.loads(utils.SERVICE_JSON.read_text())
+        self.assertEqual(service['cluster']['secret'], 'ab' * 32)
+        self.assertEqual(self.host.commands.count('systemctl start ipfs-cluster.service'), 1)
+
+    def test_a_second_pass_is_a_no_op(self):
+        self._leader_publishes()
+        self._peer_joins()
+        files = [utils.SERVICE_JSON, utils.PEERSTORE, charm_module.SYSTEMD_UNIT]
+        before = [path.stat().st_mtime_ns for path in files]
+        data = dict(self._unit_data())
+        del self.host.commands[:]
+
+        self.charm.on.config_changed.emit()
+        self.assertEqual([path.stat().st_mtime_ns for path in files], before)
+        self.assertEqual(self._unit_data(), data)
+        self.assertEqual([cmd for cmd in self.host.commands if 'is-active' not in cmd], [])
+
+
+class TestHealth(unittest.TestCase):
+    def setUp(self):
+        self.host = fakes.FakeHost(self)
+        self.harness = Harness(IPFSClusterCharm)
         self.addCleanup(self.harness.cleanup)
-        self.harness.begin()
\ No newline at end of file
+        self.harness.update_config({'health-blocked-ms': 200, 'health-degraded-ms': 100})
+        self.harness.set_leader(True)
+        self.harness.begin()
+        self.charm = self.harness.charm
+        self.host.stage(self.charm._desired_release())
+        self.charm.on.install.emit()
+        self.charm.on.start.emit()
+
+    def test_status_follows_the_api(self):
+        self.charm.on.update_status.emit()
+        self.assertIsInstance(self.charm.unit.status, ActiveStatus)
+
+        def slow(query):
+            time.sleep(0.15)
+            return self.host.peers
+        self.host.api.routes['/peers'] = slow
+        for _ in range(3):
+            self.charm.on.update_status.emit()
+        self.assertIsInstance(self.charm.unit.status, MaintenanceStatus)
+        self.assertIn("Degraded", self.charm.unit.status.message)
+
+    def test_a_stalled_api_blocks(self):
+        self.charm.on.update_status.emit()
+
+        def stalled(query):
+            time.sleep(0.5)
+            return self.host.peers[0]
+        self.host.api.routes['/id'] = stalled
+        self.charm.on.update_status.emit()
+        self.assertIsInstance(self.charm.unit.status, BlockedStatus)
+
+    def test_a_silent_api_blocks_on_the_tick(self):
+        with patch('charm.DEFAULT_CLUSTER_API_URL', 'http://127.0.0.1:1'):
+            self.charm.on.config_changed.emit()
+            self.assertIsInstance(self.charm.unit.status, MaintenanceStatus)
+            self.charm.on.update_status.emit()
+        self.assertIsInstance(self.charm.unit.status, BlockedStatus)
+        self.assertIn("not answering", self.charm.unit.status.message)
@@ -0,0 +1,129 @@
+# Copyright 2021 Erik Lönroth
+# See LICENSE file for licensing details.
+
+"""
+Hook wall time and external calls against the size of the replicas relation.
+
+Every hook runs in a Harness on the fakes from tests/fakes.py, with 1, 10 and 100
+peers. With more peers a hook must not run more commands or API requests, and
+must not take more than HOOK_SLOWDOWN times its wall time with one peer (plus
+HOOK_SLACK_MS for the noise on hooks that take next to nothing). No hook may take
+longer than HOOK_BUDGET_MS. The limits are relative so a slow CI machine does not
+trip them, and all of them can be raised from the environment. HOOK_BENCH_REPORT=<file>
+writes what was measured, and the limits, as JSON.
+"""
+
+import json
+import os
+import unittest
+
+from ops.testing import Harness
+
+from charm import IPFSClusterCharm
+from tests import fakes
+
+PEERS = (1, 10, 100)
+# Steady state hooks run this often, the fastest run counts.
+ROUNDS = 3
+HOOK_SLOWDOWN = float(os.environ.get('HOOK_SLOWDOWN', 3))
+HOOK_SLACK_MS = float(os.environ.get('HOOK_SLACK_MS', 10))
+HOOK_BUDGET_MS = float(os.environ.get('HOOK_BUDGET_MS', 1000))
+
+
+class TestHookLatency(unittest.TestCase):
+    def _deploy(self, peers):
+        """
+        Take a leader through its hooks while peers other units join, {hook: measurements}.
+
+        Hooks repeated in steady state, after everything converged, are reported
+        as "<hook> (steady)".
+        """
+        host = fakes.FakeHost(self)
+        harness = Harness(IPFSClusterCharm)
+        self.addCleanup(harness.cleanup)
+        harness.update_config({'hook-stats-size': 10000})
+        # Both exist from deployment on, as the peer and the subordinate relation.
+        replicas = harness.add_relation('replicas', 'ipfs-cluster')
+        ipfs = harness.add_relation('ipfs', 'ipfs-daemon')
+        harness.set_leader(True)
+        harness.begin()
+        charm = harness.charm
+        host.stage(charm._desired_release())
+        results = {}
+
+        def hook(name, fire, rounds=1):
+            key = f"{name} (steady)" if rounds > 1 else name
+            for _ in range(rounds):
+                requests = host.api.requests
+                fire()
+                record = charm._stored.hook_stats[-1]
+                self.assertEqual(record['hook'], name)
+                stats = results.setdefault(key, {'wall-ms': float('inf'), 'commands': 0,
+                                                 'requests': 0})
+                stats['wall-ms'] = min(stats['wall-ms'], record['wall'] * 1000)
+                stats['commands'] = max(stats['commands'], len(record['commands']))
+                stats['requests'] = max(stats['requests'], host.api.requests - requests)
+
+        storage_id = harness.add_storage('ipfs-cluster-state')[0]
+        hook('ipfs-cluster-state-storage-attached', lambda: harness.attach_storage(storage_id))
+        hook('install', charm.on.install.emit)
+        hook('leader-elected', charm.on.leader_elected.emit)
+        hook('config-changed', charm.on.config_changed.emit)
+        hook('start', charm.on.start.emit)
+
+        hook('ipfs-relation-joined', lambda: harness.add_relation_unit(ipfs, 'ipfs-daemon/0'))
+        hook('ipfs-relation-changed', lambda: harness.update_relation_data(
+            ipfs, 'ipfs-daemon/0', {'api-multiaddr': '/ip4/127.0.0.1/tcp/5001'}))
+
+        desired = charm._desired_release()
+
+        def data(n):
+            return {'ingress-address': f"10.0.{n // 250}.{n % 250 + 1}",
+                    'peer-id': fakes.peer_id(n), 'release': desired,
+                    'release-staged': desired, 'tags': json.dumps({'tier': 'ssd'})}
+
+        # The others join one by one as in a real model, the last one is measured.
+        for n in range(1, peers):
+            harness.add_relation_unit(replicas, f"ipfs-cluster/{n}")
+            harness.update_relation_data(replicas, f"ipfs-cluster/{n}", data(n))
+            host.peers.append({'id': fakes.peer_id(n)})
+        last = f"ipfs-cluster/{peers}"
+        hook('replicas-relation-joined', lambda: harness.add_relation_unit(replicas, last))
+        hook('replicas-relation-changed',
+             lambda: harness.update_relation_data(replicas, last, data(peers)))
+        host.peers.append({'id': fakes.peer_id(peers)})
+
+        relation = harness.model.get_relation('replicas')
+        hook('replicas-relation-changed', lambda: charm.on.replicas_relation_changed.emit(
+            relation, relation.app, harness.model.get_unit(last)), ROUNDS)
+        hook('update-status', charm.on.update_status.emit, ROUNDS)
+        hook('config-changed', charm.on.config_changed.emit, ROUNDS)
+        hook('upgrade-charm', charm.on.upgrade_charm.emit)
+        hook('replicas-relation-departed', lambda: harness.remove_relation_unit(replicas, last))
+        hook('ipfs-cluster-state-storage-detaching',
+             lambda: harness.detach_storage(storage_id))
+        hook('stop', charm.on.stop.emit)
+
+        self.assertEqual(len(host.peers), peers + 1)
+        self.assertEqual(len((host.cluster_home / 'peerstore').read_text().splitlines()),
+                         peers - 1)
+        return results
+
+    def test_hooks_scale_with_peers(self):
+        results = {peers: self._deploy(peers) for peers in PEERS}
+        small, large = results[PEERS[0]], results[PEERS[-1]]
+        for hook, stats in large.items():
+            stats['limit-ms'] = min(HOOK_SLOWDOWN * small[hook]['wall-ms'] + HOOK_SLACK_MS,
+                                    HOOK_BUDGET_MS)
+        report = os.environ.get('HOOK_BENCH_REPORT')
+        if report:
+            with open(report, 'w') as f:
+                json.dump(results, f, indent=2)
+
+        for hook, stats in large.items():
+            with self.subTest(hook=hook):
+                self.assertLessEqual(stats['commands'], small[hook]['commands'])
+                self.assertLessEqual(stats['requests'], small[hook]['requests'])
+                self.assertLessEqual(stats['wall-ms'], stats['limit-ms'],
+                                     f"{hook}: {small[hook]['wall-ms']:.1f} ms with {PEERS[0]} "
+                                     f"peer(s), {stats['wall-ms']:.1f} ms with {PEERS[-1]}")
@@ -0,0 +1,82 @@
+# Copyright 2021 Erik Lönroth
+# See LICENSE file for licensing details.
+
+import itertools
+import json
+import threading
+import unittest
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse
+
+import pin_benchmark
+from cluster_api import ClusterApi, pin_state
+
+
+class StubClusterHandler(BaseHTTPRequestHandler):
+    """
+    ipfs add plus the cluster /pins endpoints. A pin reports pinned on its second status.
+    """
+    protocol_version = 'HTTP/1.1'
+    counter = itertools.count()
+
+    def _send(self, body):
+        data = json.dumps(body).encode()
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _handle(self):
+        path = urlparse(self.path).path
+        length = int(self.headers.get('Content-Length') or 0)
+        self.rfile.read(length)
+        pins = self.server.pins
+        if path == '/api/v0/add':
+            self._send({'Hash': f"bafk{next(self.counter)}"})
+        elif path == '/pins':
+            self._send([{'peer_map': {'p1': {'status': 'queued'}}}
+                        for polls in pins.values() if not polls])
+        elif path.startswith('/pins/'):
+            cid = path[len('/pins/'):]
+            if self.command == 'POST':
+                pins[cid] = 0
+            elif self.command == 'DELETE':
+                self.server.unpinned.append(cid)
+            else:
+                pins[cid] += 1
+            status = 'pinned' if pins[cid] > 1 else 'pinning'
+            self._send({'cid': {'/': cid}, 'peer_map': {'p1': {'status': status},
+                                                        'p2': {'status': 'remote'}}})
+        else:
+            self.send_error(404)
+
+    do_GET = do_POST = do_DELETE = _handle
+
+    def log_message(self, *args):
+        pass
+
+
+class TestPinBenchmark(unittest.TestCase):
+    def setUp(self):
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), StubClusterHandler)
+        self.server.pins, self.server.unpinned = {}, []
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+        self.url = f"http://127.0.0.1:{self.server.server_port}"
+
+    def test_pins_wait_and_clean_up(self):
+        with ClusterApi(self.url, pool_size=4) as cluster:
+            results = pin_benchmark.run(cluster, self.url, count=10, concurrency=4,
+                                        poll_interval=0.01, timeout=10)
+        self.assertEqual(results['pinned'], 10)
+        self.assertEqual(results['failed'], 0)
+        self.assertEqual(results['timed-out'], 0)
+        self.assertEqual(sorted(self.server.unpinned), sorted(self.server.pins))
+
+    def test_pin_state(self):
+        self.assertEqual(pin_state({'peer_map': {'a': {'status': 'pinned'},
+                                                 'b': {'status': 'remote'}}}), 'pinned')
+        self.assertEqual(pin_state({'peer_map': {'a': {'status': 'pinned'},
+                                                 'b': {'status': 'pin_error'}}}), 'error')
+        self.assertEqual(pin_state({'peer_map': {'a': {'status': 'queued'}}}), 'pending')
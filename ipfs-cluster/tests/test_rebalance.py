@@ -0,0 +1,36 @@
+# Copyright 2021 Erik Lönroth
+# See LICENSE file for licensing details.
+
+import unittest
+
+import rebalance
+
+
+class FakeCluster:
+    def __init__(self, pins):
+        self.pins = pins
+
+    def allocations(self):
+        for pin in list(self.pins):
+            yield dict(pin)
+
+    def pin(self, cid, replication_min=0, replication_max=0, name=None):
+        for pin in self.pins:
+            if rebalance.pin_cid(pin) == cid:
+                pin.update(replication_factor_min=replication_min,
+                           replication_factor_max=replication_max)
+
+
+class TestRebalance(unittest.TestCase):
+    def test_moves_default_pins_in_batches(self):
+        pins = [{'cid': {'/': f"Qm{i}"}, 'replication_factor_min': 1,
+                 'replication_factor_max': 1} for i in range(5)]
+        pins.append({'cid': 'bafycustom', 'replication_factor_min': 1,
+                     'replication_factor_max': 4})
+        cluster = FakeCluster(pins)
+        self.assertEqual(rebalance.run(cluster, [[1, 1]], [1, 2], 2), 2)
+        self.assertEqual(rebalance.run(cluster, [[1, 1]], [1, 2], 2), 2)
+        self.assertEqual(rebalance.run(cluster, [[1, 1]], [1, 2], 2), 1)
+        self.assertEqual(rebalance.run(cluster, [[1, 1]], [1, 2], 2), 0)
+        self.assertEqual(pins[-1]['replication_factor_max'], 4)
+        self.assertTrue(all(pin['replication_factor_max'] == 2 for pin in pins[:5]))
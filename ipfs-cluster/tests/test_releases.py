@@ -0,0 +1,60 @@
+# Copyright 2021 Erik Lönroth
+# See LICENSE file for licensing details.
+
+import os
+import tempfile
+import unittest
+from pathlib import Path
+from unittest.mock import patch
+
+import releases
+
+
+def fake_fetch(uri, dst, sha256=None, cache_max_bytes=0):
+    binary = os.path.basename(uri).split('_')[0]
+    (Path(dst) / binary).mkdir(exist_ok=True)
+    (Path(dst) / binary / binary).write_text(uri)
+
+
+class TestReleases(unittest.TestCase):
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.home = Path(tmp.name)
+        for name, value in (('IPFS_HOME', self.home), ('RELEASES', self.home / 'releases'),
+                            ('CURRENT', self.home / 'current')):
+            patcher = patch.object(releases, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def stage(self, version):
+        sources = [(f"https://dist/ipfs-cluster-{b}_{version}_linux-amd64.tar.gz", None)
+                   for b in ('service', 'ctl')]
+        name = releases.release_name(sources[0][0], sources[1][0])
+        with patch('utils.fetch_and_extract_sources', fake_fetch):
+            releases.stage(name, sources, 0)
+        return name
+
+    def test_release_name(self):
+        name = releases.release_name('https://dist/ipfs-cluster-service_v0.14.1_linux.tar.gz',
+                                     'https://dist/ipfs-cluster-ctl_v0.14.1_linux.tar.gz')
+        self.assertTrue(name.startswith('v0.14.1-'))
+
+    def test_switch_keeps_paths_and_moves_legacy_binaries_aside(self):
+        (self.home / 'ipfs-cluster-service').mkdir()
+        (self.home / 'ipfs-cluster-service' / 'ipfs-cluster-service').write_text('old')
+        self.assertIsNone(releases.current())
+
+        new = self.stage('v1.0.0')
+        releases.activate(new)
+        binary = self.home / 'ipfs-cluster-service' / 'ipfs-cluster-service'
+        self.assertIn('v1.0.0', binary.read_text())
+        self.assertEqual(releases.current(), new)
+        legacy = self.home / 'releases' / 'legacy' / 'ipfs-cluster-service'
+        self.assertEqual((legacy / 'ipfs-cluster-service').read_text(), 'old')
+
+        newer = self.stage('v1.0.1')
+        self.assertIn('v1.0.0', binary.read_text())
+        releases.activate(newer)
+        self.assertIn('v1.0.1', binary.read_text())
+        self.assertEqual(sorted(releases.prune({newer, new})), ['legacy'])
@@ -0,0 +1,80 @@
+# Copyright 2021 Erik Lönroth
+# See LICENSE file for licensing details.
+
+import json
+import tempfile
+import unittest
+from pathlib import Path
+from unittest.mock import patch
+
+import service_config
+import utils
+
+
+class TestServiceConfig(unittest.TestCase):
+    def test_overrides_win_over_preset(self):
+        settings = service_config.settings_from_config({'cluster-profile': 'high-ingest',
+                                                        'pintracker-concurrent-pins': 20,
+                                                        'crdt-max-batch-age': ''})
+        self.assertEqual(settings['pin_tracker.stateless.concurrent_pins'], 20)
+        self.assertEqual(settings['consensus.crdt.batching.max_batch_age'], '1s')
+
+    def test_validation(self):
+        with self.assertRaises(ValueError):
+            service_config.settings_from_config({'monitor-check-interval': '15 seconds'})
+        with self.assertRaises(ValueError):
+            service_config.settings_from_config({'cluster-profile': 'turbo'})
+        self.assertEqual(service_config.settings_from_config({'ipfs-pin-timeout': '1m30s'}),
+                         {'ipfs_connector.ipfshttp.pin_timeout': '1m30s'})
+
+    def test_write_service_json_only_when_changed(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = Path(tmp) / 'service.json'
+            path.write_text(json.dumps({'cluster': {'secret': 'old', 'peername': 'p'},
+                                        'consensus': {'crdt': {'batching': {}}}}))
+            settings = {'consensus.crdt.batching.max_batch_size': 500}
+            with patch('utils.SERVICE_JSON', path):
+                self.assertTrue(utils.write_service_json({'cluster_secret': 's'}, settings))
+                mtime = path.stat().st_mtime_ns
+                self.assertFalse(utils.write_service_json({'cluster_secret': 's'}, settings))
+            self.assertEqual(path.stat().st_mtime_ns, mtime)
+            data = json.loads(path.read_text())
+            self.assertEqual(data['cluster'], {'secret': 's', 'peername': 'p'})
+            self.assertEqual(data['consensus']['crdt']['batching'], {'max_batch_size': 500})
+
+    def test_ipfs_node_settings(self):
+        socket = '/unix/home/ubuntu/snap/ipfs/common/api.sock'
+        self.assertEqual(service_config.ipfs_node_settings(socket),
+                         {'ipfs_connector.ipfshttp.node_multiaddress': socket,
+                          'api.ipfsproxy.node_multiaddress': socket})
+        self.assertEqual(service_config.ipfs_node_settings(None), {})
+
+    def test_deployment_defaults_under_options(self):
+        tags = [{'zone': 'az1'}, {'zone': 'az2'}, {'zone': 'az2', 'tier': 'nvme'}]
+        defaults = service_config.default_replication(len(tags))
+        defaults.update(service_config.default_allocation(tags))
+        settings = service_config.settings_from_config({'replication-factor-max': 5,
+                                                        'disable-repinning': 'false'},
+                                                       defaults)
+        self.assertEqual(settings['cluster.replication_factor_min'], 2)
+        self.assertEqual(settings['cluster.replication_factor_max'], 5)
+        self.assertIs(settings['cluster.disable_repinning'], False)
+        self.assertEqual(settings['allocator.balanced.allocate_by'], ['tag:zone', 'freespace'])
+
+        settings = service_config.settings_from_config({'allocate-by': 'tag:tier, freespace'},
+                                                       service_config.default_replication(1))
+        self.assertEqual(settings['allocator.balanced.allocate_by'], ['tag:tier', 'freespace'])
+        self.assertEqual(settings['cluster.replication_factor_max'], 1)
+        self.assertNotIn('cluster.disable_repinning', settings)
+        with self.assertRaises(ValueError):
+            service_config.settings_from_config({'replication-factor-min': -2})
+        with self.assertRaises(ValueError):
+            service_config.settings_from_config({'disable-repinning': 'sometimes'})
+
+    def test_listen_settings(self):
+        api, proxy = (key for key, _ in service_config.LISTENERS.values())
+        settings = service_config.listen_settings({api: None, proxy: None}, {'proxy'})
+        self.assertEqual(settings, {api: '/ip4/127.0.0.1/tcp/9094',
+                                    proxy: '/ip4/0.0.0.0/tcp/9095'})
+        settings = service_config.listen_settings(settings, set())
+        self.assertEqual(settings[proxy], '/ip4/127.0.0.1/tcp/9095')
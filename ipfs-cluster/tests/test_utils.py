@@ -0,0 +1,114 @@
+# Copyright 2021 Erik Lönroth
+# See LICENSE file for licensing details.
+
+import hashlib
+import io
+import os
+import tarfile
+import tempfile
+import unittest
+from pathlib import Path
+from unittest.mock import MagicMock, patch
+
+import utils
+
+
+def make_archive(files):
+    buf = io.BytesIO()
+    with tarfile.open(fileobj=buf, mode='w:gz') as tfile:
+        for name, data in files.items():
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            tfile.addfile(info, io.BytesIO(data))
+    return buf.getvalue()
+
+
+def fake_response(payload, chunk=7):
+    response = MagicMock()
+    chunks = (payload[i:i + chunk] for i in range(0, len(payload), chunk))
+    response.iter_content.return_value = chunks
+    response.__enter__.return_value = response
+    return response
+
+
+class TestFetchAndExtractSources(unittest.TestCase):
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.dst = Path(tmp.name) / 'opt'
+        self.cache = Path(tmp.name) / 'cache'
+        self.archive = make_archive({'ipfs-cluster-ctl/ipfs-cluster-ctl': b'#!/bin/true\n' * 100})
+        self.sha256 = hashlib.sha256(self.archive).hexdigest()
+
+    def fetch(self, sha256, **kwargs):
+        return utils.fetch_and_extract_sources('http://example/ctl.tar.gz', self.dst, sha256,
+                                               cache_dir=self.cache, **kwargs)
+
+    @patch('utils.requests.get')
+    def test_streams_verifies_and_caches(self, get):
+        get.return_value = fake_response(self.archive)
+        self.assertEqual(self.fetch(self.sha256), self.sha256)
+        self.assertTrue((self.dst / 'ipfs-cluster-ctl' / 'ipfs-cluster-ctl').is_file())
+        self.assertTrue((self.cache / f"{self.sha256}.tar.gz").is_file())
+        self.assertEqual(os.listdir(self.dst), ['ipfs-cluster-ctl'])
+
+    @patch('utils.requests.get')
+    def test_cache_hit_skips_network(self, get):
+        get.return_value = fake_response(self.archive)
+        self.fetch(self.sha256)
+        get.reset_mock()
+        self.fetch(self.sha256)
+        get.assert_not_called()
+
+    @patch('utils.requests.get')
+    def test_cache_hit_by_uri_without_digest(self, get):
+        get.return_value = fake_response(self.archive)
+        self.fetch(None)
+        get.reset_mock()
+        self.assertEqual(self.fetch(''), self.sha256)
+        get.assert_not_called()
+
+        (self.cache / f"{self.sha256}.tar.gz").write_bytes(self.archive + b'damage')
+        with self.assertRaises(utils.ArtifactVerificationError):
+            self.fetch(None)
+        get.return_value = fake_response(self.archive)
+        self.assertEqual(self.fetch(None), self.sha256)
+        get.assert_called_once()
+
+    @patch('utils.requests.get')
+    def test_digest_mismatch_leaves_dst_untouched(self, get):
+        get.return_value = fake_response(self.archive)
+        with self.assertRaises(utils.ArtifactVerificationError):
+            self.fetch('0' * 64)
+        self.assertEqual(os.listdir(self.dst), [])
+        self.assertEqual(os.listdir(self.cache), [])
+
+    def test_eviction_keeps_newest_within_bound(self):
+        self.cache.mkdir()
+        for i, name in enumerate(['a', 'b', 'c']):
+            path = self.cache / f"{name}.tar.gz"
+            path.write_bytes(b'x' * 10)
+            os.utime(path, (i, i))
+        evicted = utils.evict_artifact_cache(self.cache, max_bytes=20, keep='a')
+        self.assertEqual(evicted, ['b.tar.gz'])
+        self.assertEqual(sorted(os.listdir(self.cache)), ['a.tar.gz', 'c.tar.gz'])
+
+
+class TestPeerstore(unittest.TestCase):
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        patcher = patch('utils.PEERSTORE', Path(tmp.name) / 'peerstore')
+        self.peerstore = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_update_applies_diff(self):
+        a = utils.peer_multiaddr('10.0.0.1', 'QmA')
+        b = utils.peer_multiaddr('10.0.0.2', 'QmB')
+        self.assertEqual(a, '/ip4/10.0.0.1/tcp/9096/p2p/QmA')
+        self.assertEqual(utils.update_peerstore({a, b}), ({a, b}, set()))
+        mtime = self.peerstore.stat().st_mtime_ns
+        self.assertEqual(utils.update_peerstore({a, b}), (set(), set()))
+        self.assertEqual(self.peerstore.stat().st_mtime_ns, mtime)
+        self.assertEqual(utils.update_peerstore({a}), (set(), {b}))
+        self.assertEqual(self.peerstore.read_text(), f"{a}\n")
@@ -0,0 +1,81 @@
+# Copyright 2021 Erik Lönroth
+# See LICENSE file for licensing details.
+
+"""
+add/cat throughput benchmark against the local daemon HTTP API.
+"""
+
+import logging
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from hookstats import percentile
+
+logger = logging.getLogger(__name__)
+
+MIB = 1024 * 1024
+
+
+def _random_chunks(size, chunk_size=MIB):
+    """
+    Incompressible, never repeating data so nothing is deduplicated by the blockstore.
+    """
+    while size > 0:
+        n = min(size, chunk_size)
+        yield os.urandom(n)
+        size -= n
+
+
+def _summary(total_bytes, seconds, latencies):
+    latencies = [latency * 1000 for latency in latencies]
+    return {
+        'seconds': round(seconds, 3),
+        'mb-per-s': round(total_bytes / MIB / seconds, 2) if seconds else 0,
+        'ops-per-s': round(len(latencies) / seconds, 2) if seconds else 0,
+        'latency-p50-ms': round(percentile(latencies, 50), 1),
+        'latency-p95-ms': round(percentile(latencies, 95), 1),
+        'latency-p99-ms': round(percentile(latencies, 99), 1),
+    }
+
+
+def run(api, size_mb, file_count, chunker, raw_leaves, cid_version, concurrency, timeout=300):
+    """
+    Add file_count files making up size_mb of synthetic data, then cat them all back
+    with concurrency parallel readers. Nothing is pinned, a later GC drops the data.
+    """
+    if size_mb <= 0 or file_count <= 0 or concurrency <= 0:
+        raise ValueError("size-mb, file-count and concurrency must be positive")
+    file_size = max(1, size_mb * MIB // file_count)
+
+    cids, add_latencies = [], []
+    started = time.monotonic()
+    for i in range(file_count):
+        t0 = time.monotonic()
+        added = api.add([(f"benchmark-{i}", _random_chunks(file_size), None)], timeout=timeout,
+                        chunker=chunker, raw_leaves=raw_leaves, cid_version=cid_version,
+                        pin=False, quieter=True)
+        add_latencies.append(time.monotonic() - t0)
+        cids.append(added[-1]['Hash'])
+    add_seconds = time.monotonic() - started
+    logger.info(f"Added {file_count} x {file_size} bytes in {add_seconds:.2f}s")
+
+    def cat(cid):
+        t0 = time.monotonic()
+        size = sum(len(chunk) for chunk in api.cat(cid, timeout=timeout))
+        return size, time.monotonic() - t0
+
+    started = time.monotonic()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        reads = list(pool.map(cat, cids))
+    cat_seconds = time.monotonic() - started
+    read_bytes = sum(size for size, _ in reads)
+    if read_bytes != file_size * file_count:
+        raise RuntimeError(f"Read back {read_bytes} bytes, added {file_size * file_count}")
+
+    return {
+        'files': file_count,
+        'file-size-bytes': file_size,
+        'add': _summary(file_size * file_count, add_seconds, add_latencies),
+        'cat': _summary(read_bytes, cat_seconds, [latency for _, latency in reads]),
+    }
@@ -2,18 +2,35 @@
 # Copyright 2021 Erik Lönroth
 # See LICENSE file for licensing details.
 
+import json
 import logging
 import os
 import shutil
 
-from ops.charm import CharmBase
+from ops.charm import CharmBase, UpdateStatusEvent
 from ops.framework import StoredState
 from ops.main import main
-from ops.model import ActiveStatus, WaitingStatus, MaintenanceStatus
-import subprocess
+from ops.model import BlockedStatus, MaintenanceStatus
+from pathlib import Path
 import sys
 
+import requests
+
 import utils
+import files
+import hookstats
+import metrics
+import benchmark
+import digests
+import health
+import dataset_import
+import peering
+import repo_gc
+import systemd_unit
+import storage
+import tuning
+import upstreams
+from ipfs_api import IpfsApi, url_multiaddr
 
 logger = logging.getLogger(__name__)
 
@@ -23,6 +40,22 @@ EMOJI_GREEN_DOT = "\U0001F7E2"
 EMOJI_RED_DOT = "\U0001F534"
 EMOJI_PACKAGE = "\U0001F4E6"
 
+IPFS_REPO = Path('/home/ubuntu/snap/ipfs/common/')
+IPFS_CONFIG = IPFS_REPO / 'config'
+# Inside the snap's common dir, the confined daemon can create it there.
+API_SOCKET = IPFS_REPO / 'api.sock'
+SYSTEMD_DIR = Path('/etc/systemd/system')
+IPFS_DEFAULTS = Path('/etc/default/ipfs')
+
+# go-ipfs default Swarm.ConnMgr.HighWater
+DEFAULT_CONNMGR_HIGH_WATER = 900
+
+# The daemon shares the host with a co-located ipfs-cluster, and takes the lion's share.
+DAEMON_MEMORY_SHARE = 0.75
+
+# Listeners public-endpoints can publish, see tuning.LISTENER_KEYS.
+PUBLIC_ROLES = ('gateway', 'api')
+
 
 class IPFSCharm(CharmBase):
     """Charm the hello service with all core hooks."""
@@ -42,11 +75,39 @@ class IPFSCharm(CharmBase):
         self.framework.observe(self.on.update_status, self._on_update_status)
         self.framework.observe(self.on.collect_metrics, self._on_collect_metrics)
         self.framework.observe(self.on.upgrade_charm, self._on_upgrade_charm)
+        self.framework.observe(self.on.hook_stats_action, self._on_hook_stats_action)
+        self.framework.observe(self.on.ipfs_repo_storage_attached,
+                               self._on_ipfs_repo_storage_attached)
+        self.framework.observe(self.on.ipfs_repo_storage_detaching,
+                               self._on_ipfs_repo_storage_detaching)
+        self.framework.observe(self.on.benchmark_action, self._on_benchmark_action)
+        self.framework.observe(self.on.gc_action, self._on_gc_action)
+        self.framework.observe(self.on.import_action, self._on_import_action)
+
+        self.framework.observe(self.on.ipfs_relation_joined, self._on_ipfs_relation_joined)
+        self.framework.observe(self.on.ipfs_peers_relation_joined,
+                               self._on_ipfs_peers_relation_changed)
+        self.framework.observe(self.on.ipfs_peers_relation_changed,
+                               self._on_ipfs_peers_relation_changed)
+        self.framework.observe(self.on.ipfs_peers_relation_departed,
+                               self._on_ipfs_peers_relation_departed)
+
+        # Prometheus scrape relation
+        self.framework.observe(self.on.metrics_endpoint_relation_joined,
+                               self._on_metrics_endpoint_relation_joined)
 
         self._stored.set_default(snap_channel=self.config["snap-channel"],
-                                 restart_on_reconfig=self.config["restart-on-reconfig"])
-
-
+                                 restart_on_reconfig=self.config["restart-on-reconfig"],
+                                 hook_stats=[],
+                                 gc_history=[],
+                                 gc_trigger=None,
+                                 import_state={},
+                                 digests={},
+                                 peering={},
+                                 latency=[],
+                                 version_cache={})
+
+    @hookstats.timed
     def _on_install(self, event):
         """
         Install your software here plus any dependencies, utilities and everything you need to run
@@ -56,20 +117,24 @@ class IPFSCharm(CharmBase):
 
         In this charm, we install a package and a service unit file which will use hello.
 
-        This hook is ran after the storage-filesystem-attached hook - only once in the entire lifetime of the unit.
+        This hook is ran after the storage-filesystem-attached hook - only once in the
+        entire lifetime of the unit.
         """
         logger.debug(EMOJI_CORE_HOOK_EVENT + sys._getframe().f_code.co_name)
 
         logger.info(f"Installing from snap ipfs {EMOJI_PACKAGE}")
-        os.system(f"snap install ipfs --channel={self._stored.snap_channel}")
+        hookstats.system(f"snap install ipfs --channel={self._stored.snap_channel}")
+        digests.record(self._stored.digests, 'snap-channel', self._stored.snap_channel)
 
         # Install unit file for hello (one-shot service)
-        shutil.copyfile('templates/etc/systemd/system/ipfs-daemon.service', '/etc/systemd/system/ipfs-daemon.service')
+        self._install_daemon_unit()
 
         # (re)config hello.
         self._reconfig_ipfs(restart=False)
 
+        self._install_exporter()
 
+    @hookstats.timed
     def _on_config_changed(self, event):
         """
         Deal with charm configuration changes here.
@@ -82,32 +147,47 @@ class IPFSCharm(CharmBase):
         """
         logger.debug(EMOJI_CORE_HOOK_EVENT + sys._getframe().f_code.co_name)
 
-        if self.config["snap-channel"] != self._stored.snap_channel:
-            self._stored.snap_channel = self.config["snap-channel"]
-            self._reconfig_ipfs(restart=self.config["restart-on-reconfig"])
+        if self._tuning() is None or self._public_roles() is None:
+            return
+
+        unit_changed = self._install_daemon_unit()
+        changed = self._reconfig_ipfs(restart=False)
+
+        if (changed or unit_changed) and self.config["restart-on-reconfig"]:
+            logger.info(f"{EMOJI_GREEN_DOT} Restarting ipfs-daemon.")
+            hookstats.system('systemctl restart ipfs-daemon.service')
 
+        self._install_exporter()
+        self._publish_scrape_config()
+        self._publish_api_endpoint()
         self._on_update_status(event)
 
+    @hookstats.timed
     def _on_start(self, event):
         """
             Start your service here, possibly defer (wait) until conditions are OK.
         """
         logger.debug(EMOJI_CORE_HOOK_EVENT + sys._getframe().f_code.co_name)
-        logger.debug(f"ipfs init")
-        os.system('sudo -u ubuntu ipfs init')
+        if not IPFS_CONFIG.exists():
+            self._init_repo()
+        self._apply_tuning(restart=False)
         logger.info(f"{EMOJI_GREEN_DOT} Starting the ipfs-daemon service...")
-        os.system('systemctl start ipfs-daemon.service')
+        hookstats.system('systemctl start ipfs-daemon.service')
+        self._publish_peering()
 
         # Calling update_status gives quick feedback when deploying starts up.
         self._on_update_status(event)
 
+    @hookstats.timed
     def _on_leader_elected(self, event):
         """
             This is only run on the unit which is selected by juju as leader.
-            We are not implementing anything here. See the "leadership" charm for an example.
         """
         logger.debug(EMOJI_CORE_HOOK_EVENT + sys._getframe().f_code.co_name)
+        self._publish_scrape_config()
+        self._share_upstreams()
 
+    @hookstats.timed
     def _on_leader_settings_changed(self, event):
         """
             This is only run on the unit which is selected by juju as leader.
@@ -115,40 +195,67 @@ class IPFSCharm(CharmBase):
         """
         logger.debug(EMOJI_CORE_HOOK_EVENT + sys._getframe().f_code.co_name)
 
+    @hookstats.timed
     def _on_update_status(self, event):
         """
             This runs every 5 minutes.
 
-            Have one place to figure out status for the charm is a good strategy for a beginner charmer.
+            Have one place to figure out status for the charm is a good strategy for a
+            beginner charmer.
         """
         logger.debug(EMOJI_CORE_HOOK_EVENT + sys._getframe().f_code.co_name)
 
-        if not os.system('systemctl is-active ipfs-daemon.service') == 0:
-            logger.info("ipfs-daemon service is not running.")
-            self.unit.status = MaintenanceStatus("Inactive.")
+        tick = isinstance(event, UpdateStatusEvent)
+        probed = self._probe_health()
+        if probed is None:
+            if not hookstats.system('systemctl is-active ipfs-daemon.service') == 0:
+                logger.info("ipfs-daemon service is not running.")
+                self.unit.status = MaintenanceStatus("Inactive.")
+            elif tick:
+                self.unit.status = BlockedStatus("Running, but the API is not answering.")
+            else:
+                self.unit.status = MaintenanceStatus("Waiting for the API.")
         else:
-            logger.info(f"ipfs-daemon service is running.")
-            self.unit.status = ActiveStatus("Running.")
+            note = ""
+            # Only the periodic tick does GC, not the hooks calling us for quick feedback.
+            if tick:
+                self._publish_api_endpoint()
+                if self._maybe_gc():
+                    note = "Repo GC running."
+            self.unit.status = health.to_status(*probed, note=note)
+        self._describe_upstreams(probed)
+        self._share_upstreams()
 
         if self.model.unit.is_leader():
-                self.unit.set_workload_version(utils.getIpfsVersion())
-            
+            version = health.cached_version(self._stored.version_cache, utils.IPFS_BINARY,
+                                            utils.getIpfsVersion)
+            if version:
+                self.unit.set_workload_version(version)
+
+    @hookstats.timed
     def _on_upgrade_charm(self, event):
         logger.debug(EMOJI_CORE_HOOK_EVENT + sys._getframe().f_code.co_name)
 
+        # Units from before digests were kept already run the stored channel.
+        if 'snap-channel' not in self._stored.digests:
+            digests.record(self._stored.digests, 'snap-channel', self._stored.snap_channel)
+
         # Re-install systemd unit
-        shutil.copyfile('templates/etc/systemd/system/ipfs-daemon.service', '/etc/systemd/system/ipfs-daemon.service')
+        self._install_daemon_unit()
+        self._install_exporter()
 
+    @hookstats.timed
     def _on_stop(self, event):
         """
-        Bring down your service, possibly defer until all systems are good to go similar to start hook.
+        Bring down your service, possibly defer until all systems are good to go similar to
+        start hook.
         """
         logger.debug(EMOJI_CORE_HOOK_EVENT + sys._getframe().f_code.co_name)
 
         logger.info(f"{EMOJI_RED_DOT} Stopping the ipfs-daemon service...")
-        os.system('systemctl stop ipfs-daemon.service')
-
+        hookstats.system('systemctl stop ipfs-daemon.service')
 
+    @hookstats.timed
     def _on_remove(self, event):
         """
         Remove stuff you might want to clean up.
@@ -158,48 +265,575 @@ class IPFSCharm(CharmBase):
         logger.debug(EMOJI_CORE_HOOK_EVENT + sys._getframe().f_code.co_name)
 
         logger.info(f"Removing ipfs {EMOJI_PACKAGE}")
-        os.system('snap remove ipfs')
-
+        hookstats.system('snap remove ipfs')
 
+    @hookstats.timed
     def _on_collect_metrics(self, event):
         """
         This runs every 5 minutes - if metrics are defined in metrics.yaml.
 
-        We don't implement any metrics this in this charm. See the metrics charm for a working example.
-        
-        ipfs stats might be useful
+        Reads the figures from the daemon HTTP API, the same way the exporter does.
+        """
+        logger.debug(EMOJI_CORE_HOOK_EVENT + sys._getframe().f_code.co_name)
+
+        with IpfsApi(self.config["ipfs-api-url"]) as api:
+            samples = {s.name: s.value for s in metrics.collect(api)}
+
+        if not samples.get('ipfs_up'):
+            logger.info("ipfs API not answering, no metrics to add.")
+            return
+
+        event.add_metrics({'repo-size': samples['ipfs_repo_size_bytes'],
+                           'swarm-peers': samples['ipfs_swarm_peers'],
+                           'bw-rate-in': samples['ipfs_bw_rate_in_bytes'],
+                           'bw-rate-out': samples['ipfs_bw_rate_out_bytes']})
+
+    @hookstats.timed
+    def _on_ipfs_repo_storage_attached(self, event):
+        """
+        Put the ipfs repo on the volume, moving an existing repo over while it runs.
+
+        Runs before install on new units, then there is nothing to move.
+        """
+        logger.debug(EMOJI_CORE_HOOK_EVENT + sys._getframe().f_code.co_name)
+        location = event.storage.location
+        target = location / 'ipfs'
+        storage.ensure_noatime(location)
+
+        if storage.is_bind_mounted(target, IPFS_REPO):
+            return
+        for parent in (IPFS_REPO.parent.parent, IPFS_REPO.parent):
+            parent.mkdir(exist_ok=True)
+            shutil.chown(parent, 'ubuntu', 'ubuntu')
+
+        if not storage.has_data(IPFS_REPO):
+            storage.bind_mount(target, IPFS_REPO)
+            return
+
+        logger.info(f"{EMOJI_PACKAGE} Moving ipfs repo {IPFS_REPO} onto {target}")
+        running = hookstats.system('systemctl is-active ipfs-daemon.service') == 0
+
+        def progress(phase, percent):
+            self.unit.status = MaintenanceStatus(f"Moving repo to storage: {phase} {percent}%")
+
+        def stop():
+            if running:
+                hookstats.system('systemctl stop ipfs-daemon.service')
+
+        def start():
+            if running:
+                hookstats.system('systemctl start ipfs-daemon.service')
+
+        storage.migrate(IPFS_REPO, target, stop, start, progress)
+        self._on_update_status(event)
+
+    @hookstats.timed
+    def _on_ipfs_repo_storage_detaching(self, event):
+        """
+        The repo goes with the volume, stop the daemon before it disappears.
+        """
+        logger.debug(EMOJI_CORE_HOOK_EVENT + sys._getframe().f_code.co_name)
+        logger.info(f"{EMOJI_RED_DOT} Stopping the ipfs-daemon service, repo storage detaching")
+        hookstats.system('systemctl stop ipfs-daemon.service')
+        storage.unmount(IPFS_REPO)
+        self.unit.status = BlockedStatus("ipfs-repo storage detached.")
+
+    def _on_hook_stats_action(self, event):
+        """
+        Wall time and external command percentiles per hook, from the last hook-stats-size runs.
+        """
+        records = list(self._stored.hook_stats)
+        summary = hookstats.summarize(records, event.params.get("hook") or None)
+        event.set_results({"recorded": len(records), "hooks": summary})
 
+    def _on_benchmark_action(self, event):
         """
+        add/cat throughput of the local daemon, see benchmark.run.
+        """
+        params = event.params
+        concurrency = params.get("concurrency", 4)
+        try:
+            with IpfsApi(self.config["ipfs-api-url"], pool_size=concurrency) as api:
+                results = benchmark.run(api,
+                                        size_mb=params.get("size-mb", 256),
+                                        file_count=params.get("file-count", 16),
+                                        chunker=params.get("chunker", "size-262144"),
+                                        raw_leaves=params.get("raw-leaves", True),
+                                        cid_version=params.get("cid-version", 1),
+                                        concurrency=concurrency)
+        except (requests.RequestException, ValueError, RuntimeError) as e:
+            event.fail(f"Benchmark failed: {e}")
+            return
+        event.set_results(results)
+
+    @hookstats.timed
+    def _on_metrics_endpoint_relation_joined(self, event):
+        logger.debug(EMOJI_CORE_HOOK_EVENT + sys._getframe().f_code.co_name)
+        self._publish_scrape_config(event.relation)
+
+    @hookstats.timed
+    def _on_ipfs_relation_joined(self, event):
         logger.debug(EMOJI_CORE_HOOK_EVENT + sys._getframe().f_code.co_name)
+        self._publish_api_endpoint(event.relation)
+        self._share_upstreams()
 
+    @hookstats.timed
+    def _on_ipfs_peers_relation_changed(self, event):
+        logger.debug(EMOJI_CORE_HOOK_EVENT + sys._getframe().f_code.co_name)
+        self._publish_peering(event.relation)
+        self._reconcile_peering(event.relation)
+        self._share_upstreams()
+
+    @hookstats.timed
+    def _on_ipfs_peers_relation_departed(self, event):
+        logger.debug(EMOJI_CORE_HOOK_EVENT + sys._getframe().f_code.co_name)
+        departed = event.departing_unit or event.unit
+        self._reconcile_peering(event.relation, departed=departed)
+        self._share_upstreams(departed)
+
+    def _on_gc_action(self, event):
+        """
+        Start the same IO throttled GC as update-status does, regardless of watermark and window.
+
+        It runs outside the hook, like the scheduled one, and update-status records how it went.
+        """
+        self._collect_gc()
+        history = self._stored.gc_history
+        results = {"last-run": json.dumps(dict(history[-1])) if history else ""}
+        if self._gc_running():
+            event.fail("repo gc is already running.")
+            return
+        self._start_gc("action")
+        results["started"] = repo_gc.GC_UNIT
+        event.set_results(results)
+
+    def _on_import_action(self, event):
+        """
+        Stream a directory or tarball into MFS, resuming an earlier run on the same source.
+        """
+        params = event.params
+        source = params["source"]
+        if params.get("nocopy") and not self.config["filestore"]:
+            event.fail("nocopy needs the filestore, set filestore=true first.")
+            return
+        options = {key: params.get(key) for key in ("chunker", "raw-leaves", "cid-version",
+                                                    "nocopy")}
+        try:
+            source_id = dataset_import.source_id(source, options)
+        except OSError as e:
+            event.fail(f"Can't import {source}: {e}")
+            return
+
+        state = dict(self._stored.import_state)
+        if state.get("source") != source_id or params.get("restart"):
+            state = {"source": source_id, "done": 0}
+        elif state["done"]:
+            event.log(f"Resuming after {state['done']} files")
+
+        def checkpoint(done):
+            state["done"] = done
+            self._stored.import_state = state
+            # Persist now, not at the end of the action, so a kill loses one batch at most.
+            self.framework.commit()
+
+        def progress(stats):
+            event.log(f"{state['done']} files, {stats['bytes']} bytes, {stats['mb-per-s']} MB/s")
+
+        name = params.get("name") or os.path.basename(source.rstrip('/')).split('.')[0]
+        parallelism = params.get("parallelism", 4)
+        try:
+            with IpfsApi(self.config["ipfs-api-url"], pool_size=parallelism) as api:
+                result = dataset_import.run(api, source, name, done=state["done"],
+                                            batch_size=params.get("batch-size", 64),
+                                            parallelism=parallelism,
+                                            chunker=params.get("chunker", "size-262144"),
+                                            raw_leaves=params.get("raw-leaves", True),
+                                            cid_version=params.get("cid-version", 1),
+                                            nocopy=params.get("nocopy", False),
+                                            pin=params.get("pin", True),
+                                            checkpoint=checkpoint, progress=progress)
+        except (requests.RequestException, OSError, ValueError) as e:
+            event.fail(f"Import failed: {e}")
+            return
+        event.set_results(result)
+
+    def _probe_health(self):
+        """
+        Time /api/v0/id round trips, (state, p95) over the recent ones.
+
+        Blocked if a call took longer than health-blocked-ms, None if the API
+        did not answer at all.
+        """
+        blocked_ms = self.config["health-blocked-ms"]
+        try:
+            with IpfsApi(self.config["ipfs-api-url"], timeout=blocked_ms / 1000) as api:
+                times = health.probe([lambda: api.call('id')], self.config["health-samples"])
+        except requests.Timeout as e:
+            logger.warning(f"ipfs API timed out: {e}")
+            return health.timed_out(self._stored.latency, blocked_ms)
+        except (requests.RequestException, ValueError) as e:
+            logger.warning(f"ipfs API not answering: {e}")
+            return None
+        health.record(self._stored.latency, times)
+        state, p95 = health.assess(self._stored.latency, self.config["health-degraded-ms"],
+                                   blocked_ms)
+        logger.info(f"ipfs API p95 {p95} ms over {len(self._stored.latency)} probes: {state}")
+        return state, p95
+
+    def _maybe_gc(self):
+        """
+        Start GC once the repo is past gc-high-watermark percent of StorageMax, inside
+        gc-window. Records a finished run first. Returns whether GC is running.
+        """
+        self._collect_gc()
+        if self._gc_running():
+            return True
+        try:
+            if not repo_gc.in_window(self.config["gc-window"]):
+                return False
+        except ValueError as e:
+            logger.error(str(e))
+            return False
+
+        try:
+            with IpfsApi(self.config["ipfs-api-url"]) as api:
+                size, storage_max = repo_gc.usage(api)
+        except requests.RequestException as e:
+            logger.warning(f"Skipping GC, ipfs API not answering: {e}")
+            return False
+        if not repo_gc.over_watermark(size, storage_max, self.config["gc-high-watermark"]):
+            return False
+        logger.info(f"Repo at {size}/{storage_max} bytes, past gc-high-watermark.")
+        self._start_gc("watermark")
+        return True
+
+    def _gc_running(self):
+        state = hookstats.run(['systemctl', 'show', '-p', 'ActiveState', '--value',
+                               repo_gc.GC_UNIT], capture_output=True)
+        return state.stdout.decode().strip() in ('activating', 'active', 'deactivating')
+
+    def _start_gc(self, trigger):
+        """
+        Start the ipfs-repo-gc.service oneshot without waiting for it, see repo_gc.
+        """
+        unit = systemd_unit.render('templates/etc/systemd/system/ipfs-repo-gc.service.j2',
+                                   charm_dir=self.charm_dir,
+                                   api_url=self.config["ipfs-api-url"],
+                                   io_weight=self.config["gc-io-weight"],
+                                   timeout=self.config["gc-timeout"],
+                                   result=repo_gc.RESULT)
+        if self._render(SYSTEMD_DIR / repo_gc.GC_UNIT, unit):
+            hookstats.system('systemctl daemon-reload')
+        logger.info(f"Starting {repo_gc.GC_UNIT} ({trigger})")
+        hookstats.system(f'systemctl start --no-block {repo_gc.GC_UNIT}')
+        self._stored.gc_trigger = trigger
+
+    def _collect_gc(self):
+        result = repo_gc.collect(self._stored.gc_history, self._stored.gc_trigger)
+        if result is None:
+            return
+        if result.get('error'):
+            logger.warning(f"repo gc ({result['trigger']}) failed: {result['error']}")
+        else:
+            logger.info(f"repo gc ({result['trigger']}) freed {result['freed']} bytes "
+                        f"in {result['seconds']}s")
+
+    def _install_exporter(self):
+        """
+        Render the Prometheus exporter unit and (re)start it if it changed.
+        """
+        unit = systemd_unit.render('templates/etc/systemd/system/ipfs-exporter.service.j2',
+                                   charm_dir=self.charm_dir,
+                                   port=self.config["metrics-port"],
+                                   api_url=self.config["ipfs-api-url"],
+                                   cluster_api_url=self.config["cluster-api-url"])
+        if not self._render(SYSTEMD_DIR / 'ipfs-exporter.service', unit):
+            return
+
+        logger.info(f"{EMOJI_GREEN_DOT} Installing ipfs-exporter on "
+                    f":{self.config['metrics-port']}")
+        hookstats.system('systemctl daemon-reload')
+        hookstats.system('systemctl enable ipfs-exporter.service')
+        hookstats.system('systemctl restart ipfs-exporter.service')
+
+    def _publish_scrape_config(self, relation=None):
+        """
+        Tell Prometheus where to scrape us over the metrics-endpoint relation.
+        """
+        relations = [relation] if relation else self.model.relations["metrics-endpoint"]
+        for rel in relations:
+            address = str(self.model.get_binding(rel).network.ingress_address)
+            rel.data[self.unit].update({"prometheus_scrape_unit_address": address,
+                                        "prometheus_scrape_unit_name": self.unit.name})
+            if self.unit.is_leader():
+                job = {"metrics_path": "/metrics",
+                       "static_configs": [{"targets": [f"*:{self.config['metrics-port']}"]}]}
+                rel.data[self.app].update({
+                    "scrape_jobs": json.dumps([job]),
+                    "scrape_metadata": json.dumps({"model": self.model.name,
+                                                   "model_uuid": self.model.uuid,
+                                                   "application": self.app.name,
+                                                   "unit": self.unit.name})})
+
+    def _publish_api_endpoint(self, relation=None):
+        """
+        Tell the co-located ipfs-cluster where our HTTP API is, over the ipfs relation.
+
+        The socket is only handed out once the daemon listens on it, until then
+        (api-socket just set, no restart yet) the cluster keeps using TCP.
+        """
+        multiaddr = url_multiaddr(self.config["ipfs-api-url"])
+        if self.config["api-socket"] and API_SOCKET.is_socket():
+            multiaddr = f"/unix{API_SOCKET}"
+
+        relations = [relation] if relation else self.model.relations["ipfs"]
+        for rel in relations:
+            if rel.data[self.unit].get("api-multiaddr") != multiaddr:
+                logger.info(f"{EMOJI_MESSAGE} Publishing ipfs API {multiaddr} to {rel.name}")
+                rel.data[self.unit].update({"api-multiaddr": multiaddr})
 
     def _reconfig_ipfs(self, restart=False):
         """
-        Reconfigures the startup parameters of hello.service by modifying the /etc/default/hello file.
-        Reloads systemd daemons.
+        Refreshes the snap if the channel changed and reapplies the tuning
+        (/etc/default/ipfs and the repo config).
 
-        Optionally, restart the service.
+        Optionally, restart the service. Returns whether anything changed.
+        """
+        channel = self.config["snap-channel"]
+        refreshed = digests.changed(self._stored.digests, 'snap-channel', channel,
+                                    previous=self._stored.snap_channel)
+        if refreshed:
+            logger.info(f"{EMOJI_MESSAGE} Configuring ipfs-daemon snap-channel: {channel}")
+            hookstats.system(f"snap refresh ipfs --channel={channel}")
+            self._stored.snap_channel = channel
+            digests.record(self._stored.digests, 'snap-channel', channel)
+
+        return self._apply_tuning(restart=restart) or refreshed
+
+    def _render(self, path, content):
         """
-        logger.info(f"{EMOJI_MESSAGE} Configuring ipfs-daemon snap-channel: {self._stored.snap_channel}")
-        self._stored.snap_channel = self.config["snap-channel"]
-        os.system(f"snap refresh ipfs --channel={self._stored.snap_channel}")
+        Write a rendered file if its digest changed, logging the diff. Returns whether it wrote.
 
-        with open('/etc/default/ipfs', 'w') as f:
-            f.write(f"CUSTOM_ARGS=\\'daemon\\'")
-        os.system('systemctl daemon-reload')
+        A file that already holds content (say, after an upgrade from a charm without
+        digests) only gets its digest recorded.
+        """
+        # Digests are keyed by the path as a string.
+        path = str(path)
+        exists = os.path.exists(path)
+        if exists and not digests.changed(self._stored.digests, path, content,
+                                          previous=lambda: Path(path).read_text()):
+            return False
+        wrote = not exists or Path(path).read_text() != content
+        if wrote:
+            files.write_atomic(path, content)
+        digests.record(self._stored.digests, path, content)
+        return wrote
+
+    def _install_daemon_unit(self):
+        """
+        Render ipfs-daemon.service with resource settings sized for this host.
 
-        if restart:
-            logger.info(f"{EMOJI_GREEN_DOT} Restarting hello.")
-            os.system('systemctl restart ipfs-daemon.service')
+        The expected connection count is the ConnMgr HighWater from the tuning.
+        Only reloads systemd when the rendered unit changed. Returns whether it did.
+        """
+        settings = self._tuning() or {}
+        connections = settings.get('connmgr-high-water') or DEFAULT_CONNMGR_HIGH_WATER
+        api_socket = API_SOCKET if self.config["api-socket"] else None
+        unit = systemd_unit.render('templates/etc/systemd/system/ipfs-daemon.service.j2',
+                                   api_socket=api_socket,
+                                   **systemd_unit.compute(systemd_unit.host_resources(),
+                                                          connections, DAEMON_MEMORY_SHARE,
+                                                          self.config))
+        if not self._render(SYSTEMD_DIR / 'ipfs-daemon.service', unit):
+            return False
+        hookstats.system('systemctl daemon-reload')
+        return True
+
+    def _tuning(self):
+        """
+        Resolved tuning settings, or None (and Blocked) if the config is invalid.
+        """
+        try:
+            return tuning.resolve(self.config)
+        except ValueError as e:
+            logger.error(f"Invalid tuning config: {e}")
+            self.unit.status = BlockedStatus(str(e))
+            return None
+
+    def _public_roles(self):
+        """
+        Roles from public-endpoints, or None (and Blocked) if the config is invalid.
+        """
+        try:
+            return upstreams.parse_roles(self.config["public-endpoints"], PUBLIC_ROLES)
+        except ValueError as e:
+            logger.error(f"Invalid public-endpoints: {e}")
+            self.unit.status = BlockedStatus(str(e))
+            return None
+
+    def _init_repo(self):
+        """
+        ipfs init, with the datastore backend from the tuning settings.
+
+        On a storage volume the repo starts empty and gets a datastore layout
+        sized for the volume before the daemon ever opens it.
+        """
+        settings = self._tuning() or {}
+        profile = tuning.init_profile(settings)
+        volume = self._repo_volume()
+        args = (f" --profile={profile}" if profile else "") + (" --empty-repo" if volume else "")
+        logger.debug(f"ipfs init{args}")
+        hookstats.system(f"sudo -u ubuntu ipfs init{args}")
+        # A new repo has none of the tuning or peering yet.
+        self._stored.digests.pop('repo-config', None)
+        self._stored.peering = {}
+
+        if volume and IPFS_CONFIG.exists():
+            backend = settings.get('datastore-backend') or 'flatfs'
+            tuning.apply_datastore_layout(
+                IPFS_REPO, tuning.datastore_layout(backend, storage.volume_size(volume)))
+
+    def _repo_volume(self):
+        """
+        Mount point of the attached ipfs-repo storage, None without one.
+        """
+        volumes = self.model.storages["ipfs-repo"]
+        return volumes[0].location if volumes else None
+
+    def _apply_tuning(self, restart=False):
+        """
+        Write daemon args to /etc/default/ipfs and merge the tuning into the repo config
+        in one atomic write. Restarts only if something changed and restart is set.
+        """
+        settings = self._tuning()
+        public = self._public_roles()
+        if settings is None or public is None:
+            return False
+
+        env = f'CUSTOM_ARGS="{tuning.daemon_args(settings)}"\n'
+        env_changed = self._render(IPFS_DEFAULTS, env)
+        if env_changed:
+            hookstats.system('systemctl daemon-reload')
+
+        # The repo config is only read and merged when its inputs changed.
+        inputs = {'settings': settings, 'api-socket': self.config["api-socket"],
+                  'filestore': self.config["filestore"], 'public-endpoints': sorted(public)}
+        repo_changed = {}
+        if IPFS_CONFIG.exists() and digests.changed(self._stored.digests, 'repo-config', inputs):
+            repo_config = json.loads(IPFS_CONFIG.read_text())
+            api_socket = API_SOCKET if self.config["api-socket"] else None
+            repo = tuning.repo_settings(settings)
+            for role, key in tuning.LISTENER_KEYS.items():
+                repo[key] = upstreams.bind_addresses(tuning.get_key(repo_config, key),
+                                                     role in public)
+            repo['Addresses.API'] = tuning.api_addresses(repo['Addresses.API'], api_socket)
+            repo['Experimental.FilestoreEnabled'] = self.config["filestore"]
+            repo_changed = tuning.apply_repo_config(IPFS_CONFIG, repo)
+            digests.record(self._stored.digests, 'repo-config', inputs)
+            backend = settings.get('datastore-backend')
+            current = tuning.datastore_backend(repo_config)
+            if backend and backend != current:
+                logger.warning(f"Repo uses {current}, datastore-backend {backend} "
+                               "only applies to new repos.")
+
+        if (env_changed or repo_changed) and restart:
+            logger.info(f"{EMOJI_GREEN_DOT} Restarting ipfs-daemon.")
+            hookstats.system('systemctl restart ipfs-daemon.service')
+        return bool(env_changed or repo_changed)
+
+    def _describe_upstreams(self, probed):
+        """
+        Our public listeners as upstream entries in our ipfs-peers unit data, weighted
+        by the API latency (probed, None if it did not answer) and the connection count.
+        """
+        relation = self.model.get_relation("ipfs-peers")
+        if not relation or not IPFS_CONFIG.exists():
+            return
+        with open(IPFS_CONFIG) as f:
+            repo_config = json.load(f)
+        listeners = {role: tuning.get_key(repo_config, key)
+                     for role, key in tuning.LISTENER_KEYS.items()}
+        state, p95 = probed or ('blocked', 0)
+        connections = 0
+        if probed:
+            try:
+                with IpfsApi(self.config["ipfs-api-url"]) as api:
+                    connections = api.swarm_peers_count()
+            except requests.RequestException as e:
+                logger.warning(f"Can't count swarm connections: {e}")
+        high_water = (self._tuning() or {}).get('connmgr-high-water') or \
+            DEFAULT_CONNMGR_HIGH_WATER
+        weight = health.weight(state, p95, self.config["health-degraded-ms"], connections,
+                               high_water)
+        address = str(self.model.get_binding("ipfs").network.ingress_address)
+        own = upstreams.entries(self.unit.name, address, listeners, state, weight)
+        upstreams.update(relation.data[self.unit], {"upstreams": json.dumps(own)})
+
+    def _share_upstreams(self, departed=None):
+        """
+        Hostname and port of our gateway (or API) on every ipfs relation, and from the
+        leader, the upstream entries of every unit in the app data.
+        """
+        relation = self.model.get_relation("ipfs-peers")
+        if not relation:
+            return
+        own = json.loads(relation.data[self.unit].get("upstreams") or "[]")
+        primary = next((entry for entry in own if entry["role"] == "gateway"),
+                       own[0] if own else None)
+        every = upstreams.gather(relation, own, departed) if self.unit.is_leader() else None
+        for rel in self.model.relations["ipfs"]:
+            if primary:
+                upstreams.update(rel.data[self.unit], {"hostname": primary["address"],
+                                                       "port": str(primary["port"])})
+            if every is not None:
+                upstreams.update(rel.data[self.app], {"upstreams": json.dumps(every)})
 
     def _get_ipfs_peerid(self):
-        import json
-        f = open('/home/ubuntu/snap/ipfs/common/config')
-        data = json.load(f)
-        p = data['Identity']['PeerID']
-        print(p)
-        f.close()
-
-            
+        with open(IPFS_CONFIG) as f:
+            return json.load(f)['Identity']['PeerID']
+
+    def _publish_peering(self, relation=None):
+        """
+        Hand our PeerID and swarm multiaddrs to the other units over ipfs-peers.
+        """
+        relation = relation or self.model.get_relation("ipfs-peers")
+        if not relation or not IPFS_CONFIG.exists():
+            return
+        with open(IPFS_CONFIG) as f:
+            repo_config = json.load(f)
+        ip = str(self.model.get_binding(relation).network.ingress_address)
+        data = {"peer-id": self._get_ipfs_peerid(),
+                "multiaddrs": json.dumps(peering.swarm_multiaddrs(
+                    tuning.get_key(repo_config, 'Addresses.Swarm'), ip))}
+        unit_data = relation.data[self.unit]
+        if any(unit_data.get(key) != value for key, value in data.items()):
+            unit_data.update(data)
+
+    def _reconcile_peering(self, relation, departed=None):
+        """
+        Keep Peering.Peers on the other units, in the repo config and on the running daemon.
+        """
+        if not IPFS_CONFIG.exists():
+            return
+        peers = {}
+        for unit in relation.units:
+            if unit == departed:
+                continue
+            peer_id = relation.data[unit].get("peer-id")
+            addrs = json.loads(relation.data[unit].get("multiaddrs") or "[]")
+            if peer_id and addrs:
+                peers[peer_id] = sorted(addrs)
+
+        old = {peer_id: list(addrs) for peer_id, addrs in self._stored.peering.items()}
+        if peers == old:
+            return
+        logger.info(f"{EMOJI_MESSAGE} Peering with {len(peers)} units, was {len(old)}")
+        tuning.apply_repo_config(IPFS_CONFIG, {'Peering.Peers': peering.peering_config(peers)})
+        # No restart, the running daemon gets the same change through swarm/peering.
+        with IpfsApi(self.config["ipfs-api-url"]) as api:
+            peering.apply(api, old, peers)
+        self._stored.peering = peers
+
+
 if __name__ == "__main__":
     main(IPFSCharm)
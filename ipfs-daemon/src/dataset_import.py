@@ -0,0 +1,194 @@
+# Copyright 2021 Erik Lönroth
+# See LICENSE file for licensing details.
+
+"""
+Stream a directory or tarball into the local daemon over its HTTP API.
+
+Files are sent to /api/v0/add in batches, one chunked multipart request per batch,
+and linked into MFS under /imports/<name>. MFS puts the tree back together and
+gives the root CID at the end. Files are read in chunks while the request is sent,
+and a tarball is read front to back in stream mode, so memory use does not depend
+on the size of the dataset.
+
+Progress is the number of files, in walk order, that are done without a gap.
+Resuming skips that many and relinks anything after it that made it into MFS
+already.
+"""
+
+import logging
+import os
+import tarfile
+import threading
+import time
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from itertools import chain, islice
+
+import requests
+
+logger = logging.getLogger(__name__)
+
+MIB = 1024 * 1024
+MFS_ROOT = '/imports'
+
+Entry = namedtuple('Entry', 'path size open abspath')
+
+
+def source_id(source, params):
+    """
+    A checkpoint only applies to the same source added the same way,
+    other add options give other CIDs.
+    """
+    st = os.stat(source)
+    mtime = '' if os.path.isdir(source) else st.st_mtime_ns
+    options = ','.join(f"{key}={params[key]}" for key in sorted(params))
+    return f"{os.path.realpath(source)}:{st.st_size}:{mtime}:{options}"
+
+
+def _dir_entries(root):
+    for dirpath, dirnames, filenames in os.walk(root):
+        dirnames.sort()
+        for name in sorted(filenames):
+            path = os.path.join(dirpath, name)
+            if os.path.islink(path) or not os.path.isfile(path):
+                continue
+            yield Entry(os.path.relpath(path, root), os.path.getsize(path),
+                        lambda path=path: open(path, 'rb'), os.path.abspath(path))
+
+
+def _tar_entries(tar):
+    for member in tar:
+        if member.isfile():
+            yield Entry(os.path.normpath(member.name).lstrip('/'), member.size,
+                        lambda member=member: tar.extractfile(member), None)
+
+
+def _chunks(entry, counter):
+    with entry.open() as f:
+        while True:
+            chunk = f.read(MIB)
+            if not chunk:
+                return
+            counter.add(len(chunk))
+            yield chunk
+
+
+class _Counter:
+    def __init__(self):
+        self.value = 0
+        self.lock = threading.Lock()
+
+    def add(self, n):
+        with self.lock:
+            self.value += n
+
+
+def _add_batch(api, batch, target, counter, timeout, params):
+    """
+    Add one batch in a single request, then link every file into MFS.
+
+    Parts are named by their position in the batch, paths can hold characters
+    the multipart filename can't.
+    """
+    paths = []
+
+    def parts():
+        for i, entry in enumerate(batch):
+            paths.append(entry.path)
+            headers = {'Abspath': entry.abspath} if params.get('nocopy') else None
+            yield str(i), _chunks(entry, counter), headers
+
+    added = {item['Name']: item['Hash'] for item in api.add(parts(), timeout=timeout, **params)}
+
+    for parent in sorted({os.path.dirname(path) for path in paths}):
+        api.call('files/mkdir', arg=f"{target}/{parent}".rstrip('/'), parents=True,
+                 flush=False)
+    for i, path in enumerate(paths):
+        try:
+            api.call('files/cp', arg=[f"/ipfs/{added[str(i)]}", f"{target}/{path}"],
+                     flush=False)
+        except requests.HTTPError as e:
+            # Added and linked by a run that was interrupted after it.
+            if 'already has entry' not in e.response.text:
+                raise
+    return len(paths)
+
+
+def run(api, source, name, done=0, batch_size=64, parallelism=4, chunker='size-262144',
+        raw_leaves=True, cid_version=1, nocopy=False, pin=True, timeout=600, checkpoint=None,
+        progress=None):
+    """
+    Import source (a directory or a tar, optionally compressed) as MFS_ROOT/name.
+
+    done files are skipped. checkpoint(done) and progress(stats) are called after
+    every batch that extends the gap free run of finished files. With pin the root
+    gets pinned at the end. Returns the root CID with byte and file counts.
+    """
+    if batch_size <= 0 or parallelism <= 0:
+        raise ValueError("batch-size and parallelism must be positive")
+    params = {'chunker': chunker, 'raw_leaves': raw_leaves or nocopy, 'cid_version': cid_version,
+              'nocopy': nocopy or None, 'pin': False}
+    target = f"{MFS_ROOT}/{name}"
+    api.call('files/mkdir', arg=target, parents=True)
+
+    tar = None
+    if os.path.isdir(source):
+        entries = _dir_entries(source)
+    elif nocopy:
+        raise ValueError("nocopy needs a directory, the filestore refers to files on disk")
+    else:
+        # Stream mode reads members in order, the batches have to go one by one.
+        try:
+            tar = tarfile.open(source, 'r|*')
+        except tarfile.TarError as e:
+            raise ValueError(f"{source} is neither a directory nor a tarball: {e}")
+        entries = _tar_entries(tar)
+        parallelism = 1
+
+    counter = _Counter()
+    files = 0
+    started = time.monotonic()
+    entries = islice(entries, done, None)
+
+    def stats():
+        seconds = time.monotonic() - started
+        return {'files': files, 'bytes': counter.value,
+                'mb-per-s': round(counter.value / MIB / seconds, 2) if seconds else 0}
+
+    def finished(count):
+        nonlocal done, files
+        done += count
+        files += count
+        # Make what is linked so far durable before it counts as done.
+        api.call('files/flush', arg=target)
+        if checkpoint:
+            checkpoint(done)
+        if progress:
+            progress(stats())
+
+    try:
+        if parallelism == 1:
+            for first in entries:
+                # Lazy, a tar member can only be read before the stream moves on.
+                batch = chain([first], islice(entries, batch_size - 1))
+                finished(_add_batch(api, batch, target, counter, timeout, params))
+        else:
+            with ThreadPoolExecutor(max_workers=parallelism) as pool:
+                batches = iter(lambda: list(islice(entries, batch_size)), [])
+                # Keep two batches per worker in flight, not the whole tree.
+                window = []
+                for batch in batches:
+                    window.append(pool.submit(_add_batch, api, batch, target, counter,
+                                              timeout, params))
+                    if len(window) >= 2 * parallelism:
+                        finished(window.pop(0).result())
+                for future in window:
+                    finished(future.result())
+    finally:
+        if tar:
+            tar.close()
+
+    root = api.call('files/stat', arg=target)['Hash']
+    if pin:
+        api.call('pin/add', arg=root, timeout=timeout)
+    return dict(stats(), root=root, done=done, seconds=round(time.monotonic() - started, 1))
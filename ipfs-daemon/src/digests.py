@@ -0,0 +1,57 @@
+# Copyright 2021 Erik Lönroth
+# See LICENSE file for licensing details.
+
+"""
+Digests of the inputs the charm applies, to tell which of them changed.
+
+Every input (a rendered file, the repo settings, the snap channel) is hashed as
+canonical JSON and compared with the digest stored when it was last applied, so
+a hook only refreshes, reloads or restarts for what actually changed.
+"""
+
+import difflib
+import hashlib
+import json
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+def digest(value):
+    return hashlib.sha256(json.dumps(value, sort_keys=True, default=str).encode()).hexdigest()
+
+
+def diff(old, new):
+    """
+    What changed between old and new: per key for dicts, per line for text.
+    """
+    if isinstance(old, dict) and isinstance(new, dict):
+        return {key: [old.get(key), new.get(key)]
+                for key in sorted(set(old) | set(new)) if old.get(key) != new.get(key)}
+    if isinstance(old, str) and isinstance(new, str):
+        return [line for line in difflib.unified_diff(old.splitlines(), new.splitlines(),
+                                                      lineterm='', n=0)
+                if line[:1] in '+-' and line[:3] not in ('+++', '---')]
+    return [old, new]
+
+
+def changed(digests, name, value, previous=None):
+    """
+    Whether value differs from what was last recorded for name.
+
+    digests is the stored name -> digest mapping. A change is logged as one JSON
+    line, with a diff against previous (a value, or a callable returning it) if given.
+    """
+    new = digest(value)
+    old = digests.get(name)
+    if old == new:
+        return False
+    entry = {'input': name, 'old': old[:12] if old else None, 'new': new[:12]}
+    if previous is not None:
+        entry['diff'] = diff(previous() if callable(previous) else previous, value)
+    logger.info(f"Input changed: {json.dumps(entry, default=str)}")
+    return True
+
+
+def record(digests, name, value):
+    digests[name] = digest(value)
@@ -0,0 +1,136 @@
+# Copyright 2021 Erik Lönroth
+# See LICENSE file for licensing details.
+
+import json
+import logging
+import uuid
+from urllib.parse import quote, urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_API_URL = "http://127.0.0.1:5001"
+DEFAULT_TIMEOUT = 5
+
+
+def url_multiaddr(url):
+    """
+    http://127.0.0.1:5001 -> /ip4/127.0.0.1/tcp/5001
+    """
+    parts = urlsplit(url)
+    host = parts.hostname
+    if ':' in host:
+        proto = 'ip6'
+    elif host.replace('.', '').isdigit():
+        proto = 'ip4'
+    else:
+        proto = 'dns4'
+    return f"/{proto}/{host}/tcp/{parts.port or 5001}"
+
+
+class IpfsApi:
+    """
+    Thin client for the ipfs daemon HTTP API (/api/v0).
+
+    Keeps one keep-alive session around so repeated calls don't pay for a new
+    TCP connection (or an ipfs subprocess) each time. Every call gets its own timeout.
+    """
+
+    def __init__(self, url=DEFAULT_API_URL, timeout=DEFAULT_TIMEOUT, pool_size=4):
+        self.url = url.rstrip('/')
+        self.timeout = timeout
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def close(self):
+        self.session.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    @staticmethod
+    def _params(params):
+        # The API wants lowercase true/false and dashed option names.
+        return {key.replace('_', '-'): str(value).lower() if isinstance(value, bool) else value
+                for key, value in params.items() if value is not None}
+
+    def post(self, command, timeout=None, stream=False, **params):
+        """
+        POST to /api/v0/<command> and return the raw response.
+        """
+        response = self.session.post(f"{self.url}/api/v0/{command}",
+                                     params=self._params(params),
+                                     timeout=timeout or self.timeout,
+                                     stream=stream)
+        response.raise_for_status()
+        return response
+
+    def call(self, command, timeout=None, **params):
+        """
+        POST to /api/v0/<command> and return the decoded JSON body.
+        """
+        return self.post(command, timeout=timeout, **params).json()
+
+    def stats_bw(self, timeout=None):
+        return self.call('stats/bw', timeout=timeout)
+
+    def repo_stat(self, timeout=None):
+        # size-only skips counting objects, which walks the whole blockstore.
+        return self.call('repo/stat', timeout=timeout, size_only=True)
+
+    def swarm_peers_count(self, timeout=None):
+        return len(self.call('swarm/peers', timeout=timeout).get('Peers') or [])
+
+    def bitswap_stat(self, timeout=None):
+        return self.call('bitswap/stat', timeout=timeout)
+
+    def add(self, parts, timeout=None, **params):
+        """
+        Stream parts to /api/v0/add as one chunked multipart request.
+
+        parts is an iterable of (path, chunks, headers) tuples, chunks being an iterable
+        of bytes, or None for a directory. Nothing is read ahead, so memory use does not
+        depend on the size of what is added. Returns the list of added entries.
+        """
+        boundary = uuid.uuid4().hex
+        response = self.session.post(
+            f"{self.url}/api/v0/add", params=self._params(params),
+            data=multipart_stream(boundary, parts),
+            headers={'Content-Type': f'multipart/form-data; boundary={boundary}'},
+            timeout=timeout or self.timeout, stream=True)
+        response.raise_for_status()
+        return [json.loads(line) for line in response.iter_lines() if line]
+
+    def cat(self, cid, timeout=None, chunk_size=256 * 1024):
+        """
+        Read cid back, yielding its content in chunks.
+        """
+        response = self.post('cat', timeout=timeout, stream=True, arg=cid)
+        with response:
+            yield from response.iter_content(chunk_size)
+
+
+def multipart_stream(boundary, parts):
+    """
+    Generate a multipart/form-data body the way the ipfs add command expects it.
+    """
+    for path, chunks, headers in parts:
+        content_type = 'application/x-directory' if chunks is None else 'application/octet-stream'
+        filename = quote(path, safe="")
+        head = (f"--{boundary}\r\n"
+                f'Content-Disposition: form-data; name="file"; filename="{filename}"\r\n'
+                f"Content-Type: {content_type}\r\n")
+        for name, value in (headers or {}).items():
+            head += f"{name}: {value}\r\n"
+        yield (head + "\r\n").encode()
+        for chunk in chunks or ():
+            yield chunk
+        yield b"\r\n"
+    yield f"--{boundary}--\r\n".encode()
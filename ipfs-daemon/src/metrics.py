@@ -0,0 +1,170 @@
+#!/usr/bin/env python3
+# Copyright 2021 Erik Lönroth
+# See LICENSE file for licensing details.
+
+"""
+Collects ipfs daemon (and co-located ipfs-cluster) figures over HTTP and renders them
+in the Prometheus text format. Run as a script it serves them on /metrics.
+"""
+
+import argparse
+import json
+import logging
+from collections import namedtuple
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+import requests
+
+from ipfs_api import IpfsApi, DEFAULT_API_URL, DEFAULT_TIMEOUT
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_METRICS_PORT = 9401
+DEFAULT_CLUSTER_API_URL = "http://127.0.0.1:9094"
+CLUSTER_PIN_ERRORS = ('pin_error', 'unpin_error', 'cluster_error')
+
+Sample = namedtuple('Sample', ['name', 'value', 'help', 'type'])
+
+
+def _collect_ipfs(api):
+    samples = []
+    bw = api.stats_bw()
+    samples += [
+        Sample('ipfs_bw_total_in_bytes', bw['TotalIn'], 'Bytes received since start.', 'counter'),
+        Sample('ipfs_bw_total_out_bytes', bw['TotalOut'], 'Bytes sent since start.', 'counter'),
+        Sample('ipfs_bw_rate_in_bytes', bw['RateIn'], 'Current receive rate, bytes/s.', 'gauge'),
+        Sample('ipfs_bw_rate_out_bytes', bw['RateOut'], 'Current send rate, bytes/s.', 'gauge'),
+    ]
+    repo = api.repo_stat()
+    samples += [
+        Sample('ipfs_repo_size_bytes', repo['RepoSize'], 'Size of the repo.', 'gauge'),
+        Sample('ipfs_repo_storage_max_bytes', repo['StorageMax'],
+               'Datastore.StorageMax of the repo.', 'gauge'),
+    ]
+    samples.append(Sample('ipfs_swarm_peers', api.swarm_peers_count(),
+                          'Connected swarm peers.', 'gauge'))
+    bitswap = api.bitswap_stat()
+    samples += [
+        Sample('ipfs_bitswap_blocks_received', bitswap['BlocksReceived'],
+               'Blocks received by bitswap.', 'counter'),
+        Sample('ipfs_bitswap_blocks_sent', bitswap['BlocksSent'],
+               'Blocks sent by bitswap.', 'counter'),
+        Sample('ipfs_bitswap_dup_blocks_received', bitswap['DupBlksReceived'],
+               'Duplicate blocks received by bitswap.', 'counter'),
+        Sample('ipfs_bitswap_wantlist_length', len(bitswap.get('Wantlist') or []),
+               'Blocks currently wanted.', 'gauge'),
+        Sample('ipfs_bitswap_partners', len(bitswap.get('Peers') or []),
+               'Bitswap partners.', 'gauge'),
+    ]
+    return samples
+
+
+def _json_items(response):
+    # Newer cluster versions stream pins as one JSON object per line.
+    try:
+        body = response.json()
+        return body if isinstance(body, list) else [body]
+    except ValueError:
+        return [json.loads(line) for line in response.text.splitlines() if line.strip()]
+
+
+def _collect_cluster(session, cluster_url, timeout):
+    """
+    Count the local peer's pin tracker queue and errors via the cluster REST API.
+
+    Only pins that are not settled are asked for, so this stays cheap with many pins.
+    """
+    peer_id = session.get(f"{cluster_url}/id", timeout=timeout).json()['id']
+    response = session.get(f"{cluster_url}/pins", timeout=timeout,
+                           params={'filter': ','.join(('queued', 'pinning') + CLUSTER_PIN_ERRORS),
+                                   'local': 'true'})
+    response.raise_for_status()
+    counts = {'queued': 0, 'pinning': 0, 'error': 0}
+    for info in _json_items(response):
+        status = (info.get('peer_map') or {}).get(peer_id, {}).get('status')
+        if status in CLUSTER_PIN_ERRORS:
+            counts['error'] += 1
+        elif status in counts:
+            counts[status] += 1
+    return [
+        Sample('ipfs_cluster_pins_queued', counts['queued'],
+               'Pins waiting in the local pin tracker queue.', 'gauge'),
+        Sample('ipfs_cluster_pins_pinning', counts['pinning'],
+               'Pins the local pin tracker is working on.', 'gauge'),
+        Sample('ipfs_cluster_pin_errors', counts['error'],
+               'Pins in an error state on the local peer.', 'gauge'),
+    ]
+
+
+def collect(api, cluster_url=None, timeout=DEFAULT_TIMEOUT):
+    """
+    Return a list of Samples from the ipfs daemon and, if cluster_url is set, ipfs-cluster.
+
+    A failing source is logged and left out, ipfs_up/ipfs_cluster_up tell which one.
+    """
+    samples = []
+    try:
+        samples += _collect_ipfs(api)
+        samples.append(Sample('ipfs_up', 1, 'ipfs daemon API answered.', 'gauge'))
+    except (requests.RequestException, KeyError, ValueError) as e:
+        logger.warning(f"Failed to collect ipfs metrics: {e}")
+        samples.append(Sample('ipfs_up', 0, 'ipfs daemon API answered.', 'gauge'))
+
+    if cluster_url:
+        try:
+            samples += _collect_cluster(api.session, cluster_url.rstrip('/'), timeout)
+            samples.append(Sample('ipfs_cluster_up', 1, 'ipfs-cluster API answered.', 'gauge'))
+        except (requests.RequestException, KeyError, ValueError) as e:
+            logger.warning(f"Failed to collect ipfs-cluster metrics: {e}")
+            samples.append(Sample('ipfs_cluster_up', 0, 'ipfs-cluster API answered.', 'gauge'))
+    return samples
+
+
+def render_prometheus(samples):
+    """
+    Render samples in the Prometheus text exposition format.
+    """
+    lines = []
+    for sample in samples:
+        lines.append(f"# HELP {sample.name} {sample.help}")
+        lines.append(f"# TYPE {sample.name} {sample.type}")
+        lines.append(f"{sample.name} {sample.value}")
+    return '\n'.join(lines) + '\n'
+
+
+def make_handler(api, cluster_url, timeout):
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split('?')[0] != '/metrics':
+                self.send_error(404)
+                return
+            body = render_prometheus(collect(api, cluster_url, timeout)).encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            logger.debug(format, *args)
+
+    return MetricsHandler
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--listen', default='0.0.0.0')
+    parser.add_argument('--port', type=int, default=DEFAULT_METRICS_PORT)
+    parser.add_argument('--api-url', default=DEFAULT_API_URL)
+    parser.add_argument('--cluster-api-url', default=DEFAULT_CLUSTER_API_URL)
+    parser.add_argument('--timeout', type=float, default=DEFAULT_TIMEOUT)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    api = IpfsApi(args.api_url, timeout=args.timeout)
+    handler = make_handler(api, args.cluster_api_url or None, args.timeout)
+    HTTPServer((args.listen, args.port), handler).serve_forever()
+
+
+if __name__ == "__main__":
+    main()
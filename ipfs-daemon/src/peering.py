@@ -0,0 +1,61 @@
+# Copyright 2021 Erik Lönroth
+# See LICENSE file for licensing details.
+
+"""
+Peering between the ipfs-daemon units of one deployment.
+
+Units swap PeerID and swarm multiaddrs over the ipfs-peers relation. Every unit
+keeps the others in Peering.Peers, which ipfs keeps connected (and reconnects)
+regardless of the connection manager, so bitswap finds blocks on a neighbour
+without a DHT lookup. Changes are applied at runtime through swarm/peering,
+the repo config keeps them over restarts.
+"""
+
+import logging
+
+import requests
+
+logger = logging.getLogger(__name__)
+
+
+def swarm_multiaddrs(swarm_addresses, ip):
+    """
+    The dialable versions of our Addresses.Swarm listeners on ip.
+    """
+    if ':' in ip:
+        proto, wildcard = 'ip6', '::'
+    else:
+        proto, wildcard = 'ip4', '0.0.0.0'
+    addrs = []
+    for listener in swarm_addresses or []:
+        parts = listener.split('/')
+        if len(parts) > 3 and parts[1] == proto and parts[2] in (wildcard, ip):
+            parts[2] = ip
+            addrs.append('/'.join(parts))
+    return addrs
+
+
+def peering_config(peers):
+    """
+    {peer id: [multiaddr]} as Peering.Peers.
+    """
+    return [{'ID': peer_id, 'Addrs': sorted(addrs)} for peer_id, addrs in sorted(peers.items())]
+
+
+def apply(api, old, new):
+    """
+    Add and remove peers on the running daemon to go from old to new.
+
+    Returns False if the daemon refused or did not answer, the repo config then
+    brings it in line at the next start.
+    """
+    try:
+        for peer_id in sorted(set(old) - set(new)):
+            api.call('swarm/peering/rm', arg=peer_id)
+        for peer_id, addrs in sorted(new.items()):
+            if old.get(peer_id) != addrs:
+                api.call('swarm/peering/add', arg=[f"{addr}/p2p/{peer_id}" for addr in addrs])
+    except requests.RequestException as e:
+        logger.warning(f"Could not update peering on the running daemon: {e}")
+        return False
+    return True
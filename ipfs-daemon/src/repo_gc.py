@@ -0,0 +1,175 @@
+# Copyright 2021 Erik Lönroth
+# See LICENSE file for licensing details.
+
+"""
+Watermark driven, IO throttled `ipfs repo gc`.
+
+GC runs inside the daemon process (through its HTTP API), so ionice on a helper
+process would not throttle anything. Instead the daemon unit's cgroup IOWeight is
+lowered for the duration of the run and restored afterwards.
+
+A run can take as long as gc-timeout, far longer than a hook may hold the unit.
+It runs as this module in the ipfs-repo-gc.service oneshot, which leaves its
+result in RESULT for collect() to pick up from a later hook.
+"""
+
+import argparse
+import json
+import logging
+import os
+import signal
+import subprocess
+import sys
+import time
+from datetime import datetime, timezone
+from pathlib import Path
+
+import requests
+
+import files
+import hookstats
+from ipfs_api import IpfsApi, DEFAULT_API_URL
+
+logger = logging.getLogger(__name__)
+
+GC_HISTORY_SIZE = 20
+GC_UNIT = 'ipfs-repo-gc.service'
+RESULT = Path('/var/lib/ipfs-repo-gc/result.json')
+
+
+def usage(api):
+    """
+    (RepoSize, StorageMax) in bytes.
+    """
+    stat = api.repo_stat()
+    return stat['RepoSize'], stat['StorageMax']
+
+
+def parse_window(window):
+    """
+    'HH:MM-HH:MM' -> ((h, m), (h, m)). Raises ValueError.
+    """
+    try:
+        start, end = window.split('-')
+        return tuple(tuple(int(part) for part in t.strip().split(':')) for t in (start, end))
+    except (AttributeError, ValueError):
+        raise ValueError(f"Invalid gc-window '{window}', use HH:MM-HH:MM (UTC)")
+
+
+def in_window(window, now=None):
+    """
+    Is now (UTC) inside window? An empty window is always open, windows may wrap midnight.
+    """
+    if not window:
+        return True
+    start, end = parse_window(window)
+    now = now or datetime.now(timezone.utc)
+    current = (now.hour, now.minute)
+    if start <= end:
+        return start <= current < end
+    return current >= start or current < end
+
+
+def over_watermark(size, storage_max, high_watermark):
+    return bool(high_watermark) and storage_max > 0 and \
+        100.0 * size / storage_max >= high_watermark
+
+
+def _io_weight(unit):
+    try:
+        value = hookstats.check_output(['systemctl', 'show', '-p', 'IOWeight', '--value',
+                                        unit])
+    except (subprocess.CalledProcessError, OSError) as e:
+        # An empty IOWeight= afterwards puts the unit back on the default.
+        logger.warning(f"Can't read the IOWeight of {unit}: {e}")
+        return ''
+    value = value.decode().strip()
+    return value if value.isdigit() else ''
+
+
+def run(api, unit, io_weight, timeout):
+    """
+    Run a full repo gc with the unit's IOWeight lowered to io_weight.
+
+    Returns {'seconds', 'freed', 'removed', 'errors'}.
+    """
+    before, _ = usage(api)
+    original = _io_weight(unit)
+    hookstats.system(f"systemctl set-property --runtime {unit} IOWeight={io_weight}")
+    removed = errors = 0
+    started = time.monotonic()
+    try:
+        response = api.post('repo/gc', timeout=timeout, stream=True, quiet=True)
+        with response:
+            for line in response.iter_lines():
+                if b'"Error"' in line and b'"Error":""' not in line:
+                    errors += 1
+                elif line:
+                    removed += 1
+    finally:
+        seconds = time.monotonic() - started
+        hookstats.system(f"systemctl set-property --runtime {unit} IOWeight={original}")
+
+    after, _ = usage(api)
+    result = {'seconds': round(seconds, 1), 'freed': max(0, before - after),
+              'removed': removed, 'errors': errors}
+    logger.info(f"repo gc took {result['seconds']}s, freed {result['freed']} bytes "
+                f"({removed} blocks, {errors} errors)")
+    return result
+
+
+def record(history, result, trigger):
+    history.append(dict({'at': round(time.time())}, **result, trigger=trigger))
+    while len(history) > GC_HISTORY_SIZE:
+        del history[0]
+
+
+def collect(history, trigger, path=None):
+    """
+    Move the result the GC unit left in path (RESULT) into history. Returns it,
+    None if there was none.
+    """
+    path = Path(path or RESULT)
+    try:
+        text = path.read_text()
+    except FileNotFoundError:
+        return None
+    os.unlink(path)
+    try:
+        result = json.loads(text)
+    except ValueError as e:
+        result = {'error': f"Unreadable GC result: {e}"}
+    record(history, result, trigger)
+    return history[-1]
+
+
+def _stopped(signum, frame):
+    raise TimeoutError("Stopped by systemd, past the unit timeout")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--api-url', default=DEFAULT_API_URL)
+    parser.add_argument('--unit', default='ipfs-daemon.service')
+    parser.add_argument('--io-weight', type=int, default=10)
+    parser.add_argument('--timeout', type=float, default=3600)
+    parser.add_argument('--result', type=Path, default=RESULT)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    # systemd stops us with SIGTERM past TimeoutStartSec, unwind so IOWeight is restored.
+    signal.signal(signal.SIGTERM, _stopped)
+    try:
+        with IpfsApi(args.api_url) as api:
+            result = run(api, args.unit, args.io_weight, args.timeout)
+    except (requests.RequestException, ValueError, TimeoutError) as e:
+        logger.error(f"repo gc failed: {e}")
+        result = {'error': str(e)}
+    result['at'] = round(time.time())
+    args.result.parent.mkdir(parents=True, exist_ok=True)
+    files.write_atomic(args.result, json.dumps(result))
+    return 1 if 'error' in result else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
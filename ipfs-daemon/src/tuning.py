@@ -0,0 +1,256 @@
+# Copyright 2021 Erik Lönroth
+# See LICENSE file for licensing details.
+
+"""
+Performance tuning profiles for the ipfs repo config.
+
+A profile is a set of charm option values. Options set in the charm config win over
+the profile. The result is split in what goes into the repo config (one atomic merge),
+what goes on the daemon command line and what can only be picked at `ipfs init`.
+"""
+
+import json
+import logging
+import os
+
+import files
+
+logger = logging.getLogger(__name__)
+
+PROFILES = {
+    'gateway-high-throughput': {
+        'connmgr-low-water': 600,
+        'connmgr-high-water': 2000,
+        'routing-type': 'dht',
+        'reprovider-strategy': 'all',
+        'reprovider-interval': '12h',
+        'storage-max': '500GB',
+        'gc-period': '1h',
+        'datastore-backend': 'flatfs',
+        'enable-gc': 'true',
+    },
+    'low-memory': {
+        'connmgr-low-water': 20,
+        'connmgr-high-water': 100,
+        'routing-type': 'dhtclient',
+        'reprovider-strategy': 'roots',
+        'reprovider-interval': '24h',
+        'storage-max': '10GB',
+        'gc-period': '1h',
+        'datastore-backend': 'flatfs',
+        'enable-gc': 'true',
+    },
+    'pinning-server': {
+        'connmgr-low-water': 100,
+        'connmgr-high-water': 400,
+        'routing-type': 'dht',
+        'reprovider-strategy': 'pinned',
+        'reprovider-interval': '12h',
+        'storage-max': '1TB',
+        'gc-period': '24h',
+        'datastore-backend': 'badger',
+        'enable-gc': 'false',
+    },
+}
+
+# Charm option -> repo config key.
+REPO_CONFIG_KEYS = {
+    'connmgr-low-water': 'Swarm.ConnMgr.LowWater',
+    'connmgr-high-water': 'Swarm.ConnMgr.HighWater',
+    'storage-max': 'Datastore.StorageMax',
+    'gc-period': 'Datastore.GCPeriod',
+    'routing-type': 'Routing.Type',
+    'reprovider-strategy': 'Reprovider.Strategy',
+    'reprovider-interval': 'Reprovider.Interval',
+}
+
+# Published role -> repo config key of its listeners.
+LISTENER_KEYS = {
+    'gateway': 'Addresses.Gateway',
+    'api': 'Addresses.API',
+}
+
+CHOICES = {
+    'datastore-backend': ('flatfs', 'badger'),
+    'routing-type': ('dht', 'dhtclient', 'dhtserver', 'none'),
+    'reprovider-strategy': ('all', 'pinned', 'roots'),
+    'enable-gc': ('true', 'false'),
+}
+
+OPTIONS = list(REPO_CONFIG_KEYS) + ['datastore-backend', 'enable-gc']
+
+GIB = 1024 ** 3
+TIB = 1024 ** 4
+
+# Datastore spec option -> the datastore type it belongs to.
+LAYOUT_TYPES = {'shardFunc': 'flatfs', 'vlogFileSize': 'badgerds'}
+
+# `ipfs init --profile` for each datastore backend.
+INIT_PROFILES = {'flatfs': 'flatfs', 'badger': 'badgerds'}
+
+
+def resolve(config):
+    """
+    Merge the selected profile with the per-key overrides from the charm config.
+
+    Unset overrides (empty strings, zeros) fall back to the profile, options set by
+    neither are left out so ipfs keeps its own default. Raises ValueError on bad input.
+    """
+    profile = config.get('tuning-profile') or ''
+    if profile and profile not in PROFILES:
+        raise ValueError(f"Unknown tuning-profile '{profile}'")
+
+    settings = dict(PROFILES.get(profile, {}))
+    for option in OPTIONS:
+        value = config.get(option)
+        if value not in (None, '', 0):
+            settings[option] = value
+
+    for option, choices in CHOICES.items():
+        if option in settings and settings[option] not in choices:
+            raise ValueError(f"Invalid {option} '{settings[option]}', use one of {choices}")
+    return settings
+
+
+def repo_settings(settings):
+    """
+    The part of the settings that lives in the repo config, as dotted keys.
+    """
+    return {REPO_CONFIG_KEYS[o]: v for o, v in settings.items() if o in REPO_CONFIG_KEYS}
+
+
+def daemon_args(settings):
+    args = ['daemon']
+    if settings.get('enable-gc') == 'true':
+        args.append('--enable-gc')
+    return ' '.join(args)
+
+
+def init_profile(settings):
+    return INIT_PROFILES.get(settings.get('datastore-backend'))
+
+
+def datastore_backend(repo_config):
+    """
+    Which backend an existing repo was initialized with.
+    """
+    spec = json.dumps(repo_config.get('Datastore', {}).get('Spec', {}))
+    return 'badger' if 'badgerds' in spec else 'flatfs'
+
+
+def datastore_layout(backend, volume_bytes):
+    """
+    Datastore options that suit a repo on a volume of volume_bytes.
+
+    flatfs keeps one file per block, past a couple of TiB a three character shard
+    keeps directories at a sane size. Badger's value log files are preallocated,
+    smaller ones waste less of a small volume.
+    """
+    if backend == 'badger':
+        return {'vlogFileSize': '256MiB' if volume_bytes < 200 * GIB else '1GiB'}
+    shard = 3 if volume_bytes >= 2 * TIB else 2
+    return {'shardFunc': f"/repo/flatfs/shard/v1/next-to-last/{shard}"}
+
+
+def _apply_layout(node, layout):
+    if isinstance(node, list):
+        for child in node:
+            _apply_layout(child, layout)
+    elif isinstance(node, dict):
+        for option, value in layout.items():
+            if node.get('type') == LAYOUT_TYPES[option]:
+                node[option] = value
+        for child in node.values():
+            _apply_layout(child, layout)
+
+
+def spec_json(spec):
+    """
+    datastore_spec as go-ipfs writes it, which it compares as a string on every start.
+
+    That is Go's json.Marshal of the spec: keys sorted, no spaces, no newline.
+    """
+    return json.dumps(spec, sort_keys=True, separators=(',', ':'))
+
+
+def apply_datastore_layout(repo, layout):
+    """
+    Apply layout to a freshly initialized (empty) repo.
+
+    The datastore spec lives in the config, in datastore_spec (the on-disk part) and
+    for flatfs in blocks/SHARDING, all of them have to agree. Refuses to touch a
+    blockstore that already holds blocks, those would need a conversion.
+    """
+    blocks = os.path.join(repo, 'blocks')
+    if os.path.isdir(blocks) and any(entry.is_dir() for entry in os.scandir(blocks)):
+        logger.warning(f"{blocks} already holds blocks, keeping its layout.")
+        return False
+
+    # Only the shard function is part of the on-disk spec.
+    disk_layout = {k: v for k, v in layout.items() if k == 'shardFunc'}
+    for name, options in (('config', layout), ('datastore_spec', disk_layout)):
+        path = os.path.join(repo, name)
+        with open(path) as f:
+            data = json.load(f)
+        _apply_layout(data, options)
+        files.write_atomic(path, json.dumps(data, indent=2) if name == 'config'
+                           else spec_json(data))
+
+    sharding = os.path.join(blocks, 'SHARDING')
+    if 'shardFunc' in layout and os.path.exists(sharding):
+        files.write_atomic(sharding, layout['shardFunc'] + '\n')
+    logger.info(f"Applied datastore layout {layout} to {repo}")
+    return True
+
+
+def api_addresses(current, socket_path=None):
+    """
+    Addresses.API with a unix socket listener added or taken away.
+
+    The TCP listeners already configured are kept as they are. A single address
+    stays a plain string, the way `ipfs init` writes it.
+    """
+    addresses = current if isinstance(current, list) else [current] if current else []
+    addresses = [a for a in addresses if not a.startswith('/unix/')]
+    if not addresses:
+        return current
+    if socket_path:
+        addresses.append(f"/unix{socket_path}")
+    return addresses[0] if len(addresses) == 1 else addresses
+
+
+def get_key(data, dotted):
+    for part in dotted.split('.'):
+        if not isinstance(data, dict) or part not in data:
+            return None
+        data = data[part]
+    return data
+
+
+def set_key(data, dotted, value):
+    parts = dotted.split('.')
+    for part in parts[:-1]:
+        data = data.setdefault(part, {})
+    data[parts[-1]] = value
+
+
+def apply_repo_config(path, settings):
+    """
+    Merge dotted settings into the repo config at path in one atomic write.
+
+    Returns {key: (old, new)} for the keys that changed, nothing is written if empty.
+    """
+    with open(path) as f:
+        data = json.load(f)
+
+    changed = {}
+    for key, value in settings.items():
+        old = get_key(data, key)
+        if old != value:
+            changed[key] = (old, value)
+            set_key(data, key, value)
+
+    if changed:
+        files.write_atomic(path, json.dumps(data, indent=2) + '\n')
+        logger.info(f"Updated {path}: {changed}")
+    return changed
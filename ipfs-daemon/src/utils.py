@@ -1,5 +1,8 @@
-import subprocess
+import hookstats
+
+IPFS_BINARY = '/snap/ipfs/current'
+
 
 def getIpfsVersion():
-    resp = subprocess.check_output(['ipfs','--version']).decode()
-    return resp.rstrip().rpartition(' ')[-1] # Get the version
+    resp = hookstats.check_output(['ipfs', '--version']).decode()
+    return resp.rstrip().rpartition(' ')[-1]  # Get the version
@@ -0,0 +1,9 @@
+# Copyright 2021 Erik Lönroth
+# See LICENSE file for licensing details.
+
+import sys
+from pathlib import Path
+
+# The modules both charms share live in the top-level lib/, `make` vendors them into
+# the charm's lib/ at build time. Test against the source rather than a stale copy.
+sys.path.insert(0, str(Path(__file__).resolve().parents[2] / 'lib'))
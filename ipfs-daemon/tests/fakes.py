@@ -0,0 +1,193 @@
+# Copyright 2021 Erik Lönroth
+# See LICENSE file for licensing details.
+
+"""
+Stand-ins for what the charm reaches outside of Juju on a real unit.
+
+FakeHost puts every path the charm uses (the ipfs repo, the systemd units,
+/etc/default/ipfs, fstab) under a temporary root, answers the commands run through
+hookstats like systemctl, snap and ipfs would, and serves the ipfs HTTP API from
+FakeApi. Hooks then run unchanged in a Harness.
+"""
+
+import json
+import os
+import shlex
+import subprocess
+import tempfile
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from unittest.mock import Mock, patch
+from urllib.parse import parse_qs, urlparse
+
+
+def peer_id(n):
+    return f"12D3KooWFakePeer{n:036d}"
+
+
+class _ApiHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # Headers and body go out in separate writes, don't let them wait for an ACK.
+    disable_nagle_algorithm = True
+
+    def _answer(self):
+        url = urlparse(self.path)
+        length = int(self.headers.get('Content-Length') or 0)
+        if length:
+            self.rfile.read(length)
+        with self.server.lock:
+            self.server.requests += 1
+        route = self.server.routes.get(url.path.rstrip('/'), {})
+        body = route(parse_qs(url.query)) if callable(route) else route
+        data = json.dumps(body).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    do_GET = do_POST = do_DELETE = _answer
+
+    def log_message(self, format, *args):
+        pass
+
+
+class FakeApi(ThreadingHTTPServer):
+    """
+    Answers every request with the JSON routes holds for its path, {} for any other
+    path, and counts them. A route can be a function of the query parameters.
+    """
+
+    def __init__(self, routes=None):
+        super().__init__(('127.0.0.1', 0), _ApiHandler)
+        self.routes = routes or {}
+        self.requests = 0
+        self.lock = threading.Lock()
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server_address[1]}"
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+class FakeHost:
+    """
+    A unit's host under a temporary root, for the lifetime of testcase.
+    """
+
+    def __init__(self, testcase, version='0.12.0'):
+        tmp = tempfile.TemporaryDirectory()
+        testcase.addCleanup(tmp.cleanup)
+        self.root = Path(tmp.name)
+        self.version = version
+        self.running = set()
+        # Every command line run through os.system or subprocess.run, in order.
+        self.commands = []
+        # Programs that exit 1, like a mount that fails.
+        self.failing = set()
+        self.api = FakeApi({'/api/v0/id': {'ID': peer_id(0)},
+                            '/api/v0/repo/stat': {'RepoSize': 1 << 30, 'StorageMax': 10 << 30},
+                            '/api/v0/stats/bw': {'TotalIn': 0, 'TotalOut': 0,
+                                                 'RateIn': 0.0, 'RateOut': 0.0},
+                            '/api/v0/swarm/peers': {'Peers': []},
+                            '/api/v0/bitswap/stat': {'BlocksReceived': 0, 'BlocksSent': 0,
+                                                     'DupBlksReceived': 0}})
+        testcase.addCleanup(self.api.stop)
+
+        self.repo = self.root / 'home/ubuntu/snap/ipfs/common'
+        self.repo.mkdir(parents=True)
+        etc = self.root / 'etc'
+        (etc / 'systemd/system').mkdir(parents=True)
+        (etc / 'default').mkdir()
+        (etc / 'fstab').touch()
+        (self.root / 'proc').mkdir()
+        (self.root / 'proc/mounts').touch()
+        (self.root / 'snap/ipfs').mkdir(parents=True)
+        (self.root / 'snap/ipfs/current').touch()
+
+        binding = Mock()
+        binding.network.bind_address = '10.0.0.1'
+        binding.network.ingress_address = '10.0.0.1'
+        patches = [
+            patch('os.system', self.system),
+            patch('subprocess.check_output', self.check_output),
+            patch('subprocess.run', self.run),
+            # There is no ubuntu user to hand files to.
+            patch('shutil.chown'),
+            patch('ops.model.Model.get_binding', return_value=binding),
+            patch('charm.IPFS_REPO', self.repo),
+            patch('charm.IPFS_CONFIG', self.repo / 'config'),
+            patch('charm.API_SOCKET', self.repo / 'api.sock'),
+            patch('charm.SYSTEMD_DIR', etc / 'systemd/system'),
+            patch('charm.IPFS_DEFAULTS', etc / 'default/ipfs'),
+            patch('utils.IPFS_BINARY', str(self.root / 'snap/ipfs/current')),
+            patch('repo_gc.RESULT', self.root / 'var/lib/ipfs-repo-gc/result.json'),
+            patch('storage.FSTAB', str(etc / 'fstab')),
+            patch('storage.PROC_MOUNTS', str(self.root / 'proc/mounts')),
+        ]
+        for p in patches:
+            p.start()
+            testcase.addCleanup(p.stop)
+
+    def _init(self):
+        flatfs = {'type': 'flatfs', 'path': 'blocks', 'sync': True,
+                  'shardFunc': '/repo/flatfs/shard/v1/next-to-last/2'}
+        leveldb = {'type': 'levelds', 'path': 'datastore', 'compression': 'none'}
+        config = {'Identity': {'PeerID': peer_id(0)},
+                  'Addresses': {'API': '/ip4/127.0.0.1/tcp/5001',
+                                'Swarm': ['/ip4/0.0.0.0/tcp/4001', '/ip6/::/tcp/4001']},
+                  'Datastore': {'StorageMax': '10GB', 'Spec': {'type': 'mount', 'mounts': [
+                      {'mountpoint': '/blocks', 'type': 'measure', 'prefix': 'flatfs.datastore',
+                       'child': flatfs},
+                      {'mountpoint': '/', 'type': 'measure', 'prefix': 'leveldb.datastore',
+                       'child': leveldb}]}},
+                  'Peering': {'Peers': None}}
+        (self.repo / 'config').write_text(json.dumps(config, indent=2))
+        # Byte for byte what ipfs init writes, go-ipfs compares it as a string.
+        (self.repo / 'datastore_spec').write_text(
+            '{"mounts":[{"mountpoint":"/blocks","path":"blocks",'
+            '"shardFunc":"/repo/flatfs/shard/v1/next-to-last/2","type":"flatfs"},'
+            '{"mountpoint":"/","path":"datastore","type":"levelds"}],"type":"mount"}')
+
+    def system(self, cmd):
+        self.commands.append(cmd)
+        argv = shlex.split(cmd)
+        if argv[:2] == ['sudo', '-u']:
+            argv = argv[3:]
+        program = os.path.basename(argv[0])
+        if program == 'systemctl':
+            verb, unit = argv[1], argv[-1]
+            if verb == 'is-active':
+                # os.system returns the wait status, is-active exits 3 when inactive.
+                return 0 if unit in self.running else 3 << 8
+            if verb in ('start', 'restart'):
+                self.running.add(unit)
+            elif verb == 'stop':
+                self.running.discard(unit)
+        elif program == 'ipfs' and argv[1:2] == ['init']:
+            self._init()
+        return 0
+
+    def check_output(self, args, **kwargs):
+        if args[-1] == '--version':
+            return f"{os.path.basename(args[0])} version {self.version}\n".encode()
+        if args[:2] == ['systemctl', 'show']:
+            return b'100\n'
+        return b''
+
+    def run(self, args, **kwargs):
+        self.commands.append(shlex.join(args))
+        if args[0] in self.failing:
+            if kwargs.get('check'):
+                raise subprocess.CalledProcessError(1, args)
+            return subprocess.CompletedProcess(args, 1, b'', b'')
+        if args[:2] == ['systemctl', 'show'] and 'ActiveState' in args:
+            # Started oneshots keep running until the test takes them out of running.
+            state = 'activating' if args[-1] in self.running else 'inactive'
+            return subprocess.CompletedProcess(args, 0, f"{state}\n".encode(), b'')
+        return subprocess.CompletedProcess(args, 0, b'', b'')
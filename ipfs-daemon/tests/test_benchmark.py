@@ -0,0 +1,79 @@
+# Copyright 2021 Erik Lönroth
+# See LICENSE file for licensing details.
+
+import hashlib
+import json
+import threading
+import unittest
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import benchmark
+from ipfs_api import IpfsApi
+
+
+class StubAddCatHandler(BaseHTTPRequestHandler):
+    """
+    Just enough of /api/v0/add (chunked multipart, one file) and /api/v0/cat.
+    """
+    protocol_version = 'HTTP/1.1'
+
+    def _read_chunked(self):
+        body = b''
+        while True:
+            size = int(self.rfile.readline().strip(), 16)
+            if not size:
+                self.rfile.readline()
+                return body
+            body += self.rfile.read(size)
+            self.rfile.readline()
+
+    def _send(self, data):
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        params = parse_qs(url.query)
+        if url.path == '/api/v0/add':
+            self.server.params.append(params)
+            body = self._read_chunked()
+            content = body.split(b'\r\n\r\n', 1)[1].rsplit(b'\r\n--', 1)[0]
+            cid = 'bafy' + hashlib.sha256(content).hexdigest()[:16]
+            self.server.blocks[cid] = content
+            self._send(json.dumps({'Name': cid, 'Hash': cid, 'Size': len(content)}).encode())
+        elif url.path == '/api/v0/cat':
+            self._send(self.server.blocks[params['arg'][0]])
+        else:
+            self.send_error(404)
+
+    def log_message(self, *args):
+        pass
+
+
+class TestBenchmark(unittest.TestCase):
+    def setUp(self):
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), StubAddCatHandler)
+        self.server.blocks, self.server.params = {}, []
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+        self.api = IpfsApi(f"http://127.0.0.1:{self.server.server_port}", pool_size=2)
+        self.addCleanup(self.api.close)
+
+    def test_add_and_cat_round_trip(self):
+        results = benchmark.run(self.api, size_mb=2, file_count=4, chunker='size-1048576',
+                                raw_leaves=True, cid_version=1, concurrency=2)
+        self.assertEqual(results['files'], 4)
+        self.assertEqual(results['file-size-bytes'], 512 * 1024)
+        self.assertEqual(len(self.server.blocks), 4)
+        self.assertGreater(results['cat']['mb-per-s'], 0)
+        self.assertEqual(self.server.params[0]['chunker'], ['size-1048576'])
+        self.assertEqual(self.server.params[0]['raw-leaves'], ['true'])
+        self.assertEqual(self.server.params[0]['pin'], ['false'])
+
+    def test_rejects_bad_parameters(self):
+        with self.assertRaises(ValueError):
+            benchmark.run(self.api, 0, 1, 'size-262144', True, 1, 1)
@@ -3,16 +3,103 @@
 #
 # Learn more about testing at: https://juju.is/docs/sdk/testing
 
+import json
+import socket
 import unittest
-from unittest.mock import Mock
+from unittest.mock import Mock, patch
 
-from charm import GitlabRunnerCharm
+import charm as charm_module
+from charm import IPFSCharm
+from ipfs_api import url_multiaddr
 from ops.model import ActiveStatus
 from ops.testing import Harness
 
+import repo_gc
+from tests import fakes
+
 
 class TestCharm(unittest.TestCase):
     def setUp(self):
-        self.harness = Harness(GitlabRunnerCharm)
+        self.host = fakes.FakeHost(self)
+        self.harness = Harness(IPFSCharm)
+        self.addCleanup(self.harness.cleanup)
+        self.harness.update_config({'ipfs-api-url': self.host.api.url, 'cluster-api-url': ''})
+        self.harness.begin()
+        self.charm = self.harness.charm
+        self.charm.on.install.emit()
+        self.charm.on.config_changed.emit()
+        self.charm.on.start.emit()
+
+    def test_gc_runs_outside_the_hook(self):
+        self.host.api.routes['/api/v0/repo/stat'] = {'RepoSize': 95, 'StorageMax': 100}
+        self.charm.on.update_status.emit()
+        self.assertIn(repo_gc.GC_UNIT, self.host.running)
+        self.assertIsInstance(self.charm.unit.status, ActiveStatus)
+        self.assertEqual(self.charm.unit.status.message, "Running. Repo GC running.")
+
+        # Still running, not started again.
+        self.charm.on.update_status.emit()
+        self.assertEqual(self.charm._stored.gc_history, [])
+
+        # As the oneshot leaves it.
+        self.host.running.discard(repo_gc.GC_UNIT)
+        repo_gc.RESULT.parent.mkdir(parents=True)
+        repo_gc.RESULT.write_text(json.dumps({'seconds': 12.5, 'freed': 40, 'removed': 3,
+                                              'errors': 0, 'at': 1}))
+        self.host.api.routes['/api/v0/repo/stat'] = {'RepoSize': 55, 'StorageMax': 100}
+        self.charm.on.update_status.emit()
+        self.assertEqual(self.charm.unit.status.message, "Running.")
+        last = self.charm._stored.gc_history[-1]
+        self.assertEqual((last['freed'], last['trigger']), (40, 'watermark'))
+        self.assertFalse(repo_gc.RESULT.exists())
+
+    def test_gc_action_only_starts_it(self):
+        event = Mock(params={})
+        self.charm._on_gc_action(event)
+        self.assertIn(repo_gc.GC_UNIT, self.host.running)
+        self.assertEqual(event.set_results.call_args.args[0]['started'], repo_gc.GC_UNIT)
+
+        self.charm._on_gc_action(event)
+        event.fail.assert_called_once()
+
+    def test_a_garbled_answer_counts_as_no_answer(self):
+        with patch('charm.IpfsApi.call', side_effect=ValueError("Expecting value")):
+            self.assertIsNone(self.charm._probe_health())
+
+
+class TestApiEndpoint(unittest.TestCase):
+    def _deploy(self, leader):
+        self.host = fakes.FakeHost(self)
+        self.harness = Harness(IPFSCharm)
         self.addCleanup(self.harness.cleanup)
-        self.harness.begin()
\ No newline at end of file
+        self.harness.update_config({'ipfs-api-url': self.host.api.url, 'cluster-api-url': ''})
+        self.rel = self.harness.add_relation('ipfs', 'ipfs-cluster')
+        self.harness.set_leader(leader)
+        self.harness.begin()
+        self.charm = self.harness.charm
+        self.charm.on.install.emit()
+        self.charm.on.start.emit()
+        self.harness.add_relation_unit(self.rel, 'ipfs-cluster/0')
+
+    def _published(self):
+        return self.harness.get_relation_data(self.rel, self.charm.unit.name).get('api-multiaddr')
+
+    def test_published_on_leader_and_follower(self):
+        for leader in (True, False):
+            with self.subTest(leader=leader):
+                self._deploy(leader)
+                self.assertEqual(self._published(), url_multiaddr(self.host.api.url))
+
+    def test_socket_is_published_once_the_daemon_listens_on_it(self):
+        for leader in (True, False):
+            with self.subTest(leader=leader):
+                self._deploy(leader)
+                self.harness.update_config({'api-socket': True})
+                self.charm.on.update_status.emit()
+                self.assertEqual(self._published(), url_multiaddr(self.host.api.url))
+
+                listener = socket.socket(socket.AF_UNIX)
+                self.addCleanup(listener.close)
+                listener.bind(str(charm_module.API_SOCKET))
+                self.charm.on.update_status.emit()
+                self.assertEqual(self._published(), f"/unix{charm_module.API_SOCKET}")
@@ -0,0 +1,78 @@
+# Copyright 2021 Erik Lönroth
+# See LICENSE file for licensing details.
+
+import hashlib
+import os
+import tarfile
+import tempfile
+import threading
+import unittest
+
+import dataset_import
+
+
+class FakeApi:
+    """
+    add hashes what it is sent, MFS is a dict of path -> hash.
+    """
+    def __init__(self):
+        self.mfs = {}
+        self.adds = 0
+        self.lock = threading.Lock()
+
+    def add(self, parts, timeout=None, **params):
+        added = []
+        for name, chunks, headers in parts:
+            digest = hashlib.sha256(b''.join(chunks)).hexdigest()
+            added.append({'Name': name, 'Hash': digest})
+        with self.lock:
+            self.adds += 1
+        return added
+
+    def call(self, command, arg=None, **params):
+        if command == 'files/cp':
+            with self.lock:
+                self.mfs[arg[1]] = arg[0]
+        elif command == 'files/stat':
+            return {'Hash': hashlib.sha256(repr(sorted(self.mfs.items())).encode()).hexdigest()}
+        return {}
+
+
+class TestDatasetImport(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        self.root = os.path.join(self.tmp.name, 'dataset')
+        for i in range(10):
+            os.makedirs(os.path.join(self.root, f"d{i % 3}"), exist_ok=True)
+            with open(os.path.join(self.root, f"d{i % 3}", f"f{i}"), 'wb') as f:
+                f.write(os.urandom(1000 + i))
+
+    def test_directory_in_parallel_batches(self):
+        api, checkpoints = FakeApi(), []
+        result = dataset_import.run(api, self.root, 'dataset', batch_size=3, parallelism=2,
+                                    checkpoint=checkpoints.append)
+        self.assertEqual(len(api.mfs), 10)
+        self.assertIn('/imports/dataset/d1/f4', api.mfs)
+        self.assertEqual(checkpoints, [3, 6, 9, 10])
+        self.assertEqual(result['bytes'], sum(1000 + i for i in range(10)))
+        self.assertEqual(api.adds, 4)
+
+    def test_tarball_resume_gives_the_same_root(self):
+        tarball = os.path.join(self.tmp.name, 'dataset.tar.gz')
+        with tarfile.open(tarball, 'w:gz') as tar:
+            tar.add(self.root, arcname='.')
+        full = dataset_import.run(FakeApi(), tarball, 'dataset', batch_size=4)
+
+        api = FakeApi()
+        first = dataset_import.run(api, tarball, 'dataset', batch_size=4, parallelism=1)
+        for path in sorted(api.mfs)[4:]:
+            del api.mfs[path]
+        resumed = dataset_import.run(api, tarball, 'dataset', done=4, batch_size=4)
+        self.assertEqual(resumed['files'], 6)
+        self.assertEqual(resumed['root'], full['root'])
+        self.assertEqual(first['root'], full['root'])
+
+    def test_nocopy_needs_a_directory(self):
+        with self.assertRaises(ValueError):
+            dataset_import.run(FakeApi(), __file__, 'x', nocopy=True)
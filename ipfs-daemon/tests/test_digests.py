@@ -0,0 +1,24 @@
+# Copyright 2021 Erik Lönroth
+# See LICENSE file for licensing details.
+
+import unittest
+
+import digests
+
+
+class TestDigests(unittest.TestCase):
+    def test_only_a_changed_input_counts(self):
+        stored = {}
+        settings = {'connmgr-high-water': 900, 'storage-max': '10GB'}
+        self.assertTrue(digests.changed(stored, 'repo-config', settings))
+        digests.record(stored, 'repo-config', settings)
+        self.assertFalse(digests.changed(stored, 'repo-config', dict(reversed(settings.items()))))
+
+        with self.assertLogs('digests', 'INFO') as logs:
+            self.assertTrue(digests.changed(stored, 'repo-config',
+                                            dict(settings, **{'storage-max': '20GB'}),
+                                            previous=settings))
+        self.assertIn('"diff": {"storage-max": ["10GB", "20GB"]}', logs.output[0])
+
+    def test_text_diff(self):
+        self.assertEqual(digests.diff("a=1\nb=2\n", "a=1\nb=3\n"), ['-b=2', '+b=3'])
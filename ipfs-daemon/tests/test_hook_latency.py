@@ -0,0 +1,131 @@
+# Copyright 2021 Erik Lönroth
+# See LICENSE file for licensing details.
+
+"""
+Hook wall time and external calls against the size of the ipfs-peers relation.
+
+Every hook runs in a Harness on the fakes from tests/fakes.py, with 1, 10 and 100
+peers. With more peers a hook must not run more commands or API requests, and
+must not take more than HOOK_SLOWDOWN times its wall time with one peer (plus
+HOOK_SLACK_MS for the noise on hooks that take next to nothing). No hook may take
+longer than HOOK_BUDGET_MS. The limits are relative so a slow CI machine does not
+trip them, and all of them can be raised from the environment. HOOK_BENCH_REPORT=<file>
+writes what was measured, and the limits, as JSON.
+"""
+
+import json
+import os
+import unittest
+from unittest.mock import patch
+
+from ops.testing import Harness
+
+from charm import IPFSCharm
+from tests import fakes
+
+PEERS = (1, 10, 100)
+# Steady state hooks run this often, the fastest run counts.
+ROUNDS = 3
+HOOK_SLOWDOWN = float(os.environ.get('HOOK_SLOWDOWN', 3))
+HOOK_SLACK_MS = float(os.environ.get('HOOK_SLACK_MS', 10))
+HOOK_BUDGET_MS = float(os.environ.get('HOOK_BUDGET_MS', 1000))
+
+
+class TestHookLatency(unittest.TestCase):
+    def _deploy(self, peers):
+        """
+        Take a leader through its hooks while peers other units join, {hook: measurements}.
+
+        Hooks repeated in steady state, after everything converged, are reported
+        as "<hook> (steady)".
+        """
+        host = fakes.FakeHost(self)
+        harness = Harness(IPFSCharm)
+        self.addCleanup(harness.cleanup)
+        # No co-located cluster to collect metrics from.
+        harness.update_config({'hook-stats-size': 10000, 'ipfs-api-url': host.api.url,
+                               'cluster-api-url': ''})
+        # The peer relation exists from deployment on.
+        ipfs_peers = harness.add_relation('ipfs-peers', 'ipfs-daemon')
+        harness.set_leader(True)
+        harness.begin()
+        charm = harness.charm
+        results = {}
+
+        def hook(name, fire, rounds=1):
+            key = f"{name} (steady)" if rounds > 1 else name
+            for _ in range(rounds):
+                requests = host.api.requests
+                fire()
+                record = charm._stored.hook_stats[-1]
+                self.assertEqual(record['hook'], name)
+                stats = results.setdefault(key, {'wall-ms': float('inf'), 'commands': 0,
+                                                 'requests': 0})
+                stats['wall-ms'] = min(stats['wall-ms'], record['wall'] * 1000)
+                stats['commands'] = max(stats['commands'], len(record['commands']))
+                stats['requests'] = max(stats['requests'], host.api.requests - requests)
+
+        storage_id = harness.add_storage('ipfs-repo')[0]
+        hook('ipfs-repo-storage-attached', lambda: harness.attach_storage(storage_id))
+        hook('install', charm.on.install.emit)
+        hook('leader-elected', charm.on.leader_elected.emit)
+        hook('config-changed', charm.on.config_changed.emit)
+        hook('start', charm.on.start.emit)
+
+        ipfs = harness.add_relation('ipfs', 'ipfs-cluster')
+        hook('ipfs-relation-joined', lambda: harness.add_relation_unit(ipfs, 'ipfs-cluster/0'))
+        scrape = harness.add_relation('metrics-endpoint', 'prometheus')
+        hook('metrics-endpoint-relation-joined',
+             lambda: harness.add_relation_unit(scrape, 'prometheus/0'))
+
+        def data(n):
+            return {'peer-id': fakes.peer_id(n),
+                    'multiaddrs': json.dumps([f"/ip4/10.0.{n // 250}.{n % 250 + 1}/tcp/4001"])}
+
+        # The others join one by one as in a real model, the last one is measured.
+        for n in range(1, peers):
+            harness.add_relation_unit(ipfs_peers, f"ipfs-daemon/{n}")
+            harness.update_relation_data(ipfs_peers, f"ipfs-daemon/{n}", data(n))
+        last = f"ipfs-daemon/{peers}"
+        hook('ipfs-peers-relation-joined', lambda: harness.add_relation_unit(ipfs_peers, last))
+        hook('ipfs-peers-relation-changed',
+             lambda: harness.update_relation_data(ipfs_peers, last, data(peers)))
+
+        relation = harness.model.get_relation('ipfs-peers')
+        hook('ipfs-peers-relation-changed', lambda: charm.on.ipfs_peers_relation_changed.emit(
+            relation, relation.app, harness.model.get_unit(last)), ROUNDS)
+        hook('update-status', charm.on.update_status.emit, ROUNDS)
+        # The Harness has no add-metric.
+        with patch.object(harness._backend, 'add_metrics'):
+            hook('collect-metrics', charm.on.collect_metrics.emit, ROUNDS)
+        hook('config-changed', charm.on.config_changed.emit, ROUNDS)
+        hook('leader-settings-changed', charm.on.leader_settings_changed.emit)
+        hook('upgrade-charm', charm.on.upgrade_charm.emit)
+        hook('ipfs-peers-relation-departed',
+             lambda: harness.remove_relation_unit(ipfs_peers, last))
+        hook('ipfs-repo-storage-detaching', lambda: harness.detach_storage(storage_id))
+        hook('stop', charm.on.stop.emit)
+        hook('remove', charm.on.remove.emit)
+
+        repo_config = json.loads((host.repo / 'config').read_text())
+        self.assertEqual(len(repo_config['Peering']['Peers']), peers - 1)
+        return results
+
+    def test_hooks_scale_with_peers(self):
+        results = {peers: self._deploy(peers) for peers in PEERS}
+        small, large = results[PEERS[0]], results[PEERS[-1]]
+        for hook, stats in large.items():
+            stats['limit-ms'] = min(HOOK_SLOWDOWN * small[hook]['wall-ms'] + HOOK_SLACK_MS,
+                                    HOOK_BUDGET_MS)
+        report = os.environ.get('HOOK_BENCH_REPORT')
+        if report:
+            with open(report, 'w') as f:
+                json.dump(results, f, indent=2)
+
+        for hook, stats in large.items():
+            with self.subTest(hook=hook):
+                self.assertLessEqual(stats['commands'], small[hook]['commands'])
+                self.assertLessEqual(stats['requests'], small[hook]['requests'])
+                self.assertLessEqual(stats['wall-ms'], stats['limit-ms'],
+                                     f"{hook}: {small[hook]['wall-ms']:.1f} ms with {PEERS[0]} "
+                                     f"peer(s), {stats['wall-ms']:.1f} ms with {PEERS[-1]}")
@@ -0,0 +1,82 @@
+# Copyright 2021 Erik Lönroth
+# See LICENSE file for licensing details.
+
+import json
+import threading
+import unittest
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+import metrics
+from ipfs_api import IpfsApi
+
+API = {
+    '/api/v0/stats/bw': {'TotalIn': 100, 'TotalOut': 200, 'RateIn': 1.5, 'RateOut': 2.5},
+    '/api/v0/repo/stat': {'RepoSize': 4096, 'StorageMax': 10000},
+    '/api/v0/swarm/peers': {'Peers': [{'Peer': 'a'}, {'Peer': 'b'}, {'Peer': 'c'}]},
+    '/api/v0/bitswap/stat': {'BlocksReceived': 7, 'BlocksSent': 8, 'DupBlksReceived': 1,
+                             'Wantlist': [{'/': 'x'}], 'Peers': ['a', 'b']},
+    '/id': {'id': 'local'},
+    '/pins': [{'peer_map': {'local': {'status': 'queued'}, 'other': {'status': 'pinned'}}},
+              {'peer_map': {'local': {'status': 'pin_error'}}},
+              {'peer_map': {'local': {'status': 'pinning'}}},
+              {'peer_map': {'other': {'status': 'queued'}}}],
+}
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def _reply(self):
+        self.server.requests.append((self.command, self.path))
+        body = API.get(self.path.split('?')[0])
+        if body is None:
+            self.send_error(404)
+            return
+        data = json.dumps(body).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    do_GET = do_POST = _reply
+
+    def log_message(self, *args):
+        pass
+
+
+class TestMetrics(unittest.TestCase):
+    def setUp(self):
+        self.server = HTTPServer(('127.0.0.1', 0), StubHandler)
+        self.server.requests = []
+        self.url = f"http://127.0.0.1:{self.server.server_port}"
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+        self.api = IpfsApi(self.url, timeout=2)
+        self.addCleanup(self.api.close)
+
+    def test_collect_reads_api_over_post(self):
+        samples = {s.name: s.value for s in metrics.collect(self.api)}
+        self.assertEqual(samples['ipfs_up'], 1)
+        self.assertEqual(samples['ipfs_repo_size_bytes'], 4096)
+        self.assertEqual(samples['ipfs_swarm_peers'], 3)
+        self.assertEqual(samples['ipfs_bitswap_wantlist_length'], 1)
+        self.assertTrue(all(method == 'POST' for method, _ in self.server.requests))
+        self.assertNotIn('ipfs_cluster_up', samples)
+
+    def test_collect_counts_local_cluster_queue(self):
+        samples = {s.name: s.value for s in metrics.collect(self.api, self.url)}
+        self.assertEqual(samples['ipfs_cluster_pins_queued'], 1)
+        self.assertEqual(samples['ipfs_cluster_pins_pinning'], 1)
+        self.assertEqual(samples['ipfs_cluster_pin_errors'], 1)
+
+    def test_api_down_is_reported(self):
+        api = IpfsApi('http://127.0.0.1:1', timeout=0.5)
+        self.addCleanup(api.close)
+        samples = {s.name: s.value for s in metrics.collect(api)}
+        self.assertEqual(samples, {'ipfs_up': 0})
+
+    def test_render_prometheus(self):
+        text = metrics.render_prometheus([metrics.Sample('ipfs_up', 1, 'Up.', 'gauge')])
+        self.assertEqual(text, "# HELP ipfs_up Up.\n# TYPE ipfs_up gauge\nipfs_up 1\n")
@@ -0,0 +1,38 @@
+# Copyright 2021 Erik Lönroth
+# See LICENSE file for licensing details.
+
+import unittest
+
+import requests
+
+import peering
+
+
+class FakeApi:
+    def __init__(self, fail=False):
+        self.calls = []
+        self.fail = fail
+
+    def call(self, command, arg=None):
+        if self.fail:
+            raise requests.ConnectionError("refused")
+        self.calls.append((command, arg))
+
+
+class TestPeering(unittest.TestCase):
+    def test_swarm_multiaddrs(self):
+        swarm = ["/ip4/0.0.0.0/tcp/4001", "/ip6/::/tcp/4001", "/ip4/0.0.0.0/udp/4001/quic"]
+        self.assertEqual(peering.swarm_multiaddrs(swarm, '10.0.0.5'),
+                         ["/ip4/10.0.0.5/tcp/4001", "/ip4/10.0.0.5/udp/4001/quic"])
+        self.assertEqual(peering.swarm_multiaddrs(swarm, 'fd00::5'), ["/ip6/fd00::5/tcp/4001"])
+
+    def test_apply_only_the_difference(self):
+        api = FakeApi()
+        old = {'QmA': ['/ip4/10.0.0.1/tcp/4001'], 'QmB': ['/ip4/10.0.0.2/tcp/4001']}
+        new = {'QmB': ['/ip4/10.0.0.2/tcp/4001'], 'QmC': ['/ip4/10.0.0.3/tcp/4001']}
+        self.assertTrue(peering.apply(api, old, new))
+        self.assertEqual(api.calls, [('swarm/peering/rm', 'QmA'),
+                                     ('swarm/peering/add', ['/ip4/10.0.0.3/tcp/4001/p2p/QmC'])])
+        self.assertFalse(peering.apply(FakeApi(fail=True), old, new))
+        self.assertEqual(peering.peering_config(new)[0],
+                         {'ID': 'QmB', 'Addrs': ['/ip4/10.0.0.2/tcp/4001']})
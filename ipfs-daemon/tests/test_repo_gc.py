@@ -0,0 +1,74 @@
+# Copyright 2021 Erik Lönroth
+# See LICENSE file for licensing details.
+
+import subprocess
+import tempfile
+import unittest
+from datetime import datetime, timezone
+from pathlib import Path
+from unittest.mock import MagicMock, patch
+
+import repo_gc
+
+
+def at(hour, minute=0):
+    return datetime(2021, 6, 1, hour, minute, tzinfo=timezone.utc)
+
+
+class TestRepoGC(unittest.TestCase):
+    def test_window(self):
+        self.assertTrue(repo_gc.in_window('', at(12)))
+        self.assertTrue(repo_gc.in_window('02:00-05:00', at(3, 30)))
+        self.assertFalse(repo_gc.in_window('02:00-05:00', at(5)))
+        self.assertTrue(repo_gc.in_window('23:00-01:30', at(0, 15)))
+        self.assertFalse(repo_gc.in_window('23:00-01:30', at(22)))
+        with self.assertRaises(ValueError):
+            repo_gc.in_window('nightly', at(1))
+
+    def test_watermark(self):
+        self.assertTrue(repo_gc.over_watermark(90, 100, 90))
+        self.assertFalse(repo_gc.over_watermark(89, 100, 90))
+        self.assertFalse(repo_gc.over_watermark(100, 100, 0))
+
+    @patch('repo_gc.hookstats')
+    def test_run_throttles_and_restores_io_weight(self, hookstats):
+        hookstats.check_output.return_value = b'[not set]\n'
+        api = MagicMock()
+        api.repo_stat.side_effect = [{'RepoSize': 1000, 'StorageMax': 2000},
+                                     {'RepoSize': 400, 'StorageMax': 2000}]
+        response = api.post.return_value.__enter__.return_value = api.post.return_value
+        response.iter_lines.return_value = [b'{"Key":{"/":"a"}}', b'{"Key":{"/":"b"}}',
+                                            b'{"Error":"boom"}']
+        result = repo_gc.run(api, 'ipfs-daemon.service', io_weight=10, timeout=60)
+        self.assertEqual((result['freed'], result['removed'], result['errors']), (600, 2, 1))
+        self.assertEqual([c.args[0] for c in hookstats.system.call_args_list], [
+            'systemctl set-property --runtime ipfs-daemon.service IOWeight=10',
+            'systemctl set-property --runtime ipfs-daemon.service IOWeight='])
+
+        history = []
+        for _ in range(repo_gc.GC_HISTORY_SIZE + 5):
+            repo_gc.record(history, result, 'action')
+        self.assertEqual(len(history), repo_gc.GC_HISTORY_SIZE)
+
+    @patch('repo_gc.hookstats')
+    def test_unreadable_io_weight_restores_the_default(self, hookstats):
+        hookstats.check_output.side_effect = subprocess.CalledProcessError(1, 'systemctl')
+        api = MagicMock()
+        api.repo_stat.return_value = {'RepoSize': 10, 'StorageMax': 20}
+        api.post.return_value.__enter__.return_value.iter_lines.return_value = []
+        repo_gc.run(api, 'ipfs-daemon.service', io_weight=10, timeout=60)
+        self.assertEqual(hookstats.system.call_args.args[0],
+                         'systemctl set-property --runtime ipfs-daemon.service IOWeight=')
+
+    def test_unit_leaves_its_result_for_collect(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            result = Path(tmp) / 'gc/result.json'
+            argv = ['repo_gc.py', '--api-url', 'http://127.0.0.1:1', '--result', str(result)]
+            with patch('sys.argv', argv), patch('signal.signal'):
+                self.assertEqual(repo_gc.main(), 1)
+            history = []
+            collected = repo_gc.collect(history, 'action', result)
+            self.assertIn('error', collected)
+            self.assertEqual(collected['trigger'], 'action')
+            self.assertFalse(result.exists())
+            self.assertIsNone(repo_gc.collect(history, 'action', result))
@@ -0,0 +1,79 @@
+# Copyright 2021 Erik Lönroth
+# See LICENSE file for licensing details.
+
+import shutil
+import subprocess
+import unittest
+from pathlib import Path
+from unittest.mock import Mock, patch
+
+import storage
+from tests import fakes
+
+
+class TestStorage(unittest.TestCase):
+    def setUp(self):
+        self.host = fakes.FakeHost(self)
+        self.fstab = Path(storage.FSTAB)
+        self.repo = self.host.repo
+        (self.repo / 'blocks').mkdir()
+        (self.repo / 'blocks/data').write_text('block')
+        self.volume = self.host.root / 'srv/ipfs-state/repo'
+        self.volume.mkdir(parents=True)
+        self.events = []
+        self.passes = []
+
+        def sync(source, target, progress=None, delete=False, interval=10):
+            # rsync stand-in: copy the tree, log which pass this was.
+            self.passes.append((self.events[:], delete))
+            shutil.copytree(source, target, dirs_exist_ok=True)
+        sync_patch = patch('storage.sync', side_effect=sync)
+        sync_patch.start()
+        self.addCleanup(sync_patch.stop)
+
+    def test_bind_mount_is_in_fstab_once(self):
+        self.fstab.write_text("LABEL=root\t/\text4\tdefaults\t0\t1\n")
+        storage.bind_mount(self.volume, self.repo)
+        storage.bind_mount(self.volume, self.repo)
+        lines = self.fstab.read_text().splitlines()
+        self.assertEqual(lines, ["LABEL=root\t/\text4\tdefaults\t0\t1",
+                                 f"{self.volume}\t{self.repo}\tnone\tbind\t0\t0"])
+        self.assertEqual(self.host.commands.count(f"mount --bind {self.volume} {self.repo}"), 2)
+
+    def test_unmount_drops_only_its_fstab_line(self):
+        self.fstab.write_text("LABEL=root\t/\text4\tdefaults\t0\t1\n")
+        storage.bind_mount(self.volume, self.repo)
+        storage.unmount(self.repo)
+        self.assertEqual(self.fstab.read_text(), "LABEL=root\t/\text4\tdefaults\t0\t1\n")
+
+    def test_migrate_copies_twice_and_stops_only_for_the_second_pass(self):
+        stop = Mock(side_effect=lambda: self.events.append('stop'))
+        start = Mock(side_effect=lambda: self.events.append('start'))
+        storage.migrate(self.repo, self.volume, stop, start)
+
+        self.assertEqual(self.passes, [([], False), (['stop'], True)])
+        self.assertEqual(self.events, ['stop', 'start'])
+        self.assertEqual((self.volume / 'blocks/data').read_text(), 'block')
+        self.assertIn(f"{self.volume}\t{self.repo}\tnone\tbind", self.fstab.read_text())
+        self.assertFalse(Path(f"{self.repo}.pre-storage").exists())
+
+    def test_failed_mount_puts_the_old_copy_back(self):
+        stop = Mock(side_effect=lambda: self.events.append('stop'))
+        start = Mock(side_effect=lambda: self.events.append('start'))
+        self.host.failing.add('mount')
+        with self.assertRaises(subprocess.CalledProcessError):
+            storage.migrate(self.repo, self.volume, stop, start)
+
+        self.assertIn(f"mount --bind {self.volume} {self.repo}", self.host.commands)
+        self.assertEqual(self.events, ['stop', 'start'])
+        self.assertEqual((self.repo / 'blocks/data').read_text(), 'block')
+        self.assertFalse(Path(f"{self.repo}.pre-storage").exists())
+        self.assertNotIn(str(self.volume), self.fstab.read_text())
+
+    def test_fstab_survives_a_failed_write(self):
+        storage.bind_mount(self.volume, self.repo)
+        before = self.fstab.read_text()
+        with patch('os.fsync', side_effect=OSError('disk full')):
+            with self.assertRaises(OSError):
+                storage.unmount(self.repo)
+        self.assertEqual(self.fstab.read_text(), before)
@@ -0,0 +1,78 @@
+# Copyright 2021 Erik Lönroth
+# See LICENSE file for licensing details.
+
+import json
+import os
+import tempfile
+import unittest
+
+import tuning
+
+
+class TestTuning(unittest.TestCase):
+    def test_overrides_win_over_profile(self):
+        settings = tuning.resolve({'tuning-profile': 'low-memory', 'connmgr-high-water': 300,
+                                   'storage-max': '', 'enable-gc': ''})
+        self.assertEqual(settings['connmgr-high-water'], 300)
+        self.assertEqual(settings['connmgr-low-water'], 20)
+        self.assertEqual(settings['storage-max'], '10GB')
+        self.assertEqual(tuning.daemon_args(settings), 'daemon --enable-gc')
+
+    def test_invalid_values_raise(self):
+        with self.assertRaises(ValueError):
+            tuning.resolve({'tuning-profile': 'fast'})
+        with self.assertRaises(ValueError):
+            tuning.resolve({'routing-type': 'gossip'})
+
+    def test_no_profile_leaves_ipfs_defaults(self):
+        self.assertEqual(tuning.resolve({'tuning-profile': ''}), {})
+
+    def test_apply_repo_config_merges_once(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'config')
+            with open(path, 'w') as f:
+                json.dump({'Swarm': {'ConnMgr': {'LowWater': 600, 'Type': 'basic'}},
+                           'Identity': {'PeerID': 'Qm'}}, f)
+            settings = tuning.repo_settings(tuning.resolve({'tuning-profile': 'low-memory'}))
+
+            changed = tuning.apply_repo_config(path, settings)
+            self.assertEqual(changed['Swarm.ConnMgr.LowWater'], (600, 20))
+            with open(path) as f:
+                data = json.load(f)
+            self.assertEqual(data['Swarm']['ConnMgr'], {'LowWater': 20, 'HighWater': 100,
+                                                        'Type': 'basic'})
+            self.assertEqual(data['Identity'], {'PeerID': 'Qm'})
+            self.assertEqual(tuning.apply_repo_config(path, settings), {})
+            self.assertEqual(os.listdir(tmp), ['config'])
+
+    def test_flatfs_layout_applied_to_empty_repo_only(self):
+        layout = tuning.datastore_layout('flatfs', 4 * tuning.TIB)
+        spec = {'type': 'mount', 'mounts': [
+            {'mountpoint': '/blocks', 'type': 'flatfs', 'path': 'blocks',
+             'shardFunc': '/repo/flatfs/shard/v1/next-to-last/2'}]}
+        with tempfile.TemporaryDirectory() as tmp:
+            os.mkdir(os.path.join(tmp, 'blocks'))
+            for name, data in (('config', {'Datastore': {'Spec': spec}}),
+                               ('datastore_spec', '{"mounts":[{"mountpoint":"/blocks",'
+                                                  '"path":"blocks","shardFunc":'
+                                                  '"/repo/flatfs/shard/v1/next-to-last/2",'
+                                                  '"type":"flatfs"}],"type":"mount"}'),
+                               ('blocks/SHARDING', '/repo/flatfs/shard/v1/next-to-last/2\n')):
+                with open(os.path.join(tmp, name), 'w') as f:
+                    f.write(data if isinstance(data, str) else json.dumps(data))
+            self.assertTrue(tuning.apply_datastore_layout(tmp, layout))
+            with open(os.path.join(tmp, 'datastore_spec')) as f:
+                self.assertEqual(f.read(), '{"mounts":[{"mountpoint":"/blocks","path":"blocks",'
+                                           '"shardFunc":"/repo/flatfs/shard/v1/next-to-last/3",'
+                                           '"type":"flatfs"}],"type":"mount"}')
+            with open(os.path.join(tmp, 'blocks', 'SHARDING')) as f:
+                self.assertEqual(f.read(), '/repo/flatfs/shard/v1/next-to-last/3\n')
+            os.mkdir(os.path.join(tmp, 'blocks', 'AB'))
+            self.assertFalse(tuning.apply_datastore_layout(tmp, layout))
+
+    def test_api_socket_added_next_to_tcp_and_removed_again(self):
+        tcp = '/ip4/127.0.0.1/tcp/5001'
+        with_socket = tuning.api_addresses(tcp, '/home/ubuntu/snap/ipfs/common/api.sock')
+        self.assertEqual(with_socket, [tcp, '/unix/home/ubuntu/snap/ipfs/common/api.sock'])
+        self.assertEqual(tuning.api_addresses(with_socket), tcp)
+        self.assertEqual(tuning.api_addresses(tcp), tcp)
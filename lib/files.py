@@ -0,0 +1,32 @@
+# Copyright 2021 Erik Lönroth
+# See LICENSE file for licensing details.
+
+"""
+File writes that never leave a half-written file behind.
+"""
+
+import os
+import tempfile
+
+
+def write_atomic(path, content):
+    """
+    Write content next to path and rename it over, keeping owner and mode of the old file.
+    """
+    st = os.stat(path) if os.path.exists(path) else None
+    fd, tmp = tempfile.mkstemp(prefix='.tmp-', dir=os.path.dirname(path))
+    try:
+        with os.fdopen(fd, 'w') as f:
+            f.write(content)
+            f.flush()
+            os.fsync(f.fileno())
+        if st:
+            os.chmod(tmp, st.st_mode & 0o7777)
+            os.chown(tmp, st.st_uid, st.st_gid)
+        else:
+            # mkstemp makes it private, unit and env files are world readable.
+            os.chmod(tmp, 0o644)
+        os.replace(tmp, path)
+    except BaseException:
+        os.unlink(tmp)
+        raise
@@ -0,0 +1,106 @@
+# Copyright 2021 Erik Lönroth
+# See LICENSE file for licensing details.
+
+"""
+API round trip probes behind the unit status.
+
+A service that systemd reports active may still be wedged or crawling. The probe
+times real API calls and the status follows the p95 over the last WINDOW of
+them, so one slow call does not flap the status while a slow node shows within
+a tick or two. Load balancers reading the unit status can act on it.
+"""
+
+import os
+import time
+
+from ops.model import ActiveStatus, BlockedStatus, MaintenanceStatus
+
+from hookstats import percentile
+
+# Round trip times (ms) kept to compute the p95 from.
+WINDOW = 60
+# Load balancer weights move in steps of this, a little jitter changes nothing.
+WEIGHT_STEP = 10
+
+
+def probe(calls, samples):
+    """
+    Run every call in calls samples times and return the round trip times in ms.
+
+    Whatever a call raises is passed on, a failed call is a failed probe.
+    """
+    times = []
+    for _ in range(samples):
+        for call in calls:
+            started = time.monotonic()
+            call()
+            times.append(round((time.monotonic() - started) * 1000, 1))
+    return times
+
+
+def record(history, times, window=WINDOW):
+    history.extend(times)
+    del history[:max(0, len(history) - window)]
+
+
+def assess(history, degraded_ms, blocked_ms):
+    """
+    ('active' | 'degraded' | 'blocked', p95 in ms) for the recorded round trips.
+    """
+    p95 = percentile(list(history), 95) or 0
+    if p95 >= blocked_ms:
+        return 'blocked', p95
+    if p95 >= degraded_ms:
+        return 'degraded', p95
+    return 'active', p95
+
+
+def timed_out(history, blocked_ms):
+    """
+    A probe that ran into its blocked_ms timeout: ('blocked', blocked_ms).
+
+    The window would hide a single timeout among fast round trips, but a call
+    that did not come back in time blocks on its own.
+    """
+    record(history, [float(blocked_ms)])
+    return 'blocked', float(blocked_ms)
+
+
+def to_status(state, p95, note=""):
+    note = f" {note}" if note else ""
+    if state == 'blocked':
+        return BlockedStatus(f"API too slow (p95 {p95:.0f} ms).{note}")
+    if state == 'degraded':
+        return MaintenanceStatus(f"Degraded (p95 {p95:.0f} ms).{note}")
+    return ActiveStatus(f"Running.{note}")
+
+
+def weight(state, p95, degraded_ms, connections=0, max_connections=0):
+    """
+    Load balancer weight from 0 to 100.
+
+    A blocked unit gets 0. Full weight up to a p95 of half degraded_ms, half of it
+    at degraded_ms, and down to half again as connections fill up max_connections.
+    """
+    if state == 'blocked':
+        return 0
+    latency = min(1.0, degraded_ms / 2 / p95) if p95 else 1.0
+    load = 1.0 - 0.5 * min(1.0, connections / max_connections) if max_connections else 1.0
+    return max(WEIGHT_STEP, round(100 * latency * load / WEIGHT_STEP) * WEIGHT_STEP)
+
+
+def cached_version(cache, path, read):
+    """
+    The workload version, only running read() when the binary at path changed.
+
+    cache is a stored dict, the binary is identified by its resolved path and mtime.
+    """
+    real = os.path.realpath(path)
+    try:
+        key = f"{real}:{os.stat(real).st_mtime_ns}"
+    except OSError:
+        return None
+    if cache.get('key') != key:
+        cache['version'] = read()
+        cache['key'] = key
+    return cache['version']
@@ -0,0 +1,156 @@
+# Copyright 2021 Erik Lönroth
+# See LICENSE file for licensing details.
+
+"""
+Per-hook wall time and external command accounting.
+
+Handlers decorated with @timed get their wall time and every command run through
+system()/check_output()/run() recorded in a bounded ring buffer in the charm's
+StoredState (charm._stored.hook_stats). summarize() turns that into percentiles.
+"""
+
+import functools
+import logging
+import math
+import os
+import re
+import shlex
+import subprocess
+import time
+
+logger = logging.getLogger(__name__)
+
+HOOK_STATS_SIZE = 200
+
+# Commands run by the hook being timed, None outside of a timed hook.
+_commands = None
+
+
+def _label(cmd):
+    """
+    Short name for a command: the program and its subcommand, without sudo -u <user>.
+    """
+    argv = shlex.split(cmd) if isinstance(cmd, str) else [str(arg) for arg in cmd]
+    if argv[:2] == ['sudo', '-u']:
+        argv = argv[3:]
+    argv = [os.path.basename(argv[0])] + [arg for arg in argv[1:2] if not arg.startswith('-')]
+    return ' '.join(argv)
+
+
+def timed_call(cmd, func, *args, **kwargs):
+    """
+    Call func, accounting its time to the current hook as command cmd.
+    """
+    started = time.monotonic()
+    try:
+        return func(*args, **kwargs)
+    finally:
+        if _commands is not None:
+            _commands.append([_label(cmd), round(time.monotonic() - started, 4)])
+
+
+def system(cmd):
+    """
+    os.system, accounted to the current hook.
+    """
+    return timed_call(cmd, os.system, cmd)
+
+
+def check_output(args, **kwargs):
+    """
+    subprocess.check_output, accounted to the current hook.
+    """
+    return timed_call(args, subprocess.check_output, args, **kwargs)
+
+
+def run(args, **kwargs):
+    """
+    subprocess.run, accounted to the current hook.
+    """
+    return timed_call(args, subprocess.run, args, **kwargs)
+
+
+def timed(handler):
+    """
+    Decorate an event handler to record its wall time and external commands.
+
+    Handlers called from another timed handler are counted as part of the outer one.
+    """
+    @functools.wraps(handler)
+    def wrapper(charm, event):
+        global _commands
+        if _commands is not None:
+            return handler(charm, event)
+
+        _commands = []
+        started = time.monotonic()
+        try:
+            return handler(charm, event)
+        finally:
+            wall = time.monotonic() - started
+            commands, _commands = _commands, None
+            size = charm.config.get('hook-stats-size') or HOOK_STATS_SIZE
+            record(charm._stored.hook_stats, event.handle.kind, wall, commands, size)
+    return wrapper
+
+
+def record(ring, hook, wall, commands, size=HOOK_STATS_SIZE):
+    """
+    Append one hook result to ring, dropping the oldest beyond size.
+    """
+    hook = hook.replace('_', '-')
+    ring.append({'hook': hook, 'at': round(time.time(), 1), 'wall': round(wall, 4),
+                 'commands': commands})
+    while len(ring) > size:
+        del ring[0]
+    logger.debug(f"{hook} took {wall:.3f}s running {len(commands)} command(s)")
+
+
+def percentile(values, pct):
+    """
+    Nearest-rank percentile of values, None for no values.
+    """
+    if not values:
+        return None
+    ordered = sorted(values)
+    rank = math.ceil(pct / 100.0 * len(ordered))
+    return ordered[max(rank, 1) - 1]
+
+
+def _key(name):
+    # Action result keys: lowercase alphanumerics and dashes.
+    return re.sub(r'[^a-z0-9]+', '-', name.lower()).strip('-')
+
+
+def summarize(records, hook=None):
+    """
+    Per hook percentiles of wall time and command counts/durations, in milliseconds.
+    """
+    by_hook = {}
+    for rec in records:
+        if hook and rec['hook'] != hook:
+            continue
+        by_hook.setdefault(rec['hook'], []).append(rec)
+
+    summary = {}
+    for name, recs in sorted(by_hook.items()):
+        walls = [rec['wall'] * 1000 for rec in recs]
+        counts = [len(rec['commands']) for rec in recs]
+        commands = {}
+        for rec in recs:
+            for label, seconds in rec['commands']:
+                commands.setdefault(label, []).append(seconds * 1000)
+        summary[_key(name)] = {
+            'count': len(recs),
+            'wall-p50-ms': round(percentile(walls, 50), 1),
+            'wall-p95-ms': round(percentile(walls, 95), 1),
+            'wall-p99-ms': round(percentile(walls, 99), 1),
+            'wall-max-ms': round(max(walls), 1),
+            'commands-per-hook-p50': percentile(counts, 50),
+            'commands-per-hook-max': max(counts),
+            'commands': {_key(label): {'count': len(times),
+                                       'total-ms': round(sum(times), 1),
+                                       'p95-ms': round(percentile(times, 95), 1)}
+                         for label, times in sorted(commands.items())},
+        }
+    return summary
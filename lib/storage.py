@@ -0,0 +1,175 @@
+# Copyright 2021 Erik Lönroth
+# See LICENSE file for licensing details.
+
+"""
+Placement of service state on a Juju storage volume.
+
+The volume is bind mounted over the directory the service already uses, so
+nothing else (snap confinement, unit files, paths in configs) has to change.
+"""
+
+import logging
+import os
+import re
+import shutil
+import subprocess
+import time
+
+import files
+import hookstats
+
+logger = logging.getLogger(__name__)
+
+FSTAB = '/etc/fstab'
+PROC_MOUNTS = '/proc/mounts'
+PROGRESS = re.compile(rb'\s(\d{1,3})%\s')
+
+
+def _mount_options(mountpoint):
+    options = None
+    with open(PROC_MOUNTS) as f:
+        for line in f:
+            fields = line.split()
+            # The last mount on a path is the one in effect.
+            if fields[1] == str(mountpoint):
+                options = fields[3].split(',')
+    return options
+
+
+def ensure_noatime(mountpoint):
+    """
+    Remount mountpoint with noatime (once), and keep it that way in fstab.
+
+    Every block read would otherwise be a metadata write on the volume.
+    """
+    options = _mount_options(mountpoint)
+    if options is None or 'noatime' in options:
+        return False
+    hookstats.system(f"mount -o remount,noatime {mountpoint}")
+    _fstab_add_option(mountpoint, 'noatime')
+    logger.info(f"Remounted {mountpoint} with noatime")
+    return True
+
+
+def _fstab_add_option(mountpoint, option):
+    if not os.path.exists(FSTAB):
+        return
+    with open(FSTAB) as f:
+        lines = f.readlines()
+    changed = False
+    for i, line in enumerate(lines):
+        fields = line.split()
+        if len(fields) >= 4 and not line.startswith('#') and fields[1] == str(mountpoint) \
+                and option not in fields[3].split(','):
+            fields[3] += f",{option}"
+            lines[i] = '\t'.join(fields) + '\n'
+            changed = True
+    if changed:
+        files.write_atomic(FSTAB, ''.join(lines))
+
+
+def is_bind_mounted(source, target):
+    """
+    Is target the same directory as source (i.e. source is bind mounted on it)?
+    """
+    if not (os.path.isdir(source) and os.path.isdir(target)):
+        return False
+    a, b = os.stat(source), os.stat(target)
+    return (a.st_dev, a.st_ino) == (b.st_dev, b.st_ino)
+
+
+def bind_mount(source, target, owner='ubuntu'):
+    """
+    Bind mount source on target, persisted in fstab once it is mounted.
+
+    Raises CalledProcessError if mount fails, fstab is left alone then.
+    """
+    os.makedirs(source, exist_ok=True)
+    os.makedirs(target, exist_ok=True)
+    shutil.chown(source, owner, owner)
+    if not is_bind_mounted(source, target):
+        hookstats.run(['mount', '--bind', str(source), str(target)], check=True)
+    lines = []
+    if os.path.exists(FSTAB):
+        with open(FSTAB) as f:
+            lines = f.readlines()
+    if not any(line.split()[:2] == [str(source), str(target)] for line in lines):
+        if lines and not lines[-1].endswith('\n'):
+            lines[-1] += '\n'
+        lines.append(f"{source}\t{target}\tnone\tbind\t0\t0\n")
+        files.write_atomic(FSTAB, ''.join(lines))
+    logger.info(f"{source} bind mounted on {target}")
+
+
+def unmount(target):
+    if os.path.ismount(target):
+        hookstats.system(f"umount {target}")
+    with open(FSTAB) as f:
+        lines = f.readlines()
+    kept = [line for line in lines if line.split()[1:2] != [str(target)]]
+    if kept != lines:
+        files.write_atomic(FSTAB, ''.join(kept))
+
+
+def has_data(path):
+    return os.path.isdir(path) and any(os.scandir(path))
+
+
+def volume_size(path):
+    st = os.statvfs(path)
+    return st.f_blocks * st.f_frsize
+
+
+def sync(source, target, progress=None, delete=False, interval=10):
+    """
+    rsync source into target, calling progress(percent) at most every interval seconds.
+    """
+    argv = ['rsync', '-aHX', '--info=progress2', '--no-inc-recursive']
+    if delete:
+        argv.append('--delete')
+    argv += [f"{source}/", f"{target}/"]
+
+    def run():
+        proc = subprocess.Popen(argv, stdout=subprocess.PIPE)
+        last, buffer = 0, b''
+        for data in iter(lambda: proc.stdout.read(4096), b''):
+            # progress2 rewrites one line with \r
+            buffer = (buffer + data)[-256:]
+            match = None
+            for match in PROGRESS.finditer(buffer):
+                pass
+            if match and progress and time.monotonic() - last >= interval:
+                progress(int(match.group(1)))
+                last = time.monotonic()
+        if proc.wait() != 0:
+            raise subprocess.CalledProcessError(proc.returncode, argv)
+
+    hookstats.timed_call(argv, run)
+
+
+def migrate(source, target, stop, start, progress=None):
+    """
+    Move the contents of source onto the volume at target with little downtime.
+
+    A first pass copies while the service runs, the service is then stopped for a
+    short second pass that picks up what changed, target is bind mounted over source
+    and the service started again. The old copy is only removed after that.
+    """
+    sync(source, target, progress=lambda pct: progress and progress('copying', pct))
+    old = f"{str(source).rstrip('/')}.pre-storage"
+    stop()
+    try:
+        sync(source, target, progress=lambda pct: progress and progress('syncing', pct),
+             delete=True)
+        os.rename(source, old)
+        try:
+            bind_mount(target, source)
+        except Exception:
+            # Put the old copy back rather than starting on an empty directory.
+            if os.path.isdir(source) and not os.path.ismount(source):
+                os.rmdir(source)
+            os.rename(old, source)
+            raise
+    finally:
+        start()
+    shutil.rmtree(old, ignore_errors=True)
@@ -0,0 +1,70 @@
+# Copyright 2021 Erik Lönroth
+# See LICENSE file for licensing details.
+
+"""
+Hardware aware resource settings for the systemd units the charm renders.
+
+Defaults are computed from the host (cores, RAM) and the connection count the
+service is expected to hold. Every value can be overridden from charm config.
+"""
+
+import os
+
+import jinja2
+
+MIB = 1024 * 1024
+
+# Charm option -> setting name
+OVERRIDES = {
+    'limit-nofile': 'LimitNOFILE',
+    'gomaxprocs': 'GOMAXPROCS',
+    'gogc': 'GOGC',
+    'gomemlimit': 'GOMEMLIMIT',
+    'memory-high': 'MemoryHigh',
+    'cpu-weight': 'CPUWeight',
+    'io-weight': 'IOWeight',
+}
+
+
+def host_resources(meminfo='/proc/meminfo'):
+    """
+    {'cores': usable cores (like nproc), 'memory': MemTotal in bytes}
+    """
+    memory = 0
+    with open(meminfo) as f:
+        for line in f:
+            if line.startswith('MemTotal:'):
+                memory = int(line.split()[1]) * 1024
+                break
+    return {'cores': len(os.sched_getaffinity(0)), 'memory': memory}
+
+
+def compute(resources, connections, memory_share, config):
+    """
+    Settings for a unit expected to hold about `connections` peer connections and
+    to use at most memory_share of the host RAM.
+
+    Every connection costs at least one fd, plus streams, datastore files and the
+    listeners, so LimitNOFILE leaves a wide margin. The Go heap limit sits below
+    MemoryHigh so the runtime collects before the kernel starts throttling.
+    """
+    memory_high = int(resources['memory'] * memory_share) // MIB
+    settings = {
+        'LimitNOFILE': max(65536, connections * 8 + 8192),
+        'GOMAXPROCS': max(1, resources['cores']),
+        'GOGC': 100,
+        'MemoryHigh': f"{memory_high}M",
+        'GOMEMLIMIT': f"{memory_high * 9 // 10}MiB",
+        'CPUWeight': 100,
+        'IOWeight': 100,
+    }
+    for option, name in OVERRIDES.items():
+        value = config.get(option)
+        if value not in (None, '', 0):
+            settings[name] = value
+    return settings
+
+
+def render(template_path, **context):
+    with open(template_path) as f:
+        return jinja2.Template(f.read()).render(**context)
@@ -0,0 +1,41 @@
+# Copyright 2021 Erik Lönroth
+# See LICENSE file for licensing details.
+
+import os
+import tempfile
+import unittest
+from pathlib import Path
+from unittest.mock import patch
+
+import files
+
+
+class TestWriteAtomic(unittest.TestCase):
+
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.dir = Path(tmp.name)
+
+    def test_new_files_are_world_readable(self):
+        path = self.dir / 'ipfs.service'
+        files.write_atomic(path, 'a')
+        self.assertEqual(path.read_text(), 'a')
+        self.assertEqual(path.stat().st_mode & 0o777, 0o644)
+
+    def test_keeps_the_mode_of_the_old_file(self):
+        path = self.dir / 'service.json'
+        path.write_text('a')
+        path.chmod(0o600)
+        files.write_atomic(path, 'b')
+        self.assertEqual(path.read_text(), 'b')
+        self.assertEqual(path.stat().st_mode & 0o777, 0o600)
+
+    def test_a_failed_write_leaves_the_old_file(self):
+        path = self.dir / 'config'
+        path.write_text('a')
+        with patch('os.fsync', side_effect=OSError('disk full')):
+            with self.assertRaises(OSError):
+                files.write_atomic(path, 'b')
+        self.assertEqual(path.read_text(), 'a')
+        self.assertEqual(os.listdir(self.dir), ['config'])
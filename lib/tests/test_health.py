@@ -0,0 +1,68 @@
+# Copyright 2021 Erik Lönroth
+# See LICENSE file for licensing details.
+
+import os
+import tempfile
+import unittest
+
+from ops.model import ActiveStatus, BlockedStatus, MaintenanceStatus
+
+import health
+
+
+class TestHealth(unittest.TestCase):
+    def test_status_follows_the_p95_of_the_window(self):
+        history = []
+        health.record(history, [10.0] * 95 + [9000.0] * 5, window=100)
+        self.assertEqual(health.assess(history, 500, 5000)[0], 'active')
+
+        health.record(history, [800.0] * 20, window=100)
+        self.assertEqual(len(history), 100)
+        state, p95 = health.assess(history, 500, 5000)
+        self.assertEqual(state, 'degraded')
+        self.assertIsInstance(health.to_status(state, p95), MaintenanceStatus)
+
+        health.record(history, [6000.0] * 100, window=100)
+        state, p95 = health.assess(history, 500, 5000)
+        self.assertEqual(state, 'blocked')
+        self.assertIsInstance(health.to_status(state, p95), BlockedStatus)
+        self.assertEqual(health.to_status('active', 3, note="Upgrading.").message,
+                         ActiveStatus("Running. Upgrading.").message)
+
+    def test_a_timeout_blocks_despite_the_window(self):
+        history = []
+        health.record(history, [10.0] * 59)
+        self.assertEqual(health.timed_out(history, 5000), ('blocked', 5000.0))
+        self.assertEqual(len(history), 60)
+        self.assertEqual(health.assess(history, 500, 5000)[0], 'active')
+
+    def test_a_failing_call_fails_the_probe(self):
+        def fail():
+            raise OSError("refused")
+        self.assertEqual(len(health.probe([lambda: None, lambda: None], 3)), 6)
+        with self.assertRaises(OSError):
+            health.probe([fail], 3)
+
+    def test_version_is_read_again_only_for_a_new_binary(self):
+        reads = []
+
+        def read():
+            reads.append(1)
+            return f"0.{len(reads)}"
+
+        with tempfile.TemporaryDirectory() as tmp:
+            binary = os.path.join(tmp, 'ipfs')
+            open(binary, 'w').close()
+            cache = {}
+            self.assertEqual(health.cached_version(cache, binary, read), "0.1")
+            self.assertEqual(health.cached_version(cache, binary, read), "0.1")
+            os.utime(binary, ns=(0, 0))
+            self.assertEqual(health.cached_version(cache, binary, read), "0.2")
+            self.assertIsNone(health.cached_version(cache, os.path.join(tmp, 'gone'), read))
+
+    def test_weight_steps_down_with_latency_and_load(self):
+        self.assertEqual(health.weight('active', 10, 500), 100)
+        self.assertEqual(health.weight('degraded', 1250, 500), 20)
+        self.assertEqual(health.weight('active', 10, 500, 900, 900), 50)
+        self.assertEqual(health.weight('degraded', 100000, 500), health.WEIGHT_STEP)
+        self.assertEqual(health.weight('blocked', 10, 500), 0)
@@ -0,0 +1,55 @@
+# Copyright 2021 Erik Lönroth
+# See LICENSE file for licensing details.
+
+import unittest
+from unittest.mock import MagicMock, patch
+
+import hookstats
+
+
+class FakeCharm:
+    def __init__(self):
+        self.config = {'hook-stats-size': 3}
+        self._stored = MagicMock(hook_stats=[])
+
+    @hookstats.timed
+    def _on_update_status(self, event):
+        hookstats.system('systemctl is-active ipfs.service')
+        self._on_other(event)
+
+    @hookstats.timed
+    def _on_other(self, event):
+        hookstats.system('sudo -u ubuntu ipfs init --profile=badgerds')
+
+
+def event(kind):
+    return MagicMock(handle=MagicMock(kind=kind))
+
+
+class TestHookStats(unittest.TestCase):
+    @patch('hookstats.os.system', return_value=0)
+    def test_nested_handlers_count_towards_outer_hook(self, _):
+        charm = FakeCharm()
+        charm._on_update_status(event('update_status'))
+        [rec] = charm._stored.hook_stats
+        self.assertEqual(rec['hook'], 'update-status')
+        self.assertEqual([label for label, _ in rec['commands']],
+                         ['systemctl is-active', 'ipfs init'])
+
+    @patch('hookstats.os.system', return_value=0)
+    def test_ring_is_bounded(self, _):
+        charm = FakeCharm()
+        for kind in ('install', 'start', 'update_status', 'update_status'):
+            charm._on_update_status(event(kind))
+        self.assertEqual([r['hook'] for r in charm._stored.hook_stats],
+                         ['start', 'update-status', 'update-status'])
+
+    def test_summarize(self):
+        records = [{'hook': 'update-status', 'wall': w / 1000.0,
+                    'commands': [['systemctl is-active', 0.01]]} for w in range(1, 101)]
+        summary = hookstats.summarize(records)['update-status']
+        self.assertEqual(summary['count'], 100)
+        self.assertEqual(summary['wall-p50-ms'], 50)
+        self.assertEqual(summary['wall-p95-ms'], 95)
+        self.assertEqual(summary['commands']['systemctl-is-active']['count'], 100)
+        self.assertEqual(hookstats.summarize(records, hook='install'), {})
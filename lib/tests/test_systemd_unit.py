@@ -0,0 +1,33 @@
+# Copyright 2021 Erik Lönroth
+# See LICENSE file for licensing details.
+
+import tempfile
+import unittest
+
+import systemd_unit
+
+HOST = {'cores': 8, 'memory': 16 * 1024 ** 3}
+
+
+class TestSystemdUnit(unittest.TestCase):
+    def test_compute_from_host(self):
+        settings = systemd_unit.compute(HOST, 10000, 0.5, {})
+        self.assertEqual(settings['GOMAXPROCS'], 8)
+        self.assertEqual(settings['MemoryHigh'], '8192M')
+        self.assertEqual(settings['GOMEMLIMIT'], '7372MiB')
+        self.assertEqual(settings['LimitNOFILE'], 10000 * 8 + 8192)
+        self.assertEqual(systemd_unit.compute(HOST, 10, 0.5, {})['LimitNOFILE'], 65536)
+
+    def test_config_overrides(self):
+        settings = systemd_unit.compute(HOST, 900, 0.5, {'gomaxprocs': 2, 'memory-high': '2G',
+                                                         'gogc': 0, 'io-weight': 500})
+        self.assertEqual((settings['GOMAXPROCS'], settings['MemoryHigh']), (2, '2G'))
+        self.assertEqual((settings['GOGC'], settings['IOWeight']), (100, 500))
+
+    def test_host_resources(self):
+        with tempfile.NamedTemporaryFile('w', suffix='meminfo') as f:
+            f.write("MemTotal:       16314436 kB\nMemFree:         1000 kB\n")
+            f.flush()
+            resources = systemd_unit.host_resources(f.name)
+        self.assertEqual(resources['memory'], 16314436 * 1024)
+        self.assertGreaterEqual(resources['cores'], 1)
@@ -0,0 +1,52 @@
+# Copyright 2021 Erik Lönroth
+# See LICENSE file for licensing details.
+
+import json
+import unittest
+from unittest.mock import Mock
+
+import upstreams
+
+
+class TestUpstreams(unittest.TestCase):
+    def test_parse_roles(self):
+        self.assertEqual(upstreams.parse_roles(' gateway,api ,', ('gateway', 'api')),
+                         {'gateway', 'api'})
+        self.assertEqual(upstreams.parse_roles('', ('gateway', 'api')), set())
+        with self.assertRaises(ValueError):
+            upstreams.parse_roles('gateway, swarm', ('gateway', 'api'))
+
+    def test_bind_addresses(self):
+        listeners = ['/ip4/127.0.0.1/tcp/8080', '/ip6/::1/tcp/8080', '/unix/run/api.sock']
+        public = upstreams.bind_addresses(listeners, True)
+        self.assertEqual(public, ['/ip4/0.0.0.0/tcp/8080', '/ip6/::/tcp/8080',
+                                  '/unix/run/api.sock'])
+        self.assertEqual(upstreams.bind_addresses(public, False), listeners)
+        self.assertEqual(upstreams.bind_addresses('/ip4/127.0.0.1/tcp/5001', True),
+                         '/ip4/0.0.0.0/tcp/5001')
+        self.assertEqual(upstreams.bind_addresses('/ip4/10.0.0.5/tcp/5001', False),
+                         '/ip4/10.0.0.5/tcp/5001')
+        self.assertEqual(upstreams.ports(public), [8080])
+        self.assertEqual(upstreams.ports(listeners), [])
+
+    def test_gather_orders_every_unit(self):
+        own = upstreams.entries('ipfs-daemon/10', '10.0.0.10',
+                                {'gateway': '/ip4/0.0.0.0/tcp/8080',
+                                 'api': '/ip4/127.0.0.1/tcp/5001'}, 'active', 100)
+        self.assertEqual(own, [{'unit': 'ipfs-daemon/10', 'role': 'gateway',
+                                'address': '10.0.0.10', 'port': 8080,
+                                'state': 'active', 'weight': 100}])
+        peer, gone = Mock(), Mock()
+        other = upstreams.entries('ipfs-daemon/2', '10.0.0.2',
+                                  {'gateway': '/ip4/0.0.0.0/tcp/8080'}, 'degraded', 30)
+        relation = Mock(units=[peer, gone],
+                        data={peer: {'upstreams': json.dumps(other)}, gone: {}})
+        every = upstreams.gather(relation, own, departed=gone)
+        self.assertEqual([entry['unit'] for entry in every], ['ipfs-daemon/2', 'ipfs-daemon/10'])
+        self.assertEqual(upstreams.gather(None, own), own)
+
+    def test_update_writes_only_changes(self):
+        data = {'hostname': '10.0.0.1'}
+        self.assertFalse(upstreams.update(data, {'hostname': '10.0.0.1'}))
+        self.assertTrue(upstreams.update(data, {'hostname': '10.0.0.1', 'port': '8080'}))
+        self.assertEqual(data, {'hostname': '10.0.0.1', 'port': '8080'})
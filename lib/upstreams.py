@@ -0,0 +1,100 @@
+# Copyright 2021 Erik Lönroth
+# See LICENSE file for licensing details.
+
+"""
+Upstream lists for the reverse proxies and clients in front of a deployment.
+
+Listeners named in public-endpoints are bound on all interfaces. Every unit puts
+them (role, address, port) with its health weight in its unit data on the peer
+relation, and the leader gathers the entries of all units into one list in the
+app data of the provided http relations. Unit data there carries the plain
+hostname and port of the http interface as well.
+"""
+
+import json
+
+LOOPBACK = {'ip4': '127.0.0.1', 'ip6': '::1'}
+WILDCARD = {'ip4': '0.0.0.0', 'ip6': '::'}
+
+
+def parse_roles(value, known):
+    """
+    'gateway, api' -> {'gateway', 'api'}. Raises ValueError on a role not in known.
+    """
+    roles = {role.strip() for role in (value or '').split(',') if role.strip()}
+    unknown = roles - set(known)
+    if unknown:
+        raise ValueError(f"Unknown public-endpoints {', '.join(sorted(unknown))}, "
+                         f"use {', '.join(known)}")
+    return roles
+
+
+def _as_list(addresses):
+    return addresses if isinstance(addresses, list) else [addresses] if addresses else []
+
+
+def bind_addresses(current, public):
+    """
+    TCP listeners in current moved to all interfaces (public) or back to loopback.
+
+    Anything else is kept as it is, a single address stays a plain string.
+    """
+    moved = []
+    for address in _as_list(current):
+        parts = address.split('/')
+        if len(parts) > 4 and parts[1] in LOOPBACK and parts[3] == 'tcp':
+            old, new = (LOOPBACK, WILDCARD) if public else (WILDCARD, LOOPBACK)
+            if parts[2] == old[parts[1]]:
+                parts[2] = new[parts[1]]
+        moved.append('/'.join(parts))
+    if not moved:
+        return current
+    return moved[0] if len(moved) == 1 else moved
+
+
+def ports(addresses):
+    """
+    TCP ports of the listeners in addresses that are bound on all interfaces.
+    """
+    found = []
+    for address in _as_list(addresses):
+        parts = address.split('/')
+        if len(parts) > 4 and parts[3] == 'tcp' and parts[2] == WILDCARD.get(parts[1]):
+            port = int(parts[4])
+            if port not in found:
+                found.append(port)
+    return found
+
+
+def entries(unit, address, listeners, state, weight):
+    """
+    The upstream entries of one unit, listeners being {role: listen multiaddrs}.
+    """
+    return [{'unit': unit, 'role': role, 'address': address, 'port': port,
+             'state': state, 'weight': weight}
+            for role, addresses in sorted(listeners.items()) for port in ports(addresses)]
+
+
+def _order(entry):
+    return entry['role'], int(entry['unit'].split('/')[-1]), entry['port']
+
+
+def gather(relation, own, departed=None):
+    """
+    own plus the entries every other unit in the peer relation published.
+    """
+    found = list(own)
+    for unit in relation.units if relation else ():
+        if unit != departed:
+            found += json.loads(relation.data[unit].get('upstreams') or '[]')
+    return sorted(found, key=_order)
+
+
+def update(data, values):
+    """
+    Write the values that differ into a relation data bag. Returns whether any did.
+    """
+    stale = {key: value for key, value in values.items() if data.get(key) != value}
+    if stale:
+        data.update(stale)
+    return bool(stale)